@@ -1,6 +1,22 @@
-from bipy.utils import append_stem
-from rpy2 import robjects
+"""
+gene annotation of result tables. annotations are looked up in a local
+store, one table per organism and id type, built from the attributes of a
+GTF file and from imported BioMart dumps. ids that are not in the store are
+fetched from BioMart with biomaRt and added to the store, so each id only
+goes over the network once and annotation works offline once the store is
+filled.
+
+example:
+build_store_from_gtf("Mus_musculus.GRCm38.gtf", "mouse")
+annotate_table(in_file, "id", "ensembl_gene_id", "mouse", fetch=False)
+"""
 import os
+import pandas as pd
+from bcbio.utils import file_exists, safe_makedir
+from bcbio.distributed.transaction import file_transaction
+from bipy.utils import append_stem
+from bipy.toolbox.rpool import RJob, RError
+from bipy.toolbox.blastdb import file_lock
 from bipy.log import logger
 
 ORG_TO_ENSEMBL = {"opossum": {"gene_ensembl": "mdomestica_gene_ensembl",
@@ -17,48 +33,261 @@ ORG_TO_ENSEMBL = {"opossum": {"gene_ensembl": "mdomestica_gene_ensembl",
                                   "filter_type": "wormbase_locus",
                                   "gene_symbol": "external_gene_id"}}
 
+DEFAULT_STORE_DIR = os.path.join(os.path.expanduser("~"), ".bipy",
+                                 "annotation")
 
-def annotate_table_with_biomart(in_file, join_column,
-                                filter_type, organism, out_file=None):
+# tables of the store already loaded, keyed by file and modification time
+_store_cache = {}
+
+
+def _check_organism(organism):
+    if organism not in ORG_TO_ENSEMBL:
+        raise ValueError("%s is not a supported organism, the supported "
+                         "organisms are %s." % (organism,
+                                                ", ".join(ORG_TO_ENSEMBL)))
+
+
+def _store_file(organism, id_type, store_dir=None):
+    store_dir = store_dir or DEFAULT_STORE_DIR
+    return os.path.join(store_dir, organism, id_type + ".txt")
+
+
+def _unknown_file(organism, id_type, store_dir=None):
+    store_dir = store_dir or DEFAULT_STORE_DIR
+    return os.path.join(store_dir, organism, id_type + ".unknown")
+
+
+def load_unknown(organism, id_type, store_dir=None):
     """
-    join_column is the column to combine the perform the lookups on
-    filter_type describes the type of the join_column (see the getBM
-    documentation in R for details), organism is the english name of
-    the organism
+    returns the set of ids of type id_type BioMart was asked about and
+    has no gene symbol for
+    """
+    unknown_file = _unknown_file(organism, id_type, store_dir)
+    if not file_exists(unknown_file):
+        return set()
+    with open(unknown_file) as in_handle:
+        return set(line.strip() for line in in_handle if line.strip())
 
-    example:
-    annotate_table_with_biomart(in_file, "id", "ensembl_gene_id",
-                                "human")
 
+def _add_unknown(ids, organism, id_type, store_dir=None):
+    unknown_file = _unknown_file(organism, id_type, store_dir)
+    with file_lock(unknown_file + ".lock"):
+        unknown = load_unknown(organism, id_type, store_dir) | set(ids)
+        with file_transaction(unknown_file) as tmp_unknown_file:
+            with open(tmp_unknown_file, "w") as out_handle:
+                for x in sorted(unknown):
+                    out_handle.write(x + "\n")
+    return unknown_file
+
+
+def load_store(organism, id_type, store_dir=None):
+    """
+    returns the annotation of organism indexed by id_type, an empty
+    dataframe if there is none stored
     """
+    _check_organism(organism)
+    store_file = _store_file(organism, id_type, store_dir)
+    if not file_exists(store_file):
+        return pd.DataFrame(index=pd.Index([], name=id_type))
+    key = (store_file, os.path.getmtime(store_file))
+    if key not in _store_cache:
+        _store_cache[key] = _read_store(store_file)
+    return _store_cache[key]
 
-    if organism not in ORG_TO_ENSEMBL:
-        logger.error("organism not supported")
-        exit(1)
 
-    logger.info("Annotating %s." % (organism))
-    if not out_file:
-        out_file = append_stem(in_file, "annotated")
-    if os.path.exists(out_file):
-        return out_file
-    # use biomaRt to annotate the data file
-    r = robjects.r
-    r.assign('join_column', join_column)
-    r.assign('in_file', in_file)
-    r.assign('out_file', out_file)
+def _read_store(store_file):
+    return pd.read_csv(store_file, sep="\t", index_col=0, dtype=str)
+
+
+def add_to_store(table, organism, id_type, store_dir=None):
+    """
+    adds a dataframe of annotation indexed by id_type to the store. the
+    new annotation replaces the stored annotation of the same ids. the
+    table is locked while it is updated, so jobs adding to the same table
+    at once don't drop each other's rows
+    """
+    _check_organism(organism)
+    table = table.copy()
+    table.index = table.index.astype(str)
+    table.index.name = id_type
+    store_file = _store_file(organism, id_type, store_dir)
+    safe_makedir(os.path.dirname(store_file))
+    with file_lock(store_file + ".lock"):
+        # read past the cache, another job may have just written the table
+        if file_exists(store_file):
+            stored = _read_store(store_file)
+        else:
+            stored = pd.DataFrame(index=pd.Index([], name=id_type))
+        combined = pd.concat([stored[~stored.index.isin(table.index)],
+                              table], sort=False)
+        with file_transaction(store_file) as tmp_store_file:
+            combined.to_csv(tmp_store_file, sep="\t")
+    return store_file
+
+
+def import_biomart_dump(dump_file, organism, id_type, store_dir=None):
+    """
+    adds a tab delimited BioMart export with a header to the store. the
+    id_type column, for example ensembl_gene_id, is used as the index
+    """
+    table = pd.read_csv(dump_file, sep="\t", header=0, dtype=str)
+    if id_type not in table.columns:
+        raise ValueError("%s does not have a %s column." % (dump_file,
+                                                            id_type))
+    table = table.drop_duplicates(subset=[id_type]).set_index(id_type)
+    return add_to_store(table, organism, id_type, store_dir)
+
+
+def _gtf_attribute(attributes, name):
+    return attributes.str.extract('%s "([^"]*)"' % (name), expand=False)
+
+
+def build_store_from_gtf(gtf_file, organism, store_dir=None):
+    """
+    adds the gene names and biotypes in the attributes of gtf_file to the
+    store, indexed both by ensembl_gene_id and by gene symbol. the biotype
+    is taken from the source column for GTF files without a gene_biotype
+    attribute
+    """
+    _check_organism(organism)
+    symbol = ORG_TO_ENSEMBL[organism]["gene_symbol"]
+    gtf = pd.read_csv(gtf_file, sep="\t", header=None, comment="#",
+                      usecols=[1, 8], names=["source", "attributes"],
+                      dtype=str)
+    genes = pd.DataFrame({"ensembl_gene_id":
+                          _gtf_attribute(gtf["attributes"], "gene_id"),
+                          symbol: _gtf_attribute(gtf["attributes"],
+                                                 "gene_name"),
+                          "gene_biotype":
+                          _gtf_attribute(gtf["attributes"], "gene_biotype")},
+                         columns=["ensembl_gene_id", symbol, "gene_biotype"])
+    genes["gene_biotype"] = genes["gene_biotype"].fillna(gtf["source"])
+    genes = genes.dropna(subset=["ensembl_gene_id"])
+    genes = genes.drop_duplicates(subset=["ensembl_gene_id"])
+    add_to_store(genes.set_index("ensembl_gene_id"), organism,
+                 "ensembl_gene_id", store_dir)
+    by_symbol = genes.dropna(subset=[symbol])
+    by_symbol = by_symbol.drop_duplicates(subset=[symbol])
+    add_to_store(by_symbol.set_index(symbol), organism, symbol, store_dir)
+    return _store_file(organism, "ensembl_gene_id", store_dir)
+
+
+def fetch_from_biomart(ids, filter_type, organism, store_dir=None,
+                       pool=None):
+    """
+    looks up ids of type filter_type with biomaRt and adds them to the
+    store. ids BioMart has no gene symbol for are stored without one and
+    remembered so they are not looked up again
+    """
+    _check_organism(organism)
+    store_file = _store_file(organism, filter_type, store_dir)
+    safe_makedir(os.path.dirname(store_file))
+    # annotation jobs for different tables can fetch at the same time
+    ids_file = "%s.%d.query" % (store_file, os.getpid())
+    fetched_file = "%s.%d.fetched" % (store_file, os.getpid())
+    pd.Series(list(ids)).to_csv(ids_file, index=False, header=False)
+    r = RJob(["biomaRt"])
+    r.assign('ids_file', ids_file)
+    r.assign('fetched_file', fetched_file)
     r.assign('ensembl_gene', ORG_TO_ENSEMBL[organism]["gene_ensembl"])
     r.assign('gene_symbol', ORG_TO_ENSEMBL[organism]["gene_symbol"])
     r.assign('filter_type', filter_type)
     r('''
-    library(biomaRt)
     ensembl = useMart("ensembl", dataset = ensembl_gene)
-    d = read.table(in_file, header=TRUE)
+    ids = readLines(ids_file)
     a = getBM(attributes=c(filter_type,
                 gene_symbol, "description"),
-                filters=c(filter_type), values=d[,join_column],
+                filters=c(filter_type), values=ids,
                 mart=ensembl)
-    m = merge(d, a, by.x=join_column, by.y=filter_type)
-    write.table(m, out_file, quote=FALSE, row.names=FALSE, sep="\t")
+    write.table(a, fetched_file, quote=FALSE, row.names=FALSE, sep="\t")
     ''')
+    try:
+        r.run(pool)
+    finally:
+        os.remove(ids_file)
+    fetched = pd.read_csv(fetched_file, sep="\t", header=0, dtype=str)
+    os.remove(fetched_file)
+    fetched = fetched.drop_duplicates(subset=[filter_type])
+    fetched = fetched.set_index(filter_type)
+    fetched = fetched.reindex(pd.Index(list(ids), name=filter_type))
+    symbol = ORG_TO_ENSEMBL[organism]["gene_symbol"]
+    if symbol in fetched.columns:
+        unknown = fetched.index[fetched[symbol].isnull()]
+    else:
+        unknown = fetched.index
+    if len(unknown):
+        _add_unknown(unknown, organism, filter_type, store_dir)
+    return add_to_store(fetched, organism, filter_type, store_dir)
 
+
+def _annotated_ids(store, organism):
+    """
+    the ids of the store with a gene symbol. ids stored without one, from
+    a GTF file without gene_name attributes for example, count as missing
+    """
+    symbol = ORG_TO_ENSEMBL[organism]["gene_symbol"]
+    if symbol not in store.columns:
+        return set(store.index)
+    return set(store.index[store[symbol].notnull()])
+
+
+def annotate_table(in_file, join_column, filter_type, organism,
+                   out_file=None, store_dir=None, fetch=True, pool=None):
+    """
+    join_column is the column to perform the lookups on, filter_type
+    describes the type of the join_column, for example ensembl_gene_id,
+    and organism is the english name of the organism. ids missing from the
+    store are fetched from BioMart unless fetch is False. every row of
+    in_file is kept, rows without annotation have empty annotation columns
+
+    example:
+    annotate_table(in_file, "id", "ensembl_gene_id", "human")
+    """
+    _check_organism(organism)
+    if not out_file:
+        out_file = append_stem(in_file, "annotated")
+    if file_exists(out_file):
+        return out_file
+
+    logger.info("Annotating %s with %s annotation." % (in_file, organism))
+    table = pd.read_csv(in_file, sep="\t", header=0,
+                        dtype={join_column: str})
+    store = load_store(organism, filter_type, store_dir)
+    missing = (set(table[join_column].dropna()) -
+               _annotated_ids(store, organism) -
+               load_unknown(organism, filter_type, store_dir))
+    if missing and fetch:
+        logger.info("Fetching %d ids missing from the %s annotation from "
+                    "BioMart." % (len(missing), organism))
+        try:
+            fetch_from_biomart(missing, filter_type, organism, store_dir,
+                               pool)
+            store = load_store(organism, filter_type, store_dir)
+        except RError:
+            logger.warning("Could not fetch the missing ids from BioMart, "
+                           "they will not be annotated.")
+    annotated = table.merge(store, how="left", left_on=join_column,
+                            right_index=True)
+    with file_transaction(out_file) as tmp_out_file:
+        annotated.to_csv(tmp_out_file, sep="\t", index=False)
     return out_file
+
+
+def annotate_table_with_biomart(in_file, join_column,
+                                filter_type, organism, out_file=None,
+                                pool=None, store_dir=None):
+    """
+    join_column is the column to combine the perform the lookups on
+    filter_type describes the type of the join_column (see the getBM
+    documentation in R for details), organism is the english name of
+    the organism. BioMart is only queried for ids that are not in the
+    local annotation store yet
+
+    example:
+    annotate_table_with_biomart(in_file, "id", "ensembl_gene_id",
+                                "human")
+
+    """
+    return annotate_table(in_file, join_column, filter_type, organism,
+                          out_file=out_file, store_dir=store_dir,
+                          fetch=True, pool=pool)
@@ -1,12 +1,50 @@
-import subprocess
-from bipy.utils import (replace_suffix, which, flatten,
-                         remove_suffix)
+"""
+bedtools style operations on BED, GTF and BAM files. the intervals are
+compared in process with bipy.toolbox.intervals instead of running the
+bedtools programs, and the output has the same format as theirs.
+
+example:
+intersect(["a.bed", "b.bed"], ["-u"])
+multi_intersect(["a.bed", "b.bed", "c.bed"], ["-header", "-cluster"])
+"""
 import os
-import logging
+from itertools import islice
+from multiprocessing import Pool
+import numpy as np
+import pysam
+from bipy.utils import replace_suffix, remove_suffix
+from bipy.toolbox.intervals import Intervals, concatenate, multi_intersect \
+    as _multi_intersect
 from bcbio.utils import file_exists
-import sh
+from bcbio.distributed.transaction import file_transaction
+from bipy.log import logger
+
+# reads compared to the features at a time
+READ_CHUNKSIZE = 1000000
+# features closer than this are counted from one fetch of the reads
+BATCH_GAP = 10000
+# past this fraction of the genome in batches one pass over all the reads
+# is faster than fetching them
+GENOME_WIDE_FRACTION = 0.25
+
 
-logger = logging.getLogger(__name__)
+def _read_chunks(samfile, chunksize=READ_CHUNKSIZE):
+    """
+    yields lists of up to chunksize reads, the index of the mapped reads in
+    the list and the alignment spans of the mapped reads as Intervals
+    """
+    references = np.array(samfile.references, dtype=object)
+    reads = samfile.fetch(until_eof=True)
+    while True:
+        chunk = list(islice(reads, chunksize))
+        if not chunk:
+            return
+        mapped = [i for i, read in enumerate(chunk) if not read.is_unmapped]
+        spans = Intervals(
+            references[[chunk[i].reference_id for i in mapped]],
+            [chunk[i].reference_start for i in mapped],
+            [chunk[i].reference_end for i in mapped], fields=[])
+        yield chunk, np.array(mapped, dtype=np.int64), spans
 
 
 def intersectbam2bed(bam_file, bed_file, exclude=False, out_file=None):
@@ -29,25 +67,115 @@ def intersectbam2bed(bam_file, bed_file, exclude=False, out_file=None):
     if file_exists(out_file):
         return out_file
 
-    if exclude:
-        exclude_arg = "-v"
-    else:
-        exclude_arg = "-u"
+    features = Intervals.from_file(bed_file)
+    with pysam.AlignmentFile(bam_file, "rb") as in_bam:
+        with file_transaction(out_file) as tx_out_file:
+            with pysam.AlignmentFile(tx_out_file, "wb",
+                                     template=in_bam) as out_bam:
+                for chunk, mapped, spans in _read_chunks(in_bam):
+                    # unmapped reads overlap nothing
+                    keep = np.zeros(len(chunk), dtype=bool)
+                    keep[mapped] = spans.overlaps_any(features)
+                    for i in np.flatnonzero(keep != exclude):
+                        out_bam.write(chunk[i])
+
+    return out_file
 
-    sh.bedtools.intersect(exclude_arg, "-abam", bam_file, b=bed_file,
-                          _out=out_file)
 
+def _write_coverage(features, counts, covered, out_file):
+    """
+    writes each feature followed by the number of reads overlapping it, the
+    number of its bases covered, its length and the fraction covered like
+    coverageBed
+    """
+    lengths = features.ends - features.starts
+    fractions = covered / np.maximum(lengths, 1).astype(np.float64)
+    with file_transaction(out_file) as tx_out_file:
+        with open(tx_out_file, "w") as out_handle:
+            for i, fields in enumerate(features.fields):
+                out_handle.write("%s\t%d\t%d\t%d\t%0.7f\n" % (
+                    "\t".join(fields), counts[i], covered[i], lengths[i],
+                    fractions[i]))
     return out_file
 
 
-def count_overlaps(in_file, bed, out_file=None):
-    """ calculates coverage across the features in the bedfile
-    bed """
+def _stream_coverage(in_file, features):
+    """
+    the number of reads overlapping each feature and the number of its
+    bases covered by them, from one pass over all of the reads
+    """
+    counts = np.zeros(len(features), dtype=np.int64)
+    # the union of the reads so far, to count the covered bases
+    reads = Intervals([], [], [])
+    with pysam.AlignmentFile(in_file, "rb") as samfile:
+        for _, _, spans in _read_chunks(samfile):
+            counts += features.count_overlaps(spans)
+            reads = concatenate([reads, spans.union()]).union()
+    return counts, features.bases_covered(reads)
+
+
+def _chrom_coverage(args):
+    """
+    counts the reads of the features on one chromosome, fetching the reads
+    of each batch of features from the index
+    """
+    in_file, chrom, starts, ends, batch_starts, batch_ends = args
+    counts = np.zeros(len(starts), dtype=np.int64)
+    covered = np.zeros(len(starts), dtype=np.int64)
+    # features are sorted by start, so each batch is a slice of them
+    bounds = np.searchsorted(starts, np.append(batch_starts, batch_ends[-1]))
+    with pysam.AlignmentFile(in_file, "rb") as samfile:
+        for i, (start, end) in enumerate(zip(batch_starts, batch_ends)):
+            reads = [read for read in samfile.fetch(chrom, start, end)
+                     if not read.is_unmapped]
+            if not reads:
+                continue
+            spans = Intervals([chrom] * len(reads),
+                              [read.reference_start for read in reads],
+                              [read.reference_end for read in reads],
+                              fields=[])
+            batch = slice(bounds[i], bounds[i + 1])
+            features = Intervals([chrom] * (bounds[i + 1] - bounds[i]),
+                                 starts[batch], ends[batch], fields=[])
+            counts[batch] = features.count_overlaps(spans)
+            covered[batch] = features.bases_covered(spans)
+    return counts, covered
+
+
+def _indexed_coverage(in_file, features, batches, cores=1):
+    """
+    the number of reads overlapping each feature and the number of its
+    bases covered by them, fetching only the reads of each batch of
+    features from the BAM index. chromosomes are counted in parallel
+    """
+    counts = np.zeros(len(features), dtype=np.int64)
+    covered = np.zeros(len(features), dtype=np.int64)
+    by_chrom = features.by_chrom()
+    # the chromosomes with the most features first, to balance the workers
+    chroms = sorted(batches, key=lambda x: -len(by_chrom[x]))
+    jobs = [(in_file, chrom, features.starts[by_chrom[chrom]],
+             features.ends[by_chrom[chrom]]) + batches[chrom]
+            for chrom in chroms]
+    if cores > 1 and len(jobs) > 1:
+        pool = Pool(min(cores, len(jobs)))
+        try:
+            results = pool.map(_chrom_coverage, jobs, chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        results = map(_chrom_coverage, jobs)
+    for chrom, (chrom_counts, chrom_covered) in zip(chroms, results):
+        counts[by_chrom[chrom]] = chrom_counts
+        covered[by_chrom[chrom]] = chrom_covered
+    return counts, covered
 
-    if not which("coverageBed"):
-        logger.error("Cannot find coverageBed. Make sure it is in your "
-                     "path or install bedtools.")
-        exit(-1)
+
+def count_overlaps(in_file, bed, out_file=None, cores=1):
+    """ calculates coverage across the features in the bedfile
+    bed. the reads of the features are fetched from the index of a
+    sorted in_file, unless the features cover so much of the genome that
+    reading all of the reads is faster """
 
     if not out_file:
         out_file = replace_suffix(in_file, ".counts")
@@ -55,11 +183,61 @@ def count_overlaps(in_file, bed, out_file=None):
     if os.path.exists(out_file):
         return out_file
 
-    cmd = ["coverageBed", "-abam", in_file, "-b", bed]
+    features = Intervals.from_file(bed)
+    with pysam.AlignmentFile(in_file, "rb") as samfile:
+        indexed = samfile.has_index()
+        lengths = dict(zip(samfile.references, samfile.lengths))
+    batches = dict((chrom, batch) for chrom, batch in
+                   features.batches(BATCH_GAP).items() if chrom in lengths)
+    batched = sum(np.sum(ends - starts) for starts, ends in batches.values())
+    genome_wide = batched > GENOME_WIDE_FRACTION * sum(lengths.values())
+    if indexed and not genome_wide:
+        counts, covered = _indexed_coverage(in_file, features, batches, cores)
+    else:
+        counts, covered = _stream_coverage(in_file, features)
+    return _write_coverage(features, counts, covered, out_file)
+
 
-    with open(out_file, "w") as out_handle:
-        subprocess.check_call(cmd, stdout=out_handle)
-    return out_file
+def _parse_multi_intersect_options(options, n_files):
+    header = False
+    cluster = False
+    names = None
+    options = list(options)
+    while options:
+        option = options.pop(0)
+        if option == "-header":
+            header = True
+        elif option == "-cluster":
+            cluster = True
+        elif option == "-names":
+            names = options[:n_files]
+            options = options[n_files:]
+            if len(names) != n_files:
+                raise ValueError("-names needs a name for each of the %d "
+                                 "files." % (n_files))
+        else:
+            raise ValueError("multi_intersect does not support the %s "
+                             "option." % (option))
+    return header, cluster, names
+
+
+def _local_maxima(pieces):
+    """
+    the pieces covered by more files than the pieces next to them, a gap
+    being covered by none
+    """
+    keep = []
+    for i, (chrom, start, end, present) in enumerate(pieces):
+        depth = present.sum()
+        before = after = 0
+        if i > 0 and pieces[i - 1][0] == chrom and pieces[i - 1][2] == start:
+            before = pieces[i - 1][3].sum()
+        if (i + 1 < len(pieces) and pieces[i + 1][0] == chrom and
+                pieces[i + 1][1] == end):
+            after = pieces[i + 1][3].sum()
+        if depth > before and depth > after:
+            keep.append(pieces[i])
+    return keep
 
 
 def multi_intersect(in_files, options=None, out_file=None):
@@ -67,41 +245,83 @@ def multi_intersect(in_files, options=None, out_file=None):
 
     if options is None:
         options = []
+    header, cluster, names = _parse_multi_intersect_options(
+        map(str, options), len(in_files))
+    labels = names or [str(x + 1) for x in range(len(in_files))]
 
-    cmd = ["multiIntersectBed", options, "-i", in_files]
-    cmd = flatten(cmd)
-    cmd = map(str, cmd)
+    out_file = _out_file(in_files, suffix=".intersect.bed",
+                         out_file=out_file)
+    if file_exists(out_file):
+        return out_file
 
-    out_file = _run_command(in_files, cmd, suffix=".intersect.bed",
-                            out_file=out_file)
+    intervals = [Intervals.from_file(x) for x in in_files]
+    pieces = list(_multi_intersect(intervals))
+    if cluster:
+        pieces = _local_maxima(pieces)
+    with file_transaction(out_file) as tx_out_file:
+        with open(tx_out_file, "w") as out_handle:
+            if header:
+                out_handle.write("\t".join(["chrom", "start", "end", "num",
+                                            "list"] +
+                                           (names or in_files)) + "\n")
+            for chrom, start, end, present in pieces:
+                out_handle.write("\t".join(
+                    [chrom, str(start), str(end), str(present.sum()),
+                     ",".join(l for l, p in zip(labels, present) if p)] +
+                    [str(int(p)) for p in present]) + "\n")
     return out_file
 
 
-def _run_command(in_files, cmd, suffix="", out_file=None):
+def _out_file(in_files, suffix="", out_file=None):
     if not out_file:
         out_file = "".join([remove_suffix(os.path.basename(x)) for x in
                             in_files]) + suffix
         out_file = os.path.join(os.path.dirname(in_files[0]), out_file)
-
-    if file_exists(out_file):
-        return out_file
-
-    with open(out_file, "w") as out_handle:
-        subprocess.check_call(cmd, stdout=out_handle)
-
     return out_file
 
 
 def intersect(in_files, options=None, out_file=None):
+    """
+    reports the parts of the features of the first file overlapping the
+    second like intersectBed -a -b. the options -u, -v, -wa and -wb of
+    intersectBed are supported
+    """
     if options is None:
         options = []
     if len(in_files) != 2:
-        logging.error("intersectBed needs two files")
-        exit(1)
-    cmd = ["intersectBed", options, "-a", in_files[0],
-           "-b", in_files[1]]
+        raise ValueError("intersect needs two files, got %d."
+                         % (len(in_files)))
+    unsupported = set(options) - set(["-u", "-v", "-wa", "-wb"])
+    if unsupported:
+        raise ValueError("intersect does not support the %s options."
+                         % (", ".join(sorted(unsupported))))
+
+    out_file = _out_file(in_files, suffix=".intersect.bed",
+                         out_file=out_file)
+    if file_exists(out_file):
+        return out_file
 
-    out_file = _run_command(in_files, cmd, suffix=".intersect.bed",
-                            out_file=out_file)
+    a = Intervals.from_file(in_files[0])
+    b = Intervals.from_file(in_files[1])
+    logger.info("Intersecting %s with %s." % (in_files[0], in_files[1]))
+    with file_transaction(out_file) as tx_out_file:
+        with open(tx_out_file, "w") as out_handle:
+            if "-u" in options or "-v" in options:
+                found = a.overlaps_any(b)
+                if "-v" in options:
+                    found = ~found
+                for i in np.flatnonzero(found):
+                    out_handle.write("\t".join(a.fields[i]) + "\n")
+            else:
+                for i, j in zip(*a.overlap_pairs(b)):
+                    if "-wa" in options:
+                        fields = a.fields[i]
+                    else:
+                        fields = a.with_coordinates(
+                            i, max(a.starts[i], b.starts[j]),
+                            min(a.ends[i], b.ends[j]))
+                    if "-wb" in options:
+                        fields = fields + b.fields[j]
+                    out_handle.write("\t".join(fields) + "\n")
 
     return out_file
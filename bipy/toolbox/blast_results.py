@@ -0,0 +1,146 @@
+"""
+tabular (-outfmt 6) BLAST results in the column order of blastn.run. the
+results are read in chunks of rows into typed columns, filtered with
+vectorized masks and written back out chunk by chunk, so large result
+files never have to fit in memory.
+
+example:
+filter_results("hits.tsv", "hits.filt.tsv", min_coverage=0.5,
+               min_identity=90)
+best_hits("hits.filt.tsv", "hits.best.tsv")
+"""
+import os
+from itertools import compress, islice
+import numpy as np
+import pandas as pd
+from bcbio.distributed.transaction import file_transaction
+
+HEADER_FIELDS = ('qseqid sseqid pident length mismatch gapopen qstart qend '
+                 'sstart send evalue bitscore qlen slen')
+FIELDS = HEADER_FIELDS.split(" ")
+DTYPES = {"qseqid": str, "sseqid": str, "pident": np.float64,
+          "length": np.int64, "mismatch": np.int64, "gapopen": np.int64,
+          "qstart": np.int64, "qend": np.int64, "sstart": np.int64,
+          "send": np.int64, "evalue": np.float64, "bitscore": np.float64,
+          "qlen": np.int64, "slen": np.int64}
+DEFAULT_CHUNKSIZE = 1000000
+
+
+def _has_header(in_file):
+    with open(in_file) as in_handle:
+        return in_handle.readline().startswith(FIELDS[0] + "\t")
+
+
+def read_results(in_file, chunksize=DEFAULT_CHUNKSIZE, usecols=None):
+    """
+    yields the results in in_file as dataframes of up to chunksize rows.
+    in_file can have a header line like the output of blastn.run or not
+    """
+    if not os.path.getsize(in_file):
+        return
+    reader = pd.read_csv(in_file, sep="\t", header=None, names=FIELDS,
+                         skiprows=1 if _has_header(in_file) else 0,
+                         usecols=usecols, dtype=DTYPES, chunksize=chunksize)
+    for chunk in reader:
+        yield chunk
+
+
+def coverage_mask(results, cutoff):
+    """
+    hits where the aligned part of both the query and the subject is more
+    than cutoff, a fraction, of their length
+    """
+    query = (np.abs(results["qstart"].values - results["qend"].values) /
+             results["qlen"].values.astype(np.float64))
+    subject = (np.abs(results["sstart"].values - results["send"].values) /
+               results["slen"].values.astype(np.float64))
+    return (query > cutoff) & (subject > cutoff)
+
+
+def filter_mask(results, min_coverage=None, min_identity=None,
+                max_evalue=None):
+    """
+    hits passing all of the filters that are set. min_coverage is the
+    fraction of both sequences that has to be aligned, min_identity the
+    lowest percent identity and max_evalue the highest e-value
+    """
+    mask = np.ones(len(results), dtype=bool)
+    if min_coverage is not None:
+        mask &= coverage_mask(results, min_coverage)
+    if min_identity is not None:
+        mask &= results["pident"].values >= min_identity
+    if max_evalue is not None:
+        mask &= results["evalue"].values <= max_evalue
+    return mask
+
+
+def write_results(chunks, out_file):
+    """
+    writes the dataframes in chunks to out_file with a header line
+    """
+    with file_transaction(out_file) as tx_out_file:
+        with open(tx_out_file, "w") as out_handle:
+            out_handle.write("\t".join(FIELDS) + "\n")
+            for chunk in chunks:
+                chunk.to_csv(out_handle, sep="\t", header=False, index=False,
+                             columns=FIELDS)
+    return out_file
+
+
+def _lines(in_file):
+    """ the lines of the results in in_file, without the header """
+    with open(in_file) as in_handle:
+        if _has_header(in_file):
+            next(in_handle)
+        for line in in_handle:
+            if line.strip():
+                yield line
+
+
+def filter_results(in_file, out_file, min_coverage=None, min_identity=None,
+                   max_evalue=None, chunksize=DEFAULT_CHUNKSIZE):
+    """
+    writes the hits in in_file passing the filters of filter_mask to
+    out_file. the lines of the hits are copied as they are
+    """
+    lines = _lines(in_file)
+    with file_transaction(out_file) as tx_out_file:
+        with open(tx_out_file, "w") as out_handle:
+            out_handle.write("\t".join(FIELDS) + "\n")
+            for chunk in read_results(in_file, chunksize):
+                mask = filter_mask(chunk, min_coverage, min_identity,
+                                   max_evalue)
+                out_handle.writelines(
+                    compress(islice(lines, len(chunk)), mask))
+    return out_file
+
+
+def best_hits(in_file, out_file, by="bitscore", chunksize=DEFAULT_CHUNKSIZE):
+    """
+    writes the hit with the highest value of by, for example bitscore or
+    pident, of each query to out_file, in the order the queries are first
+    seen. ties go to the first hit
+    """
+    best = None
+    # the queries in the order they are first seen, across the chunks
+    seen = pd.Index([])
+    for chunk in read_results(in_file, chunksize):
+        seen = seen.append(pd.Index(chunk["qseqid"].unique())).unique()
+        if best is not None:
+            chunk = pd.concat([best, chunk], ignore_index=True)
+        # a stable sort keeps the first of tied hits first
+        order = np.argsort(-chunk[by].values, kind="mergesort")
+        best = chunk.iloc[order].drop_duplicates(subset=["qseqid"])
+        order = np.argsort(seen.get_indexer(best["qseqid"]), kind="mergesort")
+        best = best.iloc[order].reset_index(drop=True)
+    return write_results([] if best is None else [best], out_file)
+
+
+def hit_ids(in_file, chunksize=DEFAULT_CHUNKSIZE):
+    """
+    the set of query ids with hits in in_file
+    """
+    ids = set()
+    for chunk in read_results(in_file, chunksize, usecols=["qseqid"]):
+        ids.update(chunk["qseqid"].unique())
+    return ids
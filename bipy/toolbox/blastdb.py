@@ -0,0 +1,176 @@
+"""
+registry of reference files and the BLAST databases built from them.
+downloads and makeblastdb runs happen under a file lock, so when many
+engines blast against the same reference at once only one of them builds
+the database and the others wait for it and reuse it. a manifest written
+next to a finished database records the checksum of the reference it was
+built from and the size of each of its volume files; a database is only
+reused if the manifest matches, so a half built database or one built
+from an older reference is rebuilt.
+
+example:
+ref_file = prepare_reference(ref, config)
+blast_db = prepare_blast_db(ref_file, "nucl")
+"""
+import os
+import fcntl
+import hashlib
+import subprocess
+from contextlib import contextmanager
+import yaml
+from bcbio.utils import safe_makedir
+from bcbio.distributed.transaction import file_transaction
+from bipy.utils import prepare_ref_file
+from bipy.log import logger
+
+# files of each volume of a database, newer versions of makeblastdb write
+# more
+VOLUME_EXTS = {"nucl": ["nhr", "nin", "nsq"],
+               "prot": ["phr", "pin", "psq"]}
+ALIAS_EXTS = {"nucl": "nal", "prot": "pal"}
+
+# manifests of the databases checked by this process
+_registry = {}
+
+
+@contextmanager
+def file_lock(lock_file):
+    """
+    holds an exclusive lock on lock_file, waiting for other processes
+    holding it to finish
+    """
+    safe_makedir(os.path.dirname(os.path.abspath(lock_file)))
+    with open(lock_file, "a") as lock_handle:
+        fcntl.flock(lock_handle, fcntl.LOCK_EX)
+        try:
+            yield lock_file
+        finally:
+            fcntl.flock(lock_handle, fcntl.LOCK_UN)
+
+
+def checksum(in_file, block_size=1 << 20):
+    """ md5 checksum of in_file """
+    md5 = hashlib.md5()
+    with open(in_file, "rb") as in_handle:
+        for block in iter(lambda: in_handle.read(block_size), ""):
+            md5.update(block)
+    return md5.hexdigest()
+
+
+def prepare_reference(ref, config):
+    """
+    the reference file of ref, downloading it from its url: into dir: ref:
+    if it isn't there yet. only one process downloads a reference at a
+    time
+    """
+    url = ref.get("url", None)
+    if not url:
+        return prepare_ref_file(ref, config)
+    lock_file = os.path.join(config["dir"]["ref"],
+                             os.path.basename(url) + ".lock")
+    with file_lock(lock_file):
+        return prepare_ref_file(ref, config)
+
+
+def _manifest_file(base):
+    return base + ".manifest"
+
+
+def volume_files(base, dbtype):
+    """
+    the files making up the database base. databases too big for one
+    volume have an alias file listing their volumes
+    """
+    alias_file = "%s.%s" % (base, ALIAS_EXTS[dbtype])
+    volumes = [base]
+    if os.path.exists(alias_file):
+        with open(alias_file) as in_handle:
+            for line in in_handle:
+                if line.startswith("DBLIST"):
+                    db_dir = os.path.dirname(base)
+                    volumes = [os.path.join(db_dir, x.strip('"'))
+                               for x in line.split()[1:]]
+        return [alias_file] + ["%s.%s" % (volume, ext) for volume in volumes
+                               for ext in VOLUME_EXTS[dbtype]]
+    return ["%s.%s" % (base, ext) for ext in VOLUME_EXTS[dbtype]]
+
+
+def write_manifest(db_file, base, dbtype):
+    """
+    records the checksum of db_file and the size of each file of the
+    database built from it
+    """
+    files = volume_files(base, dbtype)
+    missing = [x for x in files if not os.path.exists(x)]
+    if missing:
+        raise ValueError("The BLAST database %s is missing %s."
+                         % (base, ", ".join(missing)))
+    manifest = {"source": os.path.abspath(db_file),
+                "checksum": checksum(db_file),
+                "source_size": os.path.getsize(db_file),
+                "source_mtime": os.path.getmtime(db_file),
+                "dbtype": dbtype,
+                "files": dict((os.path.basename(x), os.path.getsize(x))
+                              for x in files)}
+    with file_transaction(_manifest_file(base)) as tx_manifest_file:
+        with open(tx_manifest_file, "w") as out_handle:
+            yaml.safe_dump(manifest, out_handle, default_flow_style=False)
+    _registry[base] = manifest
+    return manifest
+
+
+def read_manifest(base):
+    manifest_file = _manifest_file(base)
+    if not os.path.exists(manifest_file):
+        return None
+    with open(manifest_file) as in_handle:
+        return yaml.safe_load(in_handle)
+
+
+def is_complete(db_file, base, dbtype):
+    """
+    True if the database base was completely built from the current
+    contents of db_file. the checksum is only recalculated if the size or
+    modification time of db_file changed
+    """
+    manifest = _registry.get(base) or read_manifest(base)
+    if not manifest or manifest.get("dbtype") != dbtype:
+        return False
+    db_dir = os.path.dirname(base)
+    for name, size in manifest["files"].items():
+        volume_file = os.path.join(db_dir, name)
+        if (not os.path.exists(volume_file) or
+                os.path.getsize(volume_file) != size):
+            return False
+    if (os.path.getsize(db_file) != manifest["source_size"] or
+            os.path.getmtime(db_file) != manifest["source_mtime"]):
+        if checksum(db_file) != manifest["checksum"]:
+            return False
+    _registry[base] = manifest
+    return True
+
+
+def _makeblastdb(db_file, base, dbtype):
+    cl = ["makeblastdb", "-in", db_file, "-out", base, "-dbtype", dbtype]
+    subprocess.check_call(cl)
+
+
+def prepare_blast_db(db_file, dbtype):
+    """
+    returns the BLAST database of db_file, building it with makeblastdb
+    if there isn't a complete one built from the same file already
+    """
+    base, _ = os.path.splitext(db_file)
+    if is_complete(db_file, base, dbtype):
+        return base
+    with file_lock(base + ".lock"):
+        # another process may have built it while this one waited
+        if is_complete(db_file, base, dbtype):
+            return base
+        if os.path.exists(_manifest_file(base)):
+            os.remove(_manifest_file(base))
+        _registry.pop(base, None)
+        logger.info("Building the BLAST database of %s." % (db_file))
+        _makeblastdb(db_file, base, dbtype)
+        write_manifest(db_file, base, dbtype)
+    return base
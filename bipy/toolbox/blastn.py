@@ -2,24 +2,19 @@
 import bcbio.utils as utils
 from bipy.utils import (replace_suffix, append_stem, build_results_dir)
 import os
+import shutil
 import subprocess
-import csv
+from itertools import islice
+from multiprocessing import Pool
+from bcbio.distributed.transaction import file_transaction
+from bipy.toolbox import blast_results, blastdb
+from bipy.toolbox.blast_results import HEADER_FIELDS, FIELDS
 from bipy.log import logger
 
 
-HEADER_FIELDS = ('qseqid sseqid pident length mismatch gapopen qstart qend '
-                 'sstart send evalue bitscore qlen slen')
-
-
 def get_id_of_hits(outfile):
     """ returns a set of all of the ids that had hits in an outfile """
-    s = set()
-    with open(outfile) as in_handle:
-        reader = csv.reader(in_handle, delimiter="\t")
-        for line in reader:
-            linedict = dict(zip(HEADER_FIELDS.split(" "), line))
-            s.add(linedict["qseqid"])
-    return s
+    return blast_results.hit_ids(outfile)
 
 
 def is_long_enough(linedict, cutoff):
@@ -42,42 +37,19 @@ def filter_results_by_length(filename, cutoff):
     of the query sequence and the subject sequence must both be
     > cutoff of their length. This might be a little too restrictive though
     """
-    def query_match(linedict):
-        length = abs(float(linedict["qstart"]) - float(linedict["qend"]))
-        if length / float(linedict["qlen"]) > (cutoff / float(100)):
-            return True
-        else:
-            return False
-
-    def subject_match(linedict):
-        length = abs(float(linedict["sstart"]) - float(linedict["send"]))
-        if length / float(linedict["slen"]) > (cutoff / float(100)):
-            return True
-        else:
-            return False
-
     out_fname = append_stem(filename, str(cutoff) + "_filt")
     # skip if it already exists
     if os.path.exists(out_fname):
         return out_fname
-
-    with open(filename) as in_handle:
-        reader = csv.reader(in_handle, delimiter="\t")
-        with open(out_fname, "w") as out_handle:
-            writer = csv.writer(out_handle, delimiter="\t")
-            writer.writerow(HEADER_FIELDS.split(" "))
-            for line in reader:
-                linedict = dict(zip(HEADER_FIELDS.split(" "), line))
-                if query_match(linedict) & subject_match(linedict):
-                    writer.writerow(line)
-    return out_fname
+    return blast_results.filter_results(filename, out_fname,
+                                        min_coverage=cutoff / float(100))
 
 
-def run(in_file, ref, blastn_config, config):
+def run(in_file, ref, blastn_config, config, view=None):
     logger.info("Preparing the reference file for %s." % (ref.get("name")))
-    ref_file = prepare_ref_file(ref, config)
+    ref_file = blastdb.prepare_reference(ref, config)
     logger.info("Preparing the blast database for %s." % (ref.get("name")))
-    blast_db = prepare_blast_db(ref_file, "nucl")
+    blast_db = blastdb.prepare_blast_db(ref_file, "nucl")
     logger.info("Blasting %s against %s." % (in_file, ref.get("name")))
 
     results_dir = build_results_dir(blastn_config, config)
@@ -88,69 +60,151 @@ def run(in_file, ref, blastn_config, config):
                                            ref.get("name") + "hits.tsv"))
     tmp_out = out_file + ".tmp"
 
-    blast_results = blast_search(in_file, blast_db, tmp_out)
+    cores = blastn_config.get("cores", 1)
+    hits_file = blast_search(in_file, blast_db, tmp_out, cores=cores,
+                             chunks=blastn_config.get("chunks", None),
+                             threads=blastn_config.get("threads", None),
+                             view=view)
     #logger.info("Filtering results for at least %f percent of the "
     #            "sequences covered." %(0.5*100))
-    #filtered_results = filter_results_by_length(blast_results, 0.5)
+    #filtered_results = filter_results_by_length(hits_file, 0.5)
     #logger.info("Filtered output file here: %s" %(filtered_results))
-    with open(blast_results) as in_handle:
-        reader = csv.reader(in_handle, delimiter="\t")
-        with open(out_file, "w") as out_handle:
-            writer = csv.writer(out_handle, delimiter="\t")
-            writer.writerow(HEADER_FIELDS.split(" "))
-            for line in reader:
-                writer.writerow(line)
+    with open(hits_file) as in_handle:
+        with file_transaction(out_file) as tx_out_file:
+            with open(tx_out_file, "w") as out_handle:
+                out_handle.write("\t".join(FIELDS) + "\n")
+                shutil.copyfileobj(in_handle, out_handle)
 
     return out_file
 
 
-# de-parallelized for now
-def blast_search(in_file, blast_db, out_file):
+def _fasta_sizes(in_file):
+    """ number of residues of each record of a FASTA file, in order """
+    sizes = []
+    with open(in_file) as in_handle:
+        for line in in_handle:
+            if line.startswith(">"):
+                sizes.append(0)
+            elif sizes:
+                sizes[-1] += len(line.strip())
+    return sizes
+
+
+def _fasta_records(in_file):
+    """ yields the lines of each record of a FASTA file """
+    record = []
+    with open(in_file) as in_handle:
+        for line in in_handle:
+            if line.startswith(">") and record:
+                yield record
+                record = []
+            record.append(line)
+    if record:
+        yield record
+
+
+def _chunk_bounds(sizes, chunks):
+    """ splits records with sizes into at most chunks runs of consecutive
+    records with about the same number of residues, putting each record in
+    the chunk its middle falls into. returns the index of the first record
+    of each run """
+    total = float(sum(sizes)) or 1.0
+    bounds = []
+    last = -1
+    seen = 0
+    for i, size in enumerate(sizes):
+        chunk = min(int((seen + size / 2.0) * chunks / total), chunks - 1)
+        if chunk != last:
+            bounds.append(i)
+            last = chunk
+        seen += size
+    return bounds or [0]
+
+
+def split_fasta(in_file, out_dir, chunks):
+    """ splits a FASTA file into chunks files of consecutive records with
+    about the same number of residues each, so the queries stay in order
+    across the chunks. chunk files already there are reused """
+    utils.safe_makedir(out_dir)
+    sizes = _fasta_sizes(in_file)
+    bounds = _chunk_bounds(sizes, max(1, min(chunks, len(sizes))))
+    base = os.path.splitext(os.path.basename(in_file))[0]
+    out_files = [os.path.join(out_dir, "%s.%d_of_%d.fa" % (base, i + 1,
+                                                            len(bounds)))
+                 for i in range(len(bounds))]
+    if all(map(os.path.exists, out_files)):
+        return out_files
+
+    records = _fasta_records(in_file)
+    ends = bounds[1:] + [len(sizes)]
+    for out_file, start, end in zip(out_files, bounds, ends):
+        with file_transaction(out_file) as tx_out_file:
+            with open(tx_out_file, "w") as out_handle:
+                for record in islice(records, end - start):
+                    out_handle.writelines(record)
+    return out_files
+
+
+def _blast_chunk(args):
+    chunk_file, blast_db, threads = args
+    out_file = os.path.splitext(chunk_file)[0] + ".tsv"
+    # written in a transaction, so a chunk without hits is done too
     if not os.path.exists(out_file):
-        _do_blast(in_file, blast_db, out_file)
+        with file_transaction(out_file) as tx_out_file:
+            _do_blast(chunk_file, blast_db, tx_out_file, threads)
     return out_file
 
 
-def prepare_blast_db(db_file, dbtype):
-    exts = {"prot": "pin", "nucl": "nin"}
-    base, _ = os.path.splitext(db_file)
-    if not os.path.exists("%s.%s" % (base, exts[dbtype])):
-        cl = ["makeblastdb", "-in", db_file, "-out", base, "-dbtype", dbtype]
-        subprocess.check_call(cl)
-    return base
+def merge_chunks(chunk_files, out_file):
+    """ concatenates the tabular outputs of the chunks in order """
+    with file_transaction(out_file) as tx_out_file:
+        with open(tx_out_file, "w") as out_handle:
+            for chunk_file in chunk_files:
+                with open(chunk_file) as in_handle:
+                    shutil.copyfileobj(in_handle, out_handle)
+    return out_file
+
+
+def blast_search(in_file, blast_db, out_file, cores=1, chunks=None,
+                 threads=None, view=None):
+    """ blasts in_file against blast_db, split into chunks (by default one
+    per core) of about the same number of residues. the chunks are run on
+    the engines of view, a bipy.cluster view, or in a pool of cores local
+    processes, with threads blastn threads each (by default the cores are
+    shared out between the chunks running at once). finished chunks are
+    kept until the hits are merged, so a restarted search only runs the
+    chunks that are left """
+    if utils.file_exists(out_file):
+        return out_file
+    chunks = chunks or cores
+    chunk_dir = out_file + "_chunks"
+    chunk_files = split_fasta(in_file, chunk_dir, chunks)
+    if view:
+        threads = threads or 1
+    else:
+        processes = min(cores, len(chunk_files))
+        threads = threads or max(1, cores // processes)
+    jobs = [(x, blast_db, threads) for x in chunk_files]
+    logger.info("Blasting %s in %d chunks." % (in_file, len(jobs)))
+    if view:
+        results = view.map(_blast_chunk, jobs)
+    elif processes > 1:
+        pool = Pool(processes)
+        try:
+            results = pool.map(_blast_chunk, jobs)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        results = map(_blast_chunk, jobs)
+    merge_chunks(results, out_file)
+    shutil.rmtree(chunk_dir)
+    return out_file
 
 
-def _do_blast(in_file, blast_db, out_file):
+def _do_blast(in_file, blast_db, out_file, threads=1):
     cl = ["blastn", "-query", in_file, "-outfmt", '6 ' + HEADER_FIELDS, "-out",
           out_file, "-db", blast_db, "-num_alignments", "1",
-          "-num_descriptions", "1", "-evalue", "0.1"]
+          "-num_descriptions", "1", "-evalue", "0.1",
+          "-num_threads", str(threads)]
     subprocess.check_call(cl)
-
-
-def prepare_ref_file(ref, config):
-    """Get a reference file, either by URL or locally.
-    """
-    url = ref.get("url", None)
-    if url:
-        ref_file = _download_ref(url, config["dir"]["ref"])
-    else:
-        ref_file = ref.get("file", None)
-    assert ref_file is not None and os.path.exists(ref_file), ref_file
-    return ref_file
-
-
-def _download_ref(url, ref_dir):
-    dl_file = os.path.basename(url)
-    ref_file = None
-    for supported_ext, extract_cmd in [(".gz", "gunzip")]:
-        if dl_file.endswith(supported_ext):
-            ref_file = os.path.join(ref_dir, dl_file[:-len(supported_ext)])
-            break
-    assert ref_file is not None, url
-    if not os.path.exists(ref_file):
-        with utils.chdir(ref_dir):
-            cl = ["wget", url]
-            subprocess.check_call(cl)
-            cl = [extract_cmd, dl_file]
-            subprocess.check_call(cl)
-    return ref_file
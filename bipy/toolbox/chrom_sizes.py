@@ -0,0 +1,154 @@
+"""
+chromosome sizes for the coverage tools, taken from the @SQ lines of a BAM
+header, a samtools .fai index or the reference FASTA file instead of
+downloading them from UCSC. the sizes are cached per genome in the
+reference directory so they are only worked out once. a cache that does
+not match the header of the BAM file being converted is not used.
+
+example:
+chrom_size_file = get_chrom_sizes(config, "sample.bam")
+"""
+import os
+import hashlib
+from bcbio.utils import file_exists, safe_makedir
+from bcbio.distributed.transaction import file_transaction
+import pysam
+from bipy.log import logger
+
+
+def from_bam(bam_file):
+    """
+    (chrom, size) of each reference in the header of a SAM or BAM file
+    """
+    mode = "rb" if bam_file.endswith(".bam") else "r"
+    samfile = pysam.AlignmentFile(bam_file, mode)
+    sizes = zip(samfile.references, samfile.lengths)
+    samfile.close()
+    return sizes
+
+
+def from_fai(fai_file):
+    """
+    (chrom, size) of each sequence in a samtools .fai index
+    """
+    with open(fai_file) as in_handle:
+        fields = [line.split("\t") for line in in_handle if line.strip()]
+    return [(x[0], int(x[1])) for x in fields]
+
+
+def from_fasta(fasta_file):
+    """
+    (chrom, size) of each sequence in a FASTA file, read from its .fai
+    index if there is one next to it
+    """
+    if file_exists(fasta_file + ".fai"):
+        return from_fai(fasta_file + ".fai")
+    sizes = []
+    with open(fasta_file) as in_handle:
+        for line in in_handle:
+            if line.startswith(">"):
+                sizes.append([line[1:].split()[0], 0])
+            elif sizes:
+                sizes[-1][1] += len(line.rstrip())
+    return [tuple(x) for x in sizes]
+
+
+def write_chrom_sizes(sizes, out_file):
+    with file_transaction(out_file) as tx_out_file:
+        with open(tx_out_file, "w") as out_handle:
+            for chrom, size in sizes:
+                out_handle.write("%s\t%d\n" % (chrom, size))
+    return out_file
+
+
+def _reference_fasta(config):
+    """
+    the reference FASTA file of the configuration, either ref: fasta: or a
+    ref: prefix with a .fa file next to it
+    """
+    ref = config.get("ref", None)
+    if isinstance(ref, dict):
+        return ref.get("fasta", None)
+    if ref and file_exists(ref + ".fa"):
+        return ref + ".fa"
+    return None
+
+
+def _cache_file(config):
+    annotation = config.get("annotation", {})
+    genome = annotation.get("name", None) or annotation.get("genome", None)
+    ref_dir = config.get("dir", {}).get("ref", None)
+    if not genome or not ref_dir:
+        return None
+    safe_makedir(ref_dir)
+    return os.path.join(ref_dir, genome + ".sizes")
+
+
+def _sizes_file(config, source, sizes):
+    """
+    a chromosome size file for sizes outside of the genome cache, in dir:
+    ref: or dir: results: and named after source and the sizes themselves
+    """
+    dirs = config.get("dir", {})
+    out_dir = dirs.get("ref", None) or dirs.get("results", None)
+    if out_dir:
+        safe_makedir(out_dir)
+    else:
+        out_dir = os.path.dirname(source)
+    digest = hashlib.md5(repr(list(sizes))).hexdigest()[:12]
+    return os.path.join(out_dir, "%s.%s.sizes" % (os.path.basename(source),
+                                                  digest))
+
+
+def _matches(cached, sizes):
+    """
+    True if every chromosome of sizes is in cached with the same size
+    """
+    cached = dict(cached)
+    return all(cached.get(chrom, None) == size for chrom, size in sizes)
+
+
+def get_chrom_sizes(config, in_file=None):
+    """
+    returns a chromosome size file for the genome of the configuration.
+    an annotation: chrom_size_file: in the configuration is used as is.
+    otherwise the sizes are cached in dir: ref: as the annotation: name:
+    of the genome and taken from the header of in_file, a SAM or BAM file,
+    or from the reference FASTA file. without a genome name or reference
+    directory, or if the cached sizes do not match the header of in_file,
+    the sizes are written to a file of their own in dir: ref: or dir:
+    results: instead
+    """
+    chrom_size_file = config.get("annotation", {}).get("chrom_size_file",
+                                                       None)
+    if chrom_size_file:
+        return chrom_size_file
+    cache_file = _cache_file(config)
+
+    if in_file and os.path.splitext(in_file)[1] in [".bam", ".sam"]:
+        sizes = from_bam(in_file)
+        source = in_file
+        if cache_file and file_exists(cache_file):
+            if _matches(from_fai(cache_file), sizes):
+                return cache_file
+            logger.warning("The chromosome sizes in %s do not match the "
+                           "header of %s, using the header instead."
+                           % (cache_file, in_file))
+            cache_file = None
+    elif cache_file and file_exists(cache_file):
+        return cache_file
+    else:
+        source = _reference_fasta(config)
+        if not source or not file_exists(source):
+            raise ValueError("Could not find the chromosome sizes: set "
+                             "annotation: chrom_size_file: or ref: in the "
+                             "configuration, or pass a BAM file.")
+        sizes = from_fasta(source)
+
+    if not cache_file:
+        cache_file = _sizes_file(config, source, sizes)
+        if file_exists(cache_file):
+            return cache_file
+    logger.info("Writing the chromosome sizes from %s to %s."
+                % (source, cache_file))
+    return write_chrom_sizes(sizes, cache_file)
@@ -1,21 +1,28 @@
 """
-wrapper to run DESeq analyses. at the moment it will only run with a simple
-two-condition comparison. more complicated experimental setups could be
-added by creating a dataframe of the conditions and passing it in
+wrapper to run DESeq analyses. run handles a simple two-condition
+comparison, run_contrasts runs many pairwise comparisons of a multi-condition
+experiment off of a single fit. the size factors, dispersion moments,
+transformations and MvA data are also calculated in python for QC without
+starting R
 """
 import os
-import rpy2.robjects as robjects
-import rpy2.robjects.vectors as vectors
+import hashlib
+from itertools import combinations
+import numpy as np
 import pandas as pd
 from bcbio.utils import safe_makedir, file_exists
+from bcbio.distributed.transaction import file_transaction
+from bipy.toolbox.rpool import RJob, shared_pool
 from bipy.toolbox.reporting import LatexReport, panda_to_latex
 from mako.template import Template
 
+# top genes of the DESeq tables already read, see top_by
+_top_cache = {}
 
 
 def load_count_file(in_file, r):
     """
-    returns an r session with a read count file loaded as 'counts'
+    returns an r session or RJob with a read count file loaded as 'counts'
     """
     r.assign('in_file', in_file)
     r('''
@@ -26,42 +33,36 @@ def load_count_file(in_file, r):
 
 def make_count_set(conds, r):
     """
-    returns an r session with a new count data set loaded as cds
+    returns an r session or RJob with a new count data set loaded as cds.
+    DESeq has to be loaded already
     """
-    r.assign('conds', vectors.StrVector.factor(vectors.StrVector(conds)))
+    r.assign('conds', list(conds))
     r('''
-    require('DESeq')
+    conds = factor(conds)
     cds = newCountDataSet(counts, conds)
     ''')
     return r
 
 
-def run(in_file, conds, out_prefix):
+def run(in_file, conds, out_prefix, pool=None, size_factors=None):
+    """
+    runs a DESeq analysis of in_file as a job on an R worker pool,
+    by default the shared one. size_factors, one per sample, are used
+    instead of estimating them in R if they are given
+    """
     deseq_table_out = out_prefix + ".deseq.txt"
     dispersion_plot_out = out_prefix + ".dispersions.pdf"
     mva_plot_out = out_prefix + ".MvA.pdf"
 
     safe_makedir(os.path.dirname(out_prefix))
 
-    r = robjects.r
+    r = RJob(["DESeq"])
     r.assign('deseq_table_out', deseq_table_out)
     r.assign('mva_plot_out', mva_plot_out)
 
     r = load_count_file(in_file, r)
     r = make_count_set(conds, r)
-    r('''
-    cds = estimateSizeFactors(cds)
-    ''')
-
-    # if there are no replicates, use the replicate cheating mode
-    if len(set(conds)) == len(conds):
-        r('''
-        cds = estimateDispersions(cds, method="blind", sharingMode="fit-only")
-        ''')
-    else:
-        r('''
-        cds = estimateDispersions(cds)
-        ''')
+    r = _fit(conds, r, size_factors)
 
     _plot_disp_ests(r, dispersion_plot_out)
 
@@ -76,9 +77,290 @@ def run(in_file, conds, out_prefix):
         _plot_MvA(r, mva_plot_out)
     r('''write.table(res, file=deseq_table_out, quote=FALSE,
     row.names=FALSE, sep="\t")''')
+    r.run(pool)
     return deseq_table_out
 
 
+def _fit(conds, r, size_factors=None):
+    """
+    estimate the size factors and dispersions of cds
+    """
+    if size_factors is None:
+        r('''
+        cds = estimateSizeFactors(cds)
+        ''')
+    else:
+        r.assign("size_factors", [float(x) for x in size_factors])
+        r('''
+        sizeFactors(cds) = size_factors
+        ''')
+
+    # if there are no replicates, use the replicate cheating mode
+    if len(set(conds)) == len(conds):
+        r('''
+        cds = estimateDispersions(cds, method="blind", sharingMode="fit-only")
+        ''')
+    else:
+        r('''
+        cds = estimateDispersions(cds)
+        ''')
+    return r
+
+
+def _load_design(design):
+    """
+    a design is a dataframe indexed by sample with a condition column, a
+    dictionary of sample to condition or a tab delimited file with the
+    samples in the first column and a condition column
+    """
+    if isinstance(design, dict):
+        return pd.DataFrame({"condition": pd.Series(design)})
+    if isinstance(design, basestring):
+        return pd.read_csv(design, sep="\t", index_col=0, header=0)
+    return design
+
+
+def contrast_name(contrast):
+    return "%s_vs_%s" % tuple(contrast)
+
+
+def _fit_file(in_file, samples, conds, size_factors, out_dir):
+    """
+    the file the fit of in_file is saved in. its name is a checksum of the
+    count file, its modification time and size, the design and the size
+    factors, so a fit is only reused for the same inputs
+    """
+    if size_factors is not None:
+        size_factors = [float(x) for x in size_factors]
+    key = [os.path.abspath(in_file), os.path.getmtime(in_file),
+           os.path.getsize(in_file), list(samples), conds, size_factors]
+    digest = hashlib.md5(repr(key)).hexdigest()[:12]
+    return os.path.join(out_dir, "fit.%s.rds" % (digest))
+
+
+def run_contrasts(in_file, design, out_dir, contrasts=None, pool=None,
+                  size_factors=None):
+    """
+    runs DESeq on every contrast, a pair of conditions, of the samples in
+    in_file. all pairwise contrasts are run if contrasts is not given. size
+    factors and dispersions are estimated once over all of the samples and
+    saved, keyed on the inputs; the tests for each contrast then run as
+    separate jobs on an R worker pool, by default the shared one.
+
+    each contrast gets out_dir/cond1_vs_cond2/cond1_vs_cond2.deseq.txt and
+    an MvA plot so DeseqParser can read it. returns a dictionary of contrast
+    to result table and the combined long format table with a contrast
+    column
+
+    example:
+    run_contrasts("counts.txt", {"s1": "a", "s2": "a", "s3": "b",
+                                 "s4": "b", "s5": "c", "s6": "c"},
+                  "results/deseq")
+    """
+    samples = pd.read_csv(in_file, sep="\t", index_col=0, nrows=0).columns
+    design = _load_design(design)
+    conds = design["condition"].reindex(samples)
+    if conds.isnull().any():
+        raise ValueError("%s are missing from the design."
+                         % (", ".join(conds.index[conds.isnull()])))
+    conds = [str(x) for x in conds]
+    if contrasts is None:
+        contrasts = list(combinations(sorted(set(conds)), 2))
+    safe_makedir(out_dir)
+
+    out_files = {}
+    for contrast in contrasts:
+        name = contrast_name(contrast)
+        out_files[tuple(contrast)] = os.path.join(out_dir, name,
+                                                  name + ".deseq.txt")
+    combined_file = os.path.join(out_dir, "all_contrasts.deseq.txt")
+    if all(map(file_exists, out_files.values() + [combined_file])):
+        return out_files, combined_file
+
+    fit_file = _fit_file(in_file, samples, conds, size_factors, out_dir)
+    if not file_exists(fit_file):
+        r = RJob(["DESeq"])
+        r = load_count_file(in_file, r)
+        r = make_count_set(conds, r)
+        r = _fit(conds, r, size_factors)
+        _plot_disp_ests(r, os.path.join(out_dir, "all.dispersions.pdf"))
+        r.assign("fit_file", fit_file)
+        r('''saveRDS(cds, file=fit_file)''')
+        r.run(pool)
+
+    jobs = []
+    for contrast, out_file in out_files.items():
+        if file_exists(out_file):
+            continue
+        safe_makedir(os.path.dirname(out_file))
+        r = RJob(["DESeq"])
+        r.assign("fit_file", fit_file)
+        r.assign("cond1", str(contrast[0]))
+        r.assign("cond2", str(contrast[1]))
+        r.assign("deseq_table_out", out_file)
+        r('''
+        cds = readRDS(fit_file)
+        res = nbinomTest(cds, cond1, cond2)
+        write.table(res, file=deseq_table_out, quote=FALSE,
+        row.names=FALSE, sep="\t")
+        ''')
+        _plot_MvA(r, out_file.replace(".deseq.txt", ".MvA.pdf"))
+        jobs.append(r)
+    if pool is None:
+        pool = shared_pool()
+    pool.map(jobs)
+
+    tables = []
+    for contrast in contrasts:
+        table = pd.read_csv(out_files[tuple(contrast)], sep="\t", header=0)
+        table.insert(0, "contrast", contrast_name(contrast))
+        tables.append(table)
+    with file_transaction(combined_file) as tmp_combined_file:
+        pd.concat(tables).to_csv(tmp_combined_file, sep="\t", index=False)
+    return out_files, combined_file
+
+
+def estimate_size_factors(counts):
+    """
+    DESeq median of ratios size factors of a dataframe of counts (genes x
+    samples). genes with a zero count in any sample are left out of the
+    geometric means, as in DESeq
+    """
+    values = counts.values.astype(np.float64)
+    values = values[(values > 0).all(axis=1)]
+    if not len(values):
+        raise ValueError("Every gene has a zero count in at least one "
+                         "sample, the size factors can't be estimated.")
+    log_values = np.log(values)
+    log_ratios = log_values - log_values.mean(axis=1)[:, np.newaxis]
+    return pd.Series(np.exp(np.median(log_ratios, axis=0)),
+                     index=counts.columns)
+
+
+def normalized_counts(counts, factors=None):
+    """
+    counts divided by the size factor of each sample
+    """
+    if factors is None:
+        factors = estimate_size_factors(counts)
+    values = counts.values / np.asarray(factors, dtype=np.float64)
+    return pd.DataFrame(values, index=counts.index, columns=counts.columns)
+
+
+def log_transform(counts, factors=None, pseudocount=1):
+    """
+    log2 of the normalized counts plus pseudocount
+    """
+    normalized = normalized_counts(counts, factors)
+    return np.log2(normalized + pseudocount)
+
+
+def dispersion_moments(counts, factors=None):
+    """
+    per gene mean and variance of the normalized counts and the method of
+    moments estimate of the dispersion, as DESeq calculates them before
+    fitting. returns a dataframe with baseMean, baseVar and dispersion
+    columns
+    """
+    if factors is None:
+        factors = estimate_size_factors(counts)
+    normalized = normalized_counts(counts, factors).values
+    means = normalized.mean(axis=1)
+    variances = normalized.var(axis=1, ddof=1)
+    xim = np.mean(1 / np.asarray(factors, dtype=np.float64))
+    with np.errstate(divide="ignore", invalid="ignore"):
+        dispersions = (variances - xim * means) / means ** 2
+    return pd.DataFrame({"baseMean": means, "baseVar": variances,
+                         "dispersion": dispersions},
+                        index=counts.index,
+                        columns=["baseMean", "baseVar", "dispersion"])
+
+
+def fit_dispersions(moments, max_iterations=10):
+    """
+    fits DESeq's parametric dispersion trend, dispersion = asymptDisp +
+    extraPois / mean, to the output of dispersion_moments with a gamma
+    family GLM, dropping outlying genes between iterations. returns
+    (asymptDisp, extraPois)
+    """
+    usable = ((moments["baseMean"] > 0) &
+              np.isfinite(moments["dispersion"]) &
+              (moments["dispersion"] > 0))
+    means = moments["baseMean"].values[usable.values]
+    disps = moments["dispersion"].values[usable.values]
+    design = np.column_stack([np.ones(len(means)), 1 / means])
+    coefs = np.array([0.1, 1.0])
+    for _ in range(max_iterations):
+        residuals = disps / design.dot(coefs)
+        good = (residuals > 1e-4) & (residuals < 15)
+        new_coefs = _gamma_identity_fit(design[good], disps[good], coefs)
+        if (new_coefs <= 0).any():
+            raise ValueError("The parametric dispersion fit failed.")
+        converged = np.sum(np.log(new_coefs / coefs) ** 2) < 1e-6
+        coefs = new_coefs
+        if converged:
+            break
+    return coefs[0], coefs[1]
+
+
+def _gamma_identity_fit(design, y, coefs, max_iterations=25):
+    """
+    iteratively reweighted least squares for a gamma GLM with an identity
+    link, started from coefs
+    """
+    for _ in range(max_iterations):
+        fitted = design.dot(coefs)
+        weights = 1 / fitted ** 2
+        weighted = design * weights[:, np.newaxis]
+        new_coefs = np.linalg.solve(design.T.dot(weighted), weighted.T.dot(y))
+        if np.allclose(new_coefs, coefs, rtol=1e-8):
+            return new_coefs
+        coefs = new_coefs
+    return coefs
+
+
+def variance_stabilize(counts, factors=None, fit=None):
+    """
+    DESeq's variance stabilizing transformation for the parametric
+    dispersion fit. fit is (asymptDisp, extraPois) from fit_dispersions and
+    is calculated if it isn't given. the values are on a log2 scale
+    """
+    if factors is None:
+        factors = estimate_size_factors(counts)
+    if fit is None:
+        fit = fit_dispersions(dispersion_moments(counts, factors))
+    asympt_disp, extra_pois = fit
+    q = normalized_counts(counts, factors).values
+    values = np.log((1 + extra_pois + 2 * asympt_disp * q +
+                     2 * np.sqrt(asympt_disp * q *
+                                 (1 + extra_pois + asympt_disp * q))) /
+                    (4 * asympt_disp)) / np.log(2)
+    return pd.DataFrame(values, index=counts.index, columns=counts.columns)
+
+
+def mva_data(counts, conds, cond1, cond2, factors=None):
+    """
+    the mean expression and fold changes between cond1 and cond2 of the
+    normalized counts, with the same columns as the nbinomTest results
+    minus the tests. conds has the condition of each sample
+    """
+    conds = np.asarray(conds)
+    normalized = normalized_counts(counts, factors).values
+    base_mean_a = normalized[:, conds == cond1].mean(axis=1)
+    base_mean_b = normalized[:, conds == cond2].mean(axis=1)
+    in_contrast = (conds == cond1) | (conds == cond2)
+    base_mean = normalized[:, in_contrast].mean(axis=1)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        fold_change = base_mean_b / base_mean_a
+        log2_fold_change = np.log2(fold_change)
+    return pd.DataFrame({"id": counts.index, "baseMean": base_mean,
+                         "baseMeanA": base_mean_a, "baseMeanB": base_mean_b,
+                         "foldChange": fold_change,
+                         "log2FoldChange": log2_fold_change},
+                        columns=["id", "baseMean", "baseMeanA", "baseMeanB",
+                                 "foldChange", "log2FoldChange"])
+
+
 def _plot_disp_ests(r, dispersion_plot_out):
     """
     make a plot of the dispersion estimation
@@ -114,6 +396,45 @@ def _plot_MvA(r, mva_plot_out):
     return r
 
 
+def _rank_key(table, by):
+    """
+    smaller is better; genes without a value go last
+    """
+    key = table[by].astype(np.float64)
+    if by == "log2FoldChange":
+        key = -key.abs()
+    return key.fillna(np.inf).values
+
+
+def top_by(in_file, cols, by="padj", k=25, chunksize=50000):
+    """
+    returns the k best genes in a DESeq table ranked by padj, or by the
+    size of the fold change. the table is read in chunks of only the
+    needed columns, keeping the best k seen so far, and the result is
+    cached until the file changes
+    """
+    key = (os.path.abspath(in_file), os.path.getmtime(in_file),
+           tuple(cols), by, k)
+    if key in _top_cache:
+        return _top_cache[key].copy()
+
+    best = None
+    for chunk in pd.read_csv(in_file, sep="\t", header=0, usecols=cols,
+                             chunksize=chunksize):
+        chunk = chunk[cols]
+        if best is None:
+            # an empty frame of the first chunk keeps the column dtypes
+            best = chunk.iloc[:0]
+        candidates = pd.concat([best, chunk], ignore_index=True)
+        order = np.argsort(_rank_key(candidates, by), kind="mergesort")
+        best = candidates.iloc[order[:k]]
+    if best is None:
+        best = pd.DataFrame(columns=cols)
+    best = best.reset_index(drop=True)
+    _top_cache[key] = best
+    return best.copy()
+
+
 def run_with_config(in_file, gtf, config):
     pass
 
@@ -164,11 +485,7 @@ class DeseqParser(object):
             cols = ["id", "log2FoldChange", "padj"]
         if by not in cols:
             by = "padj"
-        table = pd.read_table(in_file, header=0)
-        # grab the top genes up to top_max genes
-        sub_table = table[cols].sort(columns=by)[0:self._top_max]
-
-        return sub_table
+        return top_by(in_file, cols, by, self._top_max)
 
 
 class DeseqReport(LatexReport):
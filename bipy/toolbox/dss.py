@@ -1,13 +1,19 @@
 """
 wrapper to perform a two condition DE testing of RNA-seq data using
 the DSS package. requires in_file to be a table of counts and conds to
-be a vector describing which condition each column of counts refers to
+be a vector describing which condition each column of counts refers to.
+run_contrasts runs many contrasts off of one fit, optionally splitting the
+genes into chunks that are tested on separate R workers
 """
-import rpy2.robjects as robjects
-import rpy2.robjects.vectors as vectors
-from bcbio.utils import safe_makedir
+from bcbio.utils import safe_makedir, file_exists
+from bcbio.distributed.transaction import file_transaction
+from bipy.toolbox.rpool import RJob, shared_pool
 import os
+import hashlib
 from collections import OrderedDict
+from itertools import combinations
+import numpy as np
+import pandas as pd
 
 
 def _plot_disp_ests(r, dispersion_plot_out):
@@ -64,21 +70,24 @@ def load_count_file_as_matrix(in_file, r):
 
 def make_count_set(conds, r):
     """
-    returns an r session with a new count data set loaded as cds
+    returns an r session or RJob with a new count data set loaded as cds.
+    DSS has to be loaded already
     """
-    #r.assign('conds', vectors.StrVector.factor(vectors.StrVector(conds)))
-    r.assign('conds', vectors.StrVector(conds))
+    r.assign('conds', list(conds))
     r('''
-    require('DSS')
     cds = newSeqCountSet(count_matrix, conds)
     ''')
     return r
 
 
-def run(in_file, conds, tests, out_prefix):
+def run(in_file, conds, tests, out_prefix, pool=None):
+    """
+    runs a DSS wald test of tests[0] against tests[1] as a job on an R
+    worker pool, by default the shared one
+    """
     dss_table_out = out_prefix + ".dss.txt"
     safe_makedir(os.path.dirname(out_prefix))
-    r = robjects.r
+    r = RJob(["DSS"])
     r.assign('dss_table_out', dss_table_out)
     testA = tests[0]
     testB = tests[1]
@@ -92,6 +101,7 @@ def run(in_file, conds, tests, out_prefix):
     res = waldTest(cds, testA, testB)
     write.table(res, file=dss_table_out, quote=FALSE, row.names=FALSE, sep="\t")
     ''')
+    r.run(pool)
 
     #r('''
     #cds = estNormFactors(cds)
@@ -101,3 +111,154 @@ def run(in_file, conds, tests, out_prefix):
     #''')
 
     return dss_table_out
+
+
+def adjust_pvalues(pvals):
+    """
+    Benjamini-Hochberg adjusted p-values, missing p-values stay missing
+    """
+    pvals = np.asarray(pvals, dtype=np.float64)
+    adjusted = np.empty(len(pvals))
+    adjusted.fill(np.nan)
+    tested = np.flatnonzero(~np.isnan(pvals))
+    n = len(tested)
+    if not n:
+        return adjusted
+    order = tested[np.argsort(pvals[tested])[::-1]]
+    ranks = np.arange(n, 0, -1)
+    adjusted[order] = np.minimum(1, np.minimum.accumulate(
+        pvals[order] * n / ranks))
+    return adjusted
+
+
+def _fit(in_file, conds, fit_file, pool=None):
+    """
+    normalizes and estimates the dispersions over all of the genes and
+    samples once and saves the SeqCountSet to fit_file
+    """
+    r = RJob(["DSS"])
+    r.assign('in_file', in_file)
+    r.assign('fit_file', fit_file)
+    # the gene ids are kept as row names so the chunks can be matched up
+    r('''
+    count_matrix = as.matrix(read.table(in_file, header=TRUE, row.names=1))
+    ''')
+    r = make_count_set(conds, r)
+    r('''
+    cds = estNormFactors(cds)
+    cds = estDispersion(cds)
+    saveRDS(cds, file=fit_file)
+    ''')
+    r.run(pool)
+    return fit_file
+
+
+def _test_chunk(fit_file, contrast, first, last, out_file):
+    """
+    a job testing genes first to last (1-based, inclusive) of the saved fit.
+    the chunk keeps the global normalization factors and dispersions
+    """
+    r = RJob(["DSS"])
+    r.assign('fit_file', fit_file)
+    r.assign('testA', str(contrast[0]))
+    r.assign('testB', str(contrast[1]))
+    r.assign('first', first)
+    r.assign('last', last)
+    r.assign('out_file', out_file)
+    r('''
+    cds = readRDS(fit_file)
+    rows = first:last
+    chunk = newSeqCountSet(exprs(cds)[rows, , drop=FALSE],
+                           pData(cds)$designs)
+    normalizationFactor(chunk) = normalizationFactor(cds)
+    dispersion(chunk) = dispersion(cds)[rows]
+    res = waldTest(chunk, testA, testB)
+    res$geneIndex = res$geneIndex + first - 1
+    res$id = rownames(exprs(cds))[res$geneIndex]
+    write.table(res, file=out_file, quote=FALSE, row.names=FALSE, sep="\t")
+    ''')
+    return r
+
+
+def _merge_chunks(chunk_files, out_file):
+    """
+    combines the test results of the chunks of a contrast, adjusting the
+    p-values over all of the genes. local.fdr needs all of the test
+    statistics at once, so it is dropped if there is more than one chunk
+    """
+    res = pd.concat([pd.read_csv(x, sep="\t", header=0)
+                     for x in chunk_files], ignore_index=True)
+    if len(chunk_files) > 1 and "local.fdr" in res.columns:
+        del res["local.fdr"]
+    res["fdr"] = adjust_pvalues(res["pvals"])
+    res = res.sort_values("pvals", kind="mergesort")
+    with file_transaction(out_file) as tmp_out_file:
+        res.to_csv(tmp_out_file, sep="\t", index=False)
+    return out_file
+
+
+def _fit_key(in_file, conds):
+    """
+    a checksum of the count file, its modification time and size and the
+    conditions, naming the saved fit and the chunks tested with it so they
+    are only reused for the same inputs
+    """
+    key = [os.path.abspath(in_file), os.path.getmtime(in_file),
+           os.path.getsize(in_file), list(conds)]
+    return hashlib.md5(repr(key)).hexdigest()[:12]
+
+
+def run_contrasts(in_file, conds, out_dir, contrasts=None, chunk_size=None,
+                  pool=None):
+    """
+    runs a DSS wald test for each contrast, a pair of conditions in conds,
+    or for all pairs of conditions if contrasts is not given. the
+    normalization and dispersions are estimated once over all of the genes.
+    with chunk_size the genes are tested in chunks of that many genes as
+    separate jobs on an R worker pool, by default the shared one, and the
+    p-values are adjusted after the chunks are merged. the fit and the
+    tested chunks are kept, named after the inputs and the range of genes
+    so a rerun only reuses them for the same inputs. returns a dictionary
+    of contrast to out_dir/testA_vs_testB/testA_vs_testB.dss.txt
+    """
+    if contrasts is None:
+        contrasts = list(combinations(sorted(set(conds)), 2))
+    out_files = OrderedDict()
+    for contrast in contrasts:
+        name = "%s_vs_%s" % tuple(contrast)
+        out_files[tuple(contrast)] = os.path.join(out_dir, name,
+                                                  name + ".dss.txt")
+    todo = [x for x in out_files if not file_exists(out_files[x])]
+    if not todo:
+        return out_files
+
+    safe_makedir(out_dir)
+    if pool is None:
+        pool = shared_pool()
+    fit_key = _fit_key(in_file, conds)
+    fit_file = os.path.join(out_dir, "fit.%s.rds" % (fit_key))
+    if not file_exists(fit_file):
+        _fit(in_file, conds, fit_file, pool)
+
+    n_genes = len(pd.read_csv(in_file, sep="\t", header=0, usecols=[0]))
+    chunk_size = chunk_size or n_genes
+    chunks = [(first, min(first + chunk_size - 1, n_genes))
+              for first in range(1, n_genes + 1, chunk_size)]
+    jobs = []
+    chunk_files = {}
+    for contrast in todo:
+        chunk_dir = safe_makedir(os.path.join(os.path.dirname(
+            out_files[contrast]), "chunks"))
+        chunk_files[contrast] = []
+        for first, last in chunks:
+            chunk_file = os.path.join(chunk_dir, "chunk_%d_%d.%s.dss.txt"
+                                      % (first, last, fit_key))
+            chunk_files[contrast].append(chunk_file)
+            if not file_exists(chunk_file):
+                jobs.append(_test_chunk(fit_file, contrast, first, last,
+                                        chunk_file))
+    pool.map(jobs)
+
+    for contrast in todo:
+        _merge_chunks(chunk_files[contrast], out_files[contrast])
+    return out_files
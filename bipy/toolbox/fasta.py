@@ -1,19 +1,249 @@
 """ tools for handling fasta files """
 from Bio import SeqIO
-from contextlib import nested
+from Bio.Seq import Seq
+from Bio.SeqRecord import SeqRecord
+from collections import namedtuple, OrderedDict
+from itertools import islice
+from multiprocessing import Pool
+import mmap
 import os
+from bcbio.utils import file_exists
+from bcbio.distributed.transaction import file_transaction
 
+# records filtered at a time and the write buffer of filter_seqio
+FILTER_BATCHSIZE = 10000
+WRITE_BUFFER = 16 * 1024 * 1024
 
-def count_seqio(in_file, predicate, kind):
+# the columns of a samtools faidx .fai index
+FaiEntry = namedtuple("FaiEntry", ["name", "length", "offset", "linebases",
+                                   "linewidth"])
+
+
+def build_index(in_file, fai_file=None):
+    """
+    writes a samtools faidx compatible index of in_file to fai_file,
+    in_file.fai by default. every line of a record but the last has to
+    have the same length and no two records can have the same name
+    """
+    fai_file = fai_file or in_file + ".fai"
+    entries = []
+    names = set()
+    offset = 0
+    entry = None
+    with open(in_file, "rb") as in_handle:
+        for line in in_handle:
+            if line.startswith(">"):
+                name = line[1:].split()[0]
+                if name in names:
+                    raise ValueError("%s appears more than once in %s." %
+                                     (name, in_file))
+                names.add(name)
+                entry = {"name": name, "length": 0,
+                         "offset": offset + len(line), "linebases": 0,
+                         "linewidth": 0, "short": False}
+                entries.append(entry)
+            elif entry is not None:
+                bases = len(line.rstrip("\r\n"))
+                if bases and entry["short"]:
+                    raise ValueError("The lines of %s in %s have different "
+                                     "lengths." % (entry["name"], in_file))
+                if not entry["linebases"]:
+                    entry["linebases"] = bases
+                    entry["linewidth"] = len(line)
+                elif (bases < entry["linebases"] or
+                      len(line) != entry["linewidth"]):
+                    entry["short"] = True
+                if bases > entry["linebases"]:
+                    raise ValueError("The lines of %s in %s have different "
+                                     "lengths." % (entry["name"], in_file))
+                entry["length"] += bases
+            offset += len(line)
+    with file_transaction(fai_file) as tx_fai_file:
+        with open(tx_fai_file, "w") as out_handle:
+            for x in entries:
+                out_handle.write("%s\t%d\t%d\t%d\t%d\n" % (
+                    x["name"], x["length"], x["offset"], x["linebases"],
+                    x["linewidth"]))
+    return fai_file
+
+
+def read_index(fai_file):
+    """ the entries of a .fai index by name, in the order of the file """
+    entries = OrderedDict()
+    with open(fai_file) as in_handle:
+        for line in in_handle:
+            if line.strip():
+                fields = line.rstrip("\n").split("\t")
+                if fields[0] in entries:
+                    raise ValueError("%s appears more than once in %s." %
+                                     (fields[0], fai_file))
+                entries[fields[0]] = FaiEntry(fields[0],
+                                              *map(int, fields[1:5]))
+    return entries
+
+
+class IndexedFasta(object):
+    """
+    random access to the records of a FASTA file through its .fai index,
+    which is built if it is missing or older than the file. the file is
+    memory mapped and only the bytes of the sequences asked for are read
+
+    example:
+    with IndexedFasta("genome.fa") as fasta:
+        fasta.fetch("chr1", 999, 2000)
+        fasta.region("chr1:1000-2000")
+    """
+
+    def __init__(self, in_file, fai_file=None):
+        self.in_file = in_file
+        fai_file = fai_file or in_file + ".fai"
+        if (not file_exists(fai_file) or
+                os.path.getmtime(fai_file) < os.path.getmtime(in_file)):
+            build_index(in_file, fai_file)
+        self.index = read_index(fai_file)
+        self._handle = open(in_file, "rb")
+        if os.path.getsize(in_file):
+            self._map = mmap.mmap(self._handle.fileno(), 0,
+                                  access=mmap.ACCESS_READ)
+        else:
+            self._map = ""
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        if isinstance(self._map, mmap.mmap):
+            self._map.close()
+        self._handle.close()
+
+    def __len__(self):
+        return len(self.index)
+
+    def __contains__(self, name):
+        return name in self.index
+
+    def __getitem__(self, name):
+        return self.fetch(name)
+
+    @property
+    def names(self):
+        return list(self.index)
+
+    def _entry(self, name):
+        if name not in self.index:
+            raise KeyError("%s is not in %s." % (name, self.in_file))
+        return self.index[name]
+
+    def _position(self, entry, base):
+        """ the byte offset of the 0-based base of a record """
+        if not entry.linebases:
+            return entry.offset
+        return (entry.offset + base // entry.linebases * entry.linewidth +
+                base % entry.linebases)
+
+    def fetch(self, name, start=0, end=None):
+        """
+        the sequence of name from the 0-based start up to end, the whole
+        sequence by default
+        """
+        entry = self._entry(name)
+        end = entry.length if end is None else min(end, entry.length)
+        start = max(start, 0)
+        if start >= end:
+            return ""
+        chunk = self._map[self._position(entry, start):
+                          self._position(entry, end - 1) + 1]
+        return chunk.replace("\n", "").replace("\r", "")
+
+    def region(self, region):
+        """
+        the sequence of a samtools style region, chrom, chrom:start or
+        chrom:start-end with 1-based inclusive coordinates
+        """
+        name, _, span = region.rpartition(":")
+        if not name or name not in self.index:
+            return self.fetch(region)
+        start, _, end = span.replace(",", "").partition("-")
+        return self.fetch(name, int(start) - 1, int(end) if end else None)
+
+    def description(self, name):
+        """ the header line of name without the > """
+        entry = self._entry(name)
+        header_end = entry.offset - 1
+        # the header is the whole line before the sequence, which can
+        # have a > of its own
+        header_start = self._map.rfind("\n", 0, header_end) + 1
+        return self._map[header_start + 1:header_end].rstrip("\r")
+
+    def record(self, name):
+        """ name as a SeqRecord like the ones of SeqIO.parse """
+        return SeqRecord(Seq(self.fetch(name)), id=name, name=name,
+                         description=self.description(name))
+
+    def records(self, names=None):
+        """ yields the records of names, all records by default """
+        for name in (self.names if names is None else names):
+            yield self.record(name)
+
+    def byte_chunks(self, chunks):
+        """
+        splits the records into up to chunks lists of names, each a
+        contiguous byte range of the file of about the same size. a record
+        goes to the chunk the middle of its sequence falls in
+        """
+        entries = self.index.values()
+        if not entries:
+            return []
+        size = float(max(len(self._map), 1))
+        groups = [[] for _ in range(chunks)]
+        for entry in entries:
+            middle = self._position(entry, entry.length // 2)
+            groups[min(int(middle / size * chunks), chunks - 1)].append(
+                entry.name)
+        return [x for x in groups if x]
+
+
+def _passed_chunk(args):
+    in_file, names, predicate = args
+    with IndexedFasta(in_file) as fasta:
+        return sum(1 for record in fasta.records(names) if predicate(record))
+
+
+def _passed_chunks(in_file, predicate, cores):
+    """
+    the number of records of a FASTA file passing predicate and the total
+    number of records, counted in byte range chunks of the file by a pool
+    of cores processes. predicate has to be picklable, a function defined
+    at the top level of a module for example
+    """
+    with IndexedFasta(in_file) as fasta:
+        total = len(fasta)
+        chunks = fasta.byte_chunks(cores * 4)
+    jobs = [(in_file, names, predicate) for names in chunks]
+    pool = Pool(cores)
+    try:
+        passed = sum(pool.map(_passed_chunk, jobs, chunksize=1))
+    finally:
+        pool.close()
+        pool.join()
+    return (passed, total)
+
+
+def count_seqio(in_file, predicate, kind, cores=1):
     """ counts the records in a file that pass a predicate """
-    with open(in_file) as in_handle:
-        return reduce(lambda x, y: x + 1,
-                      filter(predicate, SeqIO.parse(in_handle, kind)), 0)
+    return passed_seqio(in_file, predicate, kind, cores)[0]
 
 
-def passed_seqio(in_file, predicate, kind):
+def passed_seqio(in_file, predicate, kind, cores=1):
     """ returns the number of records that pass a predicate
-     and the total  number of records as a tuple (passed, total) """
+     and the total  number of records as a tuple (passed, total).
+     with more than one core FASTA files are split into byte ranges which
+     are checked in parallel """
+    if kind == "fasta" and cores > 1:
+        return _passed_chunks(in_file, predicate, cores)
     with open(in_file) as in_handle:
         passed = 0
         total = 0
@@ -30,21 +260,73 @@ def apply_seqio(in_file, f, kind):
         return map(f, SeqIO.parse(in_handle, kind))
 
 
-def filter_fasta(in_file, predicate, out_file):
+def filter_fasta(in_file, predicate, out_file, cores=1):
     """ filters a fasta by a predicate """
-    filter_seqio(in_file, predicate, out_file, kind="fasta")
+    filter_seqio(in_file, predicate, out_file, kind="fasta", cores=cores)
     return out_file
 
 
-def filter_seqio(in_file, predicate, out_file, kind="fasta"):
+def _batches(records, batchsize):
+    """ yields lists of up to batchsize records """
+    records = iter(records)
+    while True:
+        batch = list(islice(records, batchsize))
+        if not batch:
+            return
+        yield batch
+
+
+def _predicate_mask(args):
+    predicate, records = args
+    return [bool(predicate(record)) for record in records]
+
+
+def _passed_batches(records, predicate, cores, batchsize):
+    """
+    yields the records passing predicate in batches, in the order of
+    records. with more than one core the predicate is evaluated by a pool
+    of processes, cores batches at a time so only those are in memory
+    """
+    batches = _batches(records, batchsize)
+    if cores <= 1:
+        for batch in batches:
+            yield [record for record in batch if predicate(record)]
+        return
+    pool = Pool(cores)
+    try:
+        while True:
+            window = list(islice(batches, cores))
+            if not window:
+                break
+            masks = pool.map(_predicate_mask,
+                             [(predicate, batch) for batch in window],
+                             chunksize=1)
+            for batch, mask in zip(window, masks):
+                yield [record for record, passed in zip(batch, mask)
+                       if passed]
+    finally:
+        pool.close()
+        pool.join()
+
+
+def filter_seqio(in_file, predicate, out_file, kind="fasta", cores=1,
+                 batchsize=FILTER_BATCHSIZE):
+    """
+    writes the records of in_file passing predicate to out_file, keeping
+    their order. records are read and written batchsize at a time, so the
+    file never has to fit in memory. with more than one core an expensive
+    predicate is evaluated in parallel; it has to be picklable, a function
+    defined at the top level of a module for example
+    """
     # skip if the output file already exists
     if os.path.exists(out_file):
         return out_file
 
-    with nested(open(in_file, "rU"),
-                open(out_file, "w")) as (in_handle, out_handle):
-        def output_writer(x):
-            return(SeqIO.write(x, out_handle, kind))
-            #map(SeqIO.write(x, out_handle, kind),
-        map(output_writer, filter(predicate, SeqIO.parse(in_handle, kind)))
+    with open(in_file, "rU") as in_handle:
+        with file_transaction(out_file) as tx_out_file:
+            with open(tx_out_file, "w", WRITE_BUFFER) as out_handle:
+                records = SeqIO.parse(in_handle, kind)
+                for passed in _passed_batches(records, predicate, cores,
+                                              batchsize):
+                    SeqIO.write(passed, out_handle, kind)
     return out_file
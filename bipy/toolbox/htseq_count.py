@@ -1,84 +1,732 @@
-""" wrapper for using the htseq-count script """
+"""
+gene level read counting. counts reads in union mode the same way the
+htseq-count script does, but in process using pysam and a vectorized exon
+index built from the GTF file, so coordinate sorted BAM files can be counted
+directly and per chromosome in parallel.
+"""
 import os
-from bipy.utils import replace_suffix, flatten, prepare_ref_file
+import re
+import heapq
+import shutil
+from collections import OrderedDict
+from multiprocessing import Pool
+from multiprocessing.pool import ThreadPool
+import numpy as np
+import pysam
+from bipy.utils import replace_suffix, prepare_ref_file
 from bcbio.utils import file_exists
-import subprocess
 from bcbio.utils import safe_makedir
 import pandas as pd
 from bcbio.log import logger
-import rpy2.robjects as robjects
-import HTSeq
-from bipy import gtf
-from bcbio.provenance import do
 from bcbio.distributed.transaction import file_transaction
 
+# special counters reported at the end of the count file, in htseq-count order
+NO_FEATURE = "__no_feature"
+AMBIGUOUS = "__ambiguous"
+TOO_LOW_AQUAL = "__too_low_aQual"
+NOT_ALIGNED = "__not_aligned"
+NOT_UNIQUE = "__alignment_not_unique"
+SPECIAL_COUNTERS = [NO_FEATURE, AMBIGUOUS, TOO_LOW_AQUAL, NOT_ALIGNED,
+                    NOT_UNIQUE]
+
+# codes for reads which do not land on exactly one gene. like htseq-count,
+# a fragment touching a chromosome missing from the GTF file is no_feature
+_NO_FEATURE_CODE = -1
+_AMBIGUOUS_CODE = -2
+_UNKNOWN_CHROM_CODE = -3
+
+DEFAULT_CHUNK_SIZE = 100000
+DEFAULT_MAX_BUFFER_SIZE = 3000000
+
 
 def _load_htseq_count_file(filename):
     return pd.read_csv(filename, sep="\t", index_col=0, header=None)
 
 
-def _make_length_dict(gtf_file):
-    HTSeq.GFF_Reader(gtf_file)
-    lengths = {}
-    for feature in gtf_file:
-        lengths[feature.name] = 0
+def calculate_rpkm(count_file, gtf_file):
+    """ calculates RPKM for each column in the count_file using the
+    union exon length of each gene in the gtf_file and the sum of the
+    counts in the count_file. see bipy.toolbox.normalize for TPM, CPM and
+    upper quartile normalization """
+    # normalize builds on this module, so import it here to avoid a cycle
+    from bipy.toolbox import normalize
+    counts = normalize.drop_special_counters(load_count_matrix(count_file))
+    return normalize.rpkm(counts, normalize.gene_lengths(gtf_file))
 
 
-def calculate_rpkm(count_file, gtf_file):
-    """ calculates RPKM for each column in the count_file using
-    transcript lengths calculated from the gtf_file and the sum
-    of the counts in the count_file. uses the average length of the
-    transcripts for a gene as the gene length """
-    # calculate the lengths of the genes in gtf_file
-    gtflines = gtf.GTFtoDict(gtf_file)
-    genes = gtf.aggregateFeaturesByGene(gtflines)
-    #genes = gtf.mergeOverlappedExons(genes)
-    lengths = {}
-    for gene, features in genes.items():
-        lengths[gene] = 0
-        transcripts = set()
-        for feature in features:
-            if feature["feature"] == "exon":
-                transcripts.add(feature["transcript_id"])
-                lengths[gene] += abs(int(feature["start"]) -
-                                     int(feature["end"]))
-        lengths[gene] = lengths[gene] / float(len(transcripts))
-
-    counts_df = pd.read_table(count_file, header=0, index_col=0)
-    # if we can't find the length, assume it is the average length of about 1kb
-    length_list = [lengths.get(x, 1000) / 1000.0 for x in counts_df.index]
-    length_normalized = (counts_df.transpose() / length_list).transpose()
-    rpkm = length_normalized.apply(lambda x: x /
-                                   (float(x.sum()) / 1000000))
-    return rpkm
-
-
-def combine_counts(in_files, column_names=None, out_file=None):
+def _load_aligned_counts(in_files, genes, cores=4):
+    """
+    reads htseq-count files in a thread pool, yielding the counts of each
+    file in order lined up with genes. the files can list the genes in any
+    order, but a file missing any of genes or with genes not in genes is
+    an error
+    """
+    def load_aligned(in_file):
+        column = _load_htseq_count_file(in_file)[1]
+        if not column.index.equals(genes):
+            extra = column.index.difference(genes)
+            if len(extra):
+                raise ValueError("%s has genes not in the combined counts, "
+                                 "such as %s." % (in_file, extra[0]))
+            missing = genes.difference(column.index)
+            if len(missing):
+                raise ValueError("%s is missing genes of the combined "
+                                 "counts, such as %s." % (in_file,
+                                                          missing[0]))
+            column = column.reindex(genes)
+        return column.values
+
+    pool = ThreadPool(cores)
+    try:
+        for column in pool.imap(load_aligned, in_files):
+            yield column
+    finally:
+        pool.close()
+        pool.join()
+
+
+def combine_counts(in_files, column_names=None, out_file=None, cores=4,
+                   binary=False):
+    """
+    combines htseq-count files into one table with a column per file. the
+    files are read in a thread pool and aligned on the genes of the first
+    file into a preallocated matrix, so only a few of them are in memory at
+    once. if binary is True the matrix is also saved next to out_file as a
+    CountStore for fast reloading with load_count_matrix
+    """
     if column_names is None:
         column_names = in_files
     if out_file is None:
         out_file = os.path.join(os.path.dirname(in_files[0]),
                                                 "combined.counts")
-    r = robjects.r
-    r.assign('in_files', robjects.StrVector(in_files))
-    r.assign('out_file', out_file)
-    r.assign('col_names', robjects.StrVector(column_names))
-    r('''
-    df = read.table(in_files[1], sep="\t", row.names=1)
-    for (file in in_files[-1]) {
-    df = cbind(df, read.table(file, sep="\t", row.names=1))
-    }
-    colnames(df) = col_names
-    write.table(df, file=out_file, sep="\t", quote=FALSE, row.names=TRUE, col.names=NA)
-    ''')
+    genes = _load_htseq_count_file(in_files[0]).index.rename(None)
+    counts = np.zeros((len(genes), len(in_files)), dtype=np.int32)
+    for i, column in enumerate(_load_aligned_counts(in_files, genes, cores)):
+        counts[:, i] = column
+
+    df = pd.DataFrame(counts, index=genes, columns=column_names)
+    with file_transaction(out_file) as tmp_out_file:
+        df.to_csv(tmp_out_file, sep="\t")
+    if binary:
+        store_dir = _count_store_dir(out_file)
+        if os.path.exists(store_dir):
+            shutil.rmtree(store_dir)
+        CountStore.create(store_dir, genes).append(df)
     return out_file
 
+
+def _count_store_dir(count_file):
+    return count_file + ".store"
+
+
+def load_count_matrix(in_file):
+    """
+    loads a combined count file as a dataframe, using the CountStore
+    written by combine_counts if it is there and up to date
+    """
+    store_dir = _count_store_dir(in_file)
+    if (CountStore.exists(store_dir) and
+            CountStore(store_dir).mtime() >= os.path.getmtime(in_file)):
+        return CountStore(store_dir).read()
+    return pd.read_csv(in_file, sep="\t", index_col=0, header=0)
+
+
+class CountStore(object):
+    """
+    on disk count matrix for experiments with many samples, kept in a
+    directory. samples are added in chunks; each chunk is a samples x genes
+    int32 array in its own .npy file (or a compressed .npz file), so adding
+    samples never rewrites the existing data. uncompressed chunks are
+    memory mapped on reading, so pulling out a few samples or genes only
+    touches those parts of the files. a small manifest lists the genes and
+    which chunk and row each sample is in. appends are not safe to run
+    concurrently on the same store
+
+    example:
+    store = CountStore.create("counts.store", genes)
+    store.add_count_files(["a.counts", "b.counts"], ["a", "b"])
+    store.read(samples=["b"], genes=["gene1", "gene2"])
+    """
+    GENES = "genes.txt"
+    SAMPLES = "samples.txt"
+
+    def __init__(self, store_dir):
+        if not CountStore.exists(store_dir):
+            raise IOError("%s is not a count store." % (store_dir))
+        self._dir = store_dir
+        with open(self._path(self.GENES)) as in_handle:
+            self.genes = pd.Index([x.rstrip("\n") for x in in_handle])
+        self._load_manifest()
+
+    @classmethod
+    def exists(cls, store_dir):
+        return (os.path.exists(os.path.join(store_dir, cls.GENES)) and
+                os.path.exists(os.path.join(store_dir, cls.SAMPLES)))
+
+    @classmethod
+    def create(cls, store_dir, genes):
+        if cls.exists(store_dir):
+            raise ValueError("%s already exists." % (store_dir))
+        safe_makedir(store_dir)
+        with file_transaction(os.path.join(store_dir, cls.GENES)) as tx_file:
+            with open(tx_file, "w") as out_handle:
+                out_handle.writelines("%s\n" % x for x in genes)
+        with file_transaction(os.path.join(store_dir,
+                                           cls.SAMPLES)) as tx_file:
+            open(tx_file, "w").close()
+        return cls(store_dir)
+
+    def _path(self, name):
+        return os.path.join(self._dir, name)
+
+    def _load_manifest(self):
+        self._locations = OrderedDict()
+        with open(self._path(self.SAMPLES)) as in_handle:
+            for line in in_handle:
+                sample, chunk, row = line.rstrip("\n").split("\t")
+                self._locations[sample] = (chunk, int(row))
+
+    @property
+    def samples(self):
+        return list(self._locations.keys())
+
+    def mtime(self):
+        return os.path.getmtime(self._path(self.SAMPLES))
+
+    def append(self, counts, compress=False):
+        """
+        adds the columns of a dataframe of counts as a new chunk. the rows
+        are lined up with the genes of the store, genes missing from counts
+        are counted as 0
+        """
+        self._check_new_samples(counts.columns)
+        missing = counts.index.difference(self.genes)
+        if len(missing):
+            raise ValueError("Counts have genes not in %s, such as %s."
+                             % (self._dir, missing[0]))
+        values = counts.reindex(self.genes).fillna(0).values
+        self._write_chunk(list(counts.columns),
+                          np.ascontiguousarray(values.T, dtype=np.int32),
+                          compress)
+
+    def add_count_files(self, in_files, column_names=None, cores=4,
+                        chunk_size=100, compress=False):
+        """
+        adds htseq-count files to the store chunk_size files at a time,
+        so memory use is bounded by the chunk size, not the number of files
+        """
+        if column_names is None:
+            column_names = in_files
+        self._check_new_samples(column_names)
+        for first in range(0, len(in_files), chunk_size):
+            names = column_names[first:first + chunk_size]
+            chunk = np.zeros((len(names), len(self.genes)), dtype=np.int32)
+            columns = _load_aligned_counts(in_files[first:first + chunk_size],
+                                           self.genes, cores)
+            for i, column in enumerate(columns):
+                chunk[i, :] = column
+            self._write_chunk(names, chunk, compress)
+
+    def _check_new_samples(self, samples):
+        duplicated = [x for x in samples if x in self._locations]
+        if duplicated or len(set(samples)) != len(samples):
+            raise ValueError("%s are already in %s or are repeated."
+                             % (duplicated, self._dir))
+
+    def _write_chunk(self, samples, chunk, compress):
+        n_chunks = len(set(x[0] for x in self._locations.values()))
+        if compress:
+            chunk_name = "chunk_%05d.npz" % (n_chunks)
+        else:
+            chunk_name = "chunk_%05d.npy" % (n_chunks)
+        with file_transaction(self._path(chunk_name)) as tx_file:
+            # np.save and np.savez add an extension to bare file names
+            with open(tx_file, "wb") as out_handle:
+                if compress:
+                    np.savez_compressed(out_handle, counts=chunk)
+                else:
+                    np.save(out_handle, chunk)
+        for row, sample in enumerate(samples):
+            self._locations[sample] = (chunk_name, row)
+        with file_transaction(self._path(self.SAMPLES)) as tx_file:
+            with open(tx_file, "w") as out_handle:
+                for sample, (chunk_file, row) in self._locations.items():
+                    out_handle.write("%s\t%s\t%d\n" % (sample, chunk_file,
+                                                        row))
+
+    def _load_chunk(self, chunk_name):
+        if chunk_name.endswith(".npz"):
+            return np.load(self._path(chunk_name))["counts"]
+        return np.load(self._path(chunk_name), mmap_mode="r")
+
+    def read(self, samples=None, genes=None):
+        """
+        returns a dataframe of the counts of samples for genes, all of them
+        if they are not given. only the chunks holding the samples are read
+        """
+        if samples is None:
+            samples = self.samples
+        if genes is None:
+            rows = slice(None)
+            genes = self.genes
+        else:
+            rows = self.genes.get_indexer(genes)
+            if (rows < 0).any():
+                raise KeyError("%s are not in %s."
+                               % (list(np.asarray(genes)[rows < 0]),
+                                  self._dir))
+        missing = [x for x in samples if x not in self._locations]
+        if missing:
+            raise KeyError("%s are not in %s." % (missing, self._dir))
+        counts = np.zeros((len(genes), len(samples)), dtype=np.int32)
+        by_chunk = OrderedDict()
+        for column, sample in enumerate(samples):
+            chunk_name, row = self._locations[sample]
+            by_chunk.setdefault(chunk_name, []).append((column, row))
+        for chunk_name, positions in by_chunk.items():
+            chunk = self._load_chunk(chunk_name)
+            columns, chunk_rows = zip(*positions)
+            counts[:, list(columns)] = chunk[list(chunk_rows)][:, rows].T
+        return pd.DataFrame(counts, index=genes, columns=samples)
+
+    def to_table(self, out_file, samples=None, genes=None):
+        """ writes the store, or part of it, as a tab delimited table """
+        with file_transaction(out_file) as tx_out_file:
+            self.read(samples, genes).to_csv(tx_out_file, sep="\t")
+        return out_file
+
+
 def _get_outfilename(input_file):
     out_file = replace_suffix(os.path.basename(input_file), "counts")
     return out_file
 
 
-def run(input_file, gtf_file, out_file=None):
+class ExonIndex(object):
+    """
+    step index of the exons in a GTF file. each chromosome is cut into steps
+    at every exon boundary and each step is labelled with the code of the
+    gene covering it, _NO_FEATURE_CODE if no exon covers it or
+    _AMBIGUOUS_CODE if exons of more than one gene cover it. codes index
+    into genes, which is sorted by name. lengths holds the union exon length
+    of each gene.
+    """
+
+    def __init__(self, genes, steps, lengths):
+        self.genes = genes
+        self.lengths = lengths
+        self._steps = steps
+
+    @classmethod
+    def from_gtf(cls, gtf_file, feature_type="exon", id_attribute="gene_id"):
+        id_re = re.compile('%s "([^"]*)"' % (id_attribute))
+        intervals = {}
+        with open(gtf_file) as in_handle:
+            for line in in_handle:
+                if line.startswith("#"):
+                    continue
+                fields = line.split("\t")
+                if len(fields) < 9 or fields[2] != feature_type:
+                    continue
+                match = id_re.search(fields[8])
+                if not match:
+                    raise ValueError("Feature %s does not contain a '%s' "
+                                     "attribute." % (line.strip(),
+                                                     id_attribute))
+                # GTF is 1-based and closed, steps are 0-based and half open
+                intervals.setdefault(fields[0], []).append(
+                    (int(fields[3]) - 1, int(fields[4]), match.group(1)))
+
+        genes = sorted(set(x[2] for chrom_intervals in intervals.values()
+                           for x in chrom_intervals))
+        gene_codes = dict((gene, code) for code, gene in enumerate(genes))
+        steps = {}
+        lengths = np.zeros(len(genes), dtype=np.int64)
+        for chrom, chrom_intervals in intervals.items():
+            starts, ends, names = zip(*chrom_intervals)
+            codes = [gene_codes[x] for x in names]
+            bounds, labels, chrom_lengths = _build_steps(
+                np.array(starts, dtype=np.int64),
+                np.array(ends, dtype=np.int64),
+                np.array(codes, dtype=np.int32), len(genes))
+            steps[chrom] = (bounds, labels)
+            lengths += chrom_lengths
+        return cls(genes, steps, lengths)
+
+    def lookup(self, chrom, starts, ends):
+        """
+        returns the labels of every step overlapped by the blocks
+        [starts, ends) on chrom as a pair of arrays (block index, label)
+        """
+        if chrom not in self._steps:
+            labels = np.empty(len(starts), dtype=np.int32)
+            labels.fill(_UNKNOWN_CHROM_CODE)
+            return (np.arange(len(starts)), labels)
+        bounds, labels = self._steps[chrom]
+        first = np.maximum(np.searchsorted(bounds, starts, side="right") - 1,
+                           0)
+        last = np.searchsorted(bounds, ends, side="left")
+        steps, blocks = _expand_ranges(first, last, np.arange(len(starts)))
+        return (blocks, labels[steps])
+
+
+def _expand_ranges(first, last, values):
+    """
+    expands the ranges [first, last) into one entry per position, returning
+    the positions and the value of the range each position came from
+    """
+    lengths = np.maximum(last - first, 0)
+    offsets = np.repeat(np.cumsum(lengths) - lengths, lengths)
+    positions = (np.arange(lengths.sum()) - offsets +
+                 np.repeat(first, lengths))
+    return (positions, np.repeat(values, lengths))
+
+
+def _build_steps(starts, ends, codes, n_genes):
+    bounds = np.unique(np.concatenate([starts, ends]))
+    steps, genes = _expand_ranges(np.searchsorted(bounds, starts),
+                                  np.searchsorted(bounds, ends), codes)
+    # collapse exons of the same gene covering the same step
+    pairs = np.unique(steps * n_genes + genes)
+    steps, genes = pairs // n_genes, pairs % n_genes
+    labels = np.empty(len(bounds), dtype=np.int32)
+    labels.fill(_NO_FEATURE_CODE)
+    labels[steps] = genes
+    labels[np.bincount(steps, minlength=len(bounds)) > 1] = _AMBIGUOUS_CODE
+    widths = bounds[steps + 1] - bounds[steps]
+    lengths = np.bincount(genes, weights=widths, minlength=n_genes)
+    return (bounds, labels, lengths.astype(np.int64))
+
+
+def _resolve_fragments(fragments, labels, n_fragments):
+    """
+    union mode assignment of fragments from the labels of all of the steps
+    their blocks overlap. returns a gene code, _NO_FEATURE_CODE,
+    _AMBIGUOUS_CODE or _UNKNOWN_CHROM_CODE for each fragment
+    """
+    resolved = np.empty(n_fragments, dtype=np.int32)
+    resolved.fill(_NO_FEATURE_CODE)
+    hit = labels != _NO_FEATURE_CODE
+    fragments, labels = fragments[hit], labels[hit]
+    if not len(fragments):
+        return resolved
+    order = np.argsort(fragments, kind="mergesort")
+    fragments, labels = fragments[order], labels[order]
+    firsts = np.flatnonzero(np.concatenate([[True],
+                                            fragments[1:] != fragments[:-1]]))
+    lowest = np.minimum.reduceat(labels, firsts)
+    highest = np.maximum.reduceat(labels, firsts)
+    resolved[fragments[firsts]] = np.where(
+        (lowest == highest) | (lowest == _UNKNOWN_CHROM_CODE), lowest,
+        _AMBIGUOUS_CODE)
+    return resolved
+
+
+def _combine_codes(codes):
+    """ union of already resolved codes, used to join up mates """
+    if _UNKNOWN_CHROM_CODE in codes:
+        return _UNKNOWN_CHROM_CODE
+    hits = set(codes) - set([_NO_FEATURE_CODE])
+    if not hits:
+        return _NO_FEATURE_CODE
+    if len(hits) > 1:
+        return _AMBIGUOUS_CODE
+    return hits.pop()
+
+
+def _summarize(read):
+    """ the parts of a read needed to decide if it is countable """
+    try:
+        nh = read.get_tag("NH")
+    except KeyError:
+        nh = 1
+    return (read.is_unmapped, nh, read.mapping_quality)
+
+
+def _fragment_status(summaries, min_aqual):
+    """
+    returns the special counter a fragment falls into, or None if it
+    should be assigned to a gene. checks are in the order htseq-count uses
+    """
+    aligned = [x for x in summaries if not x[0]]
+    if not aligned:
+        return NOT_ALIGNED
+    if any(nh > 1 for _, nh, _ in aligned):
+        return NOT_UNIQUE
+    if any(mapq < min_aqual for _, _, mapq in aligned):
+        return TOO_LOW_AQUAL
+    return None
+
+
+def _read_key(read):
+    return (read.query_name, read.is_read1, read.reference_id,
+            read.reference_start)
+
+
+def _mate_key(read):
+    return (read.query_name, not read.is_read1, read.next_reference_id,
+            read.next_reference_start)
+
+
+def _position(tid, pos):
+    # unplaced reads are at the end of a coordinate sorted file
+    if tid < 0:
+        return (float("inf"), pos)
+    return (tid, pos)
+
+
+class _FragmentCounter(object):
+    """
+    collects the aligned blocks of fragments into chunks and assigns each
+    chunk to genes in bulk with the exon index. orphans are reads whose
+    mate is being counted somewhere else; their assignment is kept along
+    with the read summary so the pair can be joined up later
+    """
+
+    def __init__(self, index, references, min_aqual=0,
+                 chunk_size=DEFAULT_CHUNK_SIZE):
+        self.index = index
+        self.references = references
+        self.min_aqual = min_aqual
+        self.chunk_size = chunk_size
+        self.gene_counts = np.zeros(len(index.genes), dtype=np.int64)
+        self.special = dict((x, 0) for x in SPECIAL_COUNTERS)
+        self.orphans = []
+        self._reset()
+
+    def _reset(self):
+        self._tids = []
+        self._starts = []
+        self._ends = []
+        self._fragments = []
+        self._chunk_orphans = []
+        self._n_fragments = 0
+
+    def add(self, reads, orphan=False):
+        summaries = [_summarize(x) for x in reads]
+        if not orphan:
+            status = _fragment_status(summaries, self.min_aqual)
+            if status:
+                self.special[status] += 1
+                return
+        fragment = self._n_fragments
+        self._n_fragments += 1
+        for read in reads:
+            if read.is_unmapped:
+                continue
+            for start, end in read.get_blocks():
+                self._tids.append(read.reference_id)
+                self._starts.append(start)
+                self._ends.append(end)
+                self._fragments.append(fragment)
+        if orphan:
+            read = reads[0]
+            self._chunk_orphans.append((fragment, _read_key(read),
+                                        _mate_key(read), summaries[0]))
+        if self._n_fragments >= self.chunk_size:
+            self.flush()
+
+    def flush(self):
+        if not self._n_fragments:
+            return
+        tids = np.array(self._tids, dtype=np.int32)
+        starts = np.array(self._starts, dtype=np.int64)
+        ends = np.array(self._ends, dtype=np.int64)
+        fragments = np.array(self._fragments, dtype=np.int64)
+        hit_fragments = [np.zeros(0, dtype=np.int64)]
+        hit_labels = [np.zeros(0, dtype=np.int32)]
+        for tid in np.unique(tids):
+            selected = np.flatnonzero(tids == tid)
+            blocks, labels = self.index.lookup(self.references[tid],
+                                               starts[selected],
+                                               ends[selected])
+            hit_fragments.append(fragments[selected][blocks])
+            hit_labels.append(labels)
+        resolved = _resolve_fragments(np.concatenate(hit_fragments),
+                                      np.concatenate(hit_labels),
+                                      self._n_fragments)
+        counted = np.ones(self._n_fragments, dtype=bool)
+        for fragment, key, mate_key, summary in self._chunk_orphans:
+            self.orphans.append((key, mate_key, summary,
+                                 int(resolved[fragment])))
+            counted[fragment] = False
+        resolved = resolved[counted]
+        self.gene_counts += np.bincount(resolved[resolved >= 0],
+                                        minlength=len(self.gene_counts))
+        no_feature = ((resolved == _NO_FEATURE_CODE) |
+                      (resolved == _UNKNOWN_CHROM_CODE))
+        self.special[NO_FEATURE] += int(no_feature.sum())
+        self.special[AMBIGUOUS] += int((resolved == _AMBIGUOUS_CODE).sum())
+        self._reset()
+
+
+def _feed_reads(reads, counter, max_buffer_size, coordinate_sorted,
+                split_by_chrom=False):
+    """
+    pairs up mates through a bounded buffer and hands each fragment to the
+    counter. on coordinate sorted input a read is counted on its own as soon
+    as the position of its mate has been passed without seeing it. if
+    split_by_chrom is set, reads with a mate on another chromosome are
+    handed over as orphans
+    """
+    waiting = OrderedDict()
+    pending = []
+    for read in reads:
+        if not read.is_paired:
+            counter.add([read])
+            continue
+        if split_by_chrom and read.next_reference_id != read.reference_id:
+            counter.add([read], orphan=True)
+            continue
+        mate = waiting.pop(_read_key(read), None)
+        if mate is not None:
+            counter.add([mate, read])
+            continue
+        mate_key = _mate_key(read)
+        waiting[mate_key] = read
+        if coordinate_sorted:
+            heapq.heappush(pending, (_position(read.next_reference_id,
+                                               read.next_reference_start),
+                                     mate_key))
+            here = _position(read.reference_id, read.reference_start)
+            while pending and pending[0][0] < here:
+                _, stale_key = heapq.heappop(pending)
+                stale = waiting.pop(stale_key, None)
+                if stale is not None:
+                    counter.add([stale])
+        if len(waiting) > max_buffer_size:
+            _, stale = waiting.popitem(last=False)
+            logger.warning("Mate buffer is full, counting %s without its "
+                           "mate." % (stale.query_name))
+            counter.add([stale])
+    for read in waiting.values():
+        counter.add([read])
+    counter.flush()
+    return counter
+
+
+def _pair_orphans(orphans, min_aqual):
+    """
+    joins up reads counted apart from their mates, returns a list of
+    (special counter or None, resolved code) for each fragment
+    """
+    fragments = []
+    unpaired = {}
+    for orphan in orphans:
+        key, mate_key, _, _ = orphan
+        mate = unpaired.pop(mate_key, None)
+        if mate is None:
+            unpaired[key] = orphan
+        else:
+            fragments.append([mate, orphan])
+    fragments.extend([x] for x in unpaired.values())
+    resolved = []
+    for fragment in fragments:
+        summaries = [x[2] for x in fragment]
+        resolved.append((_fragment_status(summaries, min_aqual),
+                         _combine_codes([x[3] for x in fragment])))
+    return resolved
+
+
+def _is_coordinate_sorted(samfile):
+    header = samfile.header
+    return header.get("HD", {}).get("SO", None) == "coordinate"
+
+
+def _is_bam(in_file):
+    (_, ext) = os.path.splitext(in_file)
+    return ext == ".bam"
+
+
+def _open_samfile(in_file):
+    if _is_bam(in_file):
+        return pysam.AlignmentFile(in_file, "rb")
+    return pysam.AlignmentFile(in_file, "r")
+
+
+# per process state for the per chromosome counting jobs
+_worker_state = {}
+
+
+def _init_count_worker(index, options):
+    _worker_state["index"] = index
+    _worker_state["options"] = options
+
+
+def _count_region(job):
+    in_file, region = job
+    index = _worker_state["index"]
+    options = _worker_state["options"]
+    samfile = pysam.AlignmentFile(in_file, "rb")
+    counter = _FragmentCounter(index, samfile.references,
+                               options["min_aqual"], options["chunk_size"])
+    _feed_reads(samfile.fetch(region), counter, options["max_buffer_size"],
+                True, split_by_chrom=True)
+    samfile.close()
+    return (counter.gene_counts, counter.special, counter.orphans)
+
+
+def count_reads(in_file, index, cores=1, min_aqual=0,
+                max_buffer_size=DEFAULT_MAX_BUFFER_SIZE,
+                chunk_size=DEFAULT_CHUNK_SIZE):
+    """
+    counts the reads in a SAM or BAM file overlapping the genes of an
+    ExonIndex in htseq-count union mode, ignoring strand. paired reads are
+    counted once per pair and can be in any order. an indexed BAM file can
+    be counted per chromosome on multiple cores. returns a series of counts
+    indexed by gene followed by the special counters
+    """
+    samfile = _open_samfile(in_file)
+    indexed = _is_bam(in_file) and file_exists(in_file + ".bai")
+    if cores > 1 and indexed:
+        regions = list(samfile.references) + ["*"]
+        samfile.close()
+        options = {"min_aqual": min_aqual, "chunk_size": chunk_size,
+                   "max_buffer_size": max_buffer_size}
+        pool = Pool(cores, _init_count_worker, (index, options))
+        try:
+            results = pool.map(_count_region,
+                               [(in_file, x) for x in regions])
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        if cores > 1:
+            logger.info("%s is not an indexed BAM file, counting it in a "
+                        "single pass." % (in_file))
+        counter = _FragmentCounter(index, samfile.references, min_aqual,
+                                   chunk_size)
+        _feed_reads(samfile, counter, max_buffer_size,
+                    _is_coordinate_sorted(samfile))
+        samfile.close()
+        results = [(counter.gene_counts, counter.special, counter.orphans)]
+
+    gene_counts = sum(x[0] for x in results)
+    special = dict((x, sum(y[1][x] for y in results))
+                   for x in SPECIAL_COUNTERS)
+    orphans = [orphan for x in results for orphan in x[2]]
+    for status, code in _pair_orphans(orphans, min_aqual):
+        if status:
+            special[status] += 1
+        elif code in (_NO_FEATURE_CODE, _UNKNOWN_CHROM_CODE):
+            special[NO_FEATURE] += 1
+        elif code == _AMBIGUOUS_CODE:
+            special[AMBIGUOUS] += 1
+        else:
+            gene_counts[code] += 1
+    return pd.Series(list(gene_counts) + [special[x] for x in
+                                          SPECIAL_COUNTERS],
+                     index=index.genes + SPECIAL_COUNTERS)
+
+
+def write_counts(counts, out_file):
+    """ writes a series of counts in the htseq-count format """
+    with open(out_file, "w") as out_handle:
+        for name, count in counts.iteritems():
+            out_handle.write("%s\t%d\n" % (name, count))
+    return out_file
+
+
+def run(input_file, gtf_file, out_file=None, cores=1, min_aqual=0):
     if out_file is None:
         out_file = _get_outfilename(input_file)
 
@@ -87,12 +735,11 @@ def run(input_file, gtf_file, out_file=None):
     if file_exists(out_file):
         return out_file
 
+    logger.info("Counting reads in %s against %s." % (input_file, gtf_file))
+    index = ExonIndex.from_gtf(gtf_file)
+    counts = count_reads(input_file, index, cores, min_aqual)
     with file_transaction(out_file) as tmp_out_file:
-        htseq_cmd = ("htseq-count --mode=union --stranded=no --type=exon "
-                     "--idattr=gene_id {input_file} {gtf_file} > {tmp_out_file}")
-
-        cmd = htseq_cmd.format(**locals())
-        do.run(cmd, "Running htseq-count on %s." % (input_file), None)
+        write_counts(counts, tmp_out_file)
 
     return out_file
 
@@ -109,5 +756,6 @@ def run_with_config(input_file, config, stage, out_file=None):
                      "configuration files.")
         exit(1)
     ref = prepare_ref_file(config["annotation"], config)
-    out_file = run(input_file, ref, out_file)
+    cores = config["stage"].get(stage, {}).get("cores", 1)
+    out_file = run(input_file, ref, out_file, cores)
     return out_file
@@ -0,0 +1,300 @@
+"""
+interval operations on BED files, done in process on sorted start and end
+arrays of each chromosome instead of running bedtools. intervals are
+0-based and half open like BED; two intervals overlap if they share at
+least one base.
+
+example:
+a = Intervals.from_file("a.bed")
+b = Intervals.from_file("b.bed")
+a.subset(a.overlaps_any(b))
+"""
+import os
+import numpy as np
+
+GFF_EXTS = [".gtf", ".gff", ".gff3"]
+
+
+class Intervals(object):
+    """
+    intervals with the fields of the BED or GTF lines they came from, in
+    the order of the file. starts and ends are 0-based and half open for
+    both
+    """
+
+    def __init__(self, chroms, starts, ends, fields=None, gff=False):
+        self.chroms = np.asarray(chroms, dtype=object)
+        self.starts = np.asarray(starts, dtype=np.int64)
+        self.ends = np.asarray(ends, dtype=np.int64)
+        if fields is None:
+            fields = [[c, str(s), str(e)] for c, s, e in
+                      zip(self.chroms, self.starts, self.ends)]
+        self.fields = fields
+        self.gff = gff
+        self._by_chrom = None
+
+    def __len__(self):
+        return len(self.starts)
+
+    @classmethod
+    def from_file(cls, in_file):
+        """
+        reads a BED file, or a GTF or GFF file if in_file has one of their
+        extensions
+        """
+        gff = os.path.splitext(in_file)[1].lower() in GFF_EXTS
+        fields = []
+        with open(in_file) as in_handle:
+            for line in in_handle:
+                # headers of BED files and of Picard interval lists
+                if line.startswith(("#", "track", "browser", "@")):
+                    continue
+                line = line.rstrip("\r\n")
+                if line:
+                    fields.append(line.split("\t"))
+        if gff:
+            return cls([x[0] for x in fields],
+                       [int(x[3]) - 1 for x in fields],
+                       [int(x[4]) for x in fields], fields, gff=True)
+        return cls([x[0] for x in fields], [int(x[1]) for x in fields],
+                   [int(x[2]) for x in fields], fields)
+
+    def subset(self, mask):
+        index = np.flatnonzero(mask)
+        return Intervals(self.chroms[index], self.starts[index],
+                         self.ends[index], [self.fields[i] for i in index],
+                         self.gff)
+
+    def with_coordinates(self, i, start, end):
+        """
+        the fields of interval i with its coordinates set to start and end
+        """
+        fields = list(self.fields[i])
+        if self.gff:
+            fields[3:5] = [str(start + 1), str(end)]
+        else:
+            fields[1:3] = [str(start), str(end)]
+        return fields
+
+    def by_chrom(self):
+        """
+        a dictionary of chromosome to the index of its intervals sorted by
+        start and end
+        """
+        if self._by_chrom is None:
+            order = np.lexsort((self.ends, self.starts, self.chroms))
+            chroms = self.chroms[order]
+            self._by_chrom = {}
+            if len(order):
+                new = np.concatenate([[True], chroms[1:] != chroms[:-1]])
+                bounds = list(np.flatnonzero(new)) + [len(order)]
+                for start, end in zip(bounds[:-1], bounds[1:]):
+                    self._by_chrom[chroms[start]] = order[start:end]
+        return self._by_chrom
+
+    def overlaps_any(self, other):
+        """
+        True for each interval overlapping at least one interval of other
+        """
+        found = np.zeros(len(self), dtype=bool)
+        others = other.by_chrom()
+        for chrom, index in self.by_chrom().items():
+            if chrom not in others:
+                continue
+            other_index = others[chrom]
+            # the furthest end of the intervals of other starting before
+            # each point
+            reach = np.maximum.accumulate(other.ends[other_index])
+            before = np.searchsorted(other.starts[other_index],
+                                     self.ends[index], side="left")
+            hit = before > 0
+            found[index[hit]] = (reach[before[hit] - 1] >
+                                 self.starts[index[hit]])
+        return found
+
+    def overlap_pairs(self, other):
+        """
+        the index of each interval paired with the index in other of each
+        interval it overlaps, sorted by the first index and then by the
+        position of the other interval
+        """
+        pairs_self = []
+        pairs_other = []
+        # the position of each interval of other along its chromosome
+        ranks = np.zeros(len(other), dtype=np.int64)
+        others = other.by_chrom()
+        for chrom, index in self.by_chrom().items():
+            if chrom not in others:
+                continue
+            other_index = others[chrom]
+            ranks[other_index] = np.arange(len(other_index))
+            starts = self.starts[index]
+            ends = self.ends[index]
+            lengths = other.ends[other_index] - other.starts[other_index]
+            # intervals of other are looked up in classes of lengths within
+            # a factor of two, so one long interval doesn't widen the
+            # window of candidates for all of the short ones
+            classes = np.floor(np.log2(np.maximum(lengths, 1)))
+            for length_class in np.unique(classes):
+                class_index = other_index[classes == length_class]
+                pairs = _window_pairs(starts, ends,
+                                      other.starts[class_index],
+                                      other.ends[class_index])
+                pairs_self.append(index[pairs[0]])
+                pairs_other.append(class_index[pairs[1]])
+        if not pairs_self:
+            return (np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64))
+        pairs_self = np.concatenate(pairs_self)
+        pairs_other = np.concatenate(pairs_other)
+        order = np.lexsort((ranks[pairs_other], pairs_self))
+        return pairs_self[order], pairs_other[order]
+
+    def merged(self):
+        """
+        a dictionary of chromosome to the starts and ends of the union of
+        the intervals on it
+        """
+        merged = {}
+        for chrom, index in self.by_chrom().items():
+            starts = self.starts[index]
+            ends = self.ends[index]
+            reach = np.maximum.accumulate(ends)
+            new = np.concatenate([[True], starts[1:] > reach[:-1]])
+            first = np.flatnonzero(new)
+            last = np.concatenate([first[1:], [len(starts)]]) - 1
+            merged[chrom] = (starts[first], reach[last])
+        return merged
+
+    def batches(self, max_gap=0):
+        """
+        a dictionary of chromosome to the starts and ends of the union of
+        the intervals on it, joining parts of the union less than max_gap
+        apart
+        """
+        batches = {}
+        for chrom, (starts, ends) in self.merged().items():
+            new = np.concatenate([[True], starts[1:] - ends[:-1] >= max_gap])
+            first = np.flatnonzero(new)
+            last = np.concatenate([first[1:], [len(starts)]]) - 1
+            batches[chrom] = (starts[first], ends[last])
+        return batches
+
+    def union(self):
+        """
+        the union of the intervals as Intervals without fields of their own
+        """
+        merged = self.merged()
+        chroms = sorted(merged)
+        return Intervals(
+            np.repeat(np.array(chroms, dtype=object),
+                      [len(merged[c][0]) for c in chroms]),
+            np.concatenate([merged[c][0] for c in chroms] + [[]]),
+            np.concatenate([merged[c][1] for c in chroms] + [[]]))
+
+    def count_overlaps(self, other):
+        """
+        the number of intervals of other overlapping each interval
+        """
+        counts = np.zeros(len(self), dtype=np.int64)
+        others = other.by_chrom()
+        for chrom, index in self.by_chrom().items():
+            if chrom not in others:
+                continue
+            other_index = others[chrom]
+            starts = np.sort(other.starts[other_index])
+            ends = np.sort(other.ends[other_index])
+            # intervals starting before the end minus those ending before
+            # the start, which also started before the end
+            counts[index] = (
+                np.searchsorted(starts, self.ends[index], side="left") -
+                np.searchsorted(ends, self.starts[index], side="right"))
+        return counts
+
+    def bases_covered(self, other):
+        """
+        the number of bases of each interval covered by intervals of other
+        """
+        covered = np.zeros(len(self), dtype=np.int64)
+        merged = other.merged()
+        for chrom, index in self.by_chrom().items():
+            if chrom not in merged:
+                continue
+            starts, ends = merged[chrom]
+            below = np.concatenate([[0], np.cumsum(ends - starts)])
+
+            def covered_below(points):
+                # bases of the union below each point
+                i = np.searchsorted(starts, points, side="right")
+                inside = np.clip(points - starts[np.maximum(i - 1, 0)], 0,
+                                 (ends - starts)[np.maximum(i - 1, 0)])
+                return below[np.maximum(i - 1, 0)] + np.where(i > 0, inside,
+                                                              0)
+
+            covered[index] = (covered_below(self.ends[index]) -
+                              covered_below(self.starts[index]))
+        return covered
+
+
+def _window_pairs(starts, ends, other_starts, other_ends):
+    """
+    the overlapping pairs of the intervals of starts and ends with those of
+    other_starts and other_ends, which are sorted by start, as indexes into
+    each. each interval is compared to the window of intervals of other
+    starting less than the longest of them before it, up to its end
+    """
+    if not len(other_starts):
+        return (np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64))
+    longest = np.max(other_ends - other_starts)
+    high = np.searchsorted(other_starts, ends, side="left")
+    low = np.searchsorted(other_starts, starts - longest, side="left")
+    sizes = np.maximum(high - low, 0)
+    which = np.repeat(np.arange(len(starts)), sizes)
+    offsets = np.arange(np.sum(sizes)) - np.repeat(np.cumsum(sizes) - sizes,
+                                                   sizes)
+    candidate = low[which] + offsets
+    hit = other_ends[candidate] > starts[which]
+    return which[hit], candidate[hit]
+
+
+def concatenate(intervals):
+    """
+    the intervals of a list of Intervals as one
+    """
+    return Intervals(np.concatenate([x.chroms for x in intervals]),
+                     np.concatenate([x.starts for x in intervals]),
+                     np.concatenate([x.ends for x in intervals]),
+                     [f for x in intervals for f in x.fields],
+                     any(x.gff for x in intervals))
+
+
+def multi_intersect(intervals):
+    """
+    sweeps over a list of Intervals at once, splitting the genome at every
+    start and end. yields chrom, start, end and a boolean array of which of
+    the intervals cover each piece covered by any of them, merging
+    neighbouring pieces covered by the same intervals
+    """
+    chroms = set()
+    for x in intervals:
+        chroms.update(x.by_chrom())
+    for chrom in sorted(chroms):
+        sorted_starts = []
+        sorted_ends = []
+        for x in intervals:
+            index = x.by_chrom().get(chrom, np.zeros(0, dtype=np.int64))
+            sorted_starts.append(np.sort(x.starts[index]))
+            sorted_ends.append(np.sort(x.ends[index]))
+        bounds = np.unique(np.concatenate(sorted_starts + sorted_ends))
+        if len(bounds) < 2:
+            continue
+        # the depth of each of the intervals at the start of each piece
+        present = np.array([np.searchsorted(s, bounds[:-1], side="right") -
+                            np.searchsorted(e, bounds[:-1], side="right")
+                            for s, e in zip(sorted_starts, sorted_ends)]).T > 0
+        changed = np.concatenate(
+            [[True], (present[1:] != present[:-1]).any(axis=1)])
+        first = np.flatnonzero(changed)
+        last = np.concatenate([first[1:], [len(present)]])
+        for i, j in zip(first, last):
+            if present[i].any():
+                yield chrom, bounds[i], bounds[j], present[i]
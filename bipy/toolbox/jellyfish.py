@@ -2,6 +2,7 @@
 runs jellyfish with various options
 """
 from bipy.utils import flatten, replace_suffix, build_results_dir, append_stem
+import glob
 import os
 import subprocess
 
@@ -23,7 +24,9 @@ def _build_command(input_file, out_prefix, jellyfish_config):
 
 
 def _build_merge_command(out_prefix, out_file):
-    cmd = ["jellyfish", "merge", "-o", out_file, out_prefix + "_*"]
+    # subprocess does not expand the glob like a shell would
+    cmd = ["jellyfish", "merge", "-o", out_file]
+    cmd += sorted(glob.glob(out_prefix + "_*"))
     return(cmd)
 
 
@@ -31,7 +34,7 @@ def run(input_file, jellyfish_config, config):
     # run the jellyfish counting, this produces a set of files identified
     # by out_prefix
     out_prefix = _build_output_prefix(input_file, jellyfish_config, config)
-    cmd = _build_command(input_file, out_prefix, config)
+    cmd = _build_command(input_file, out_prefix, jellyfish_config)
     subprocess.check_call(cmd)
 
     # combine the output files into one merged file and return that
@@ -0,0 +1,179 @@
+"""
+k-mer counting in process, for the small and medium jobs like finding
+adapters and overrepresented sequences where running jellyfish is not worth
+it. reads are 2-bit encoded into uint64 k-mers, so k can be up to 32, with
+sliding windows over the bases of a chunk of reads. the k-mers of each
+chunk are counted by sorting them and chunks counted by a pool of workers
+are merged the same way. k-mers with bases other than ACGT are skipped.
+
+example:
+counts = count_kmers("reads.fastq", 21, cores=4)
+top_kmers(counts, 10)
+histogram(counts)
+"""
+from collections import namedtuple
+from itertools import islice
+from multiprocessing import Pool
+import numpy as np
+from Bio.SeqIO.QualityIO import FastqGeneralIterator
+from Bio.SeqIO.FastaIO import SimpleFastaParser
+from bcbio.distributed.transaction import file_transaction
+
+MAX_K = 32
+DEFAULT_CHUNKSIZE = 100000
+# 2-bit codes of the bases, everything else is INVALID
+INVALID = 4
+_CODES = np.empty(256, dtype=np.uint8)
+_CODES.fill(INVALID)
+for _base, _code in zip("ACGT", range(4)):
+    _CODES[ord(_base)] = _code
+    _CODES[ord(_base.lower())] = _code
+_BASES = np.array(list("ACGT"))
+
+# distinct k-mers, sorted, and the number of times each was seen
+KmerCounts = namedtuple("KmerCounts", ["k", "kmers", "counts"])
+
+
+def _check_k(k):
+    if not 0 < k <= MAX_K:
+        raise ValueError("k has to be between 1 and %d, not %d." % (MAX_K, k))
+
+
+def encode(seqs, k, canonical=False):
+    """
+    the k-mers of a list of sequences as uint64s. with canonical each k-mer
+    is the smaller of itself and its reverse complement
+    """
+    _check_k(k)
+    # the INVALID separator keeps k-mers from spanning two sequences
+    codes = _CODES[np.frombuffer("N".join(seqs), dtype=np.uint8)]
+    n = len(codes) - k + 1
+    if n <= 0:
+        return np.zeros(0, dtype=np.uint64)
+    invalid = np.concatenate([[0], np.cumsum(codes == INVALID)])
+    valid = invalid[k:] - invalid[:-k] == 0
+    codes = np.where(codes == INVALID, 0, codes).astype(np.uint64)
+    two = np.uint64(2)
+    kmers = np.zeros(n, dtype=np.uint64)
+    for i in range(k):
+        kmers = (kmers << two) | codes[i:i + n]
+    if canonical:
+        complements = np.uint64(3) - codes
+        reverse = np.zeros(n, dtype=np.uint64)
+        for i in range(k - 1, -1, -1):
+            reverse = (reverse << two) | complements[i:i + n]
+        kmers = np.minimum(kmers, reverse)
+    return kmers[valid]
+
+
+def decode(kmer, k):
+    """ the sequence of a k-mer encoded by encode """
+    kmer = int(kmer)
+    return "".join(_BASES[(kmer >> (2 * (k - 1 - i))) & 3] for i in range(k))
+
+
+def _count(kmers):
+    kmers, counts = np.unique(kmers, return_counts=True)
+    return kmers, counts.astype(np.int64)
+
+
+def _count_chunk(args):
+    seqs, k, canonical = args
+    return _count(encode(seqs, k, canonical))
+
+
+def merge_counts(partials):
+    """
+    merges (kmers, counts) pairs of chunks counted separately into one
+    """
+    partials = list(partials)
+    if not partials:
+        return np.zeros(0, dtype=np.uint64), np.zeros(0, dtype=np.int64)
+    kmers, inverse = np.unique(np.concatenate([x[0] for x in partials]),
+                               return_inverse=True)
+    counts = np.bincount(inverse,
+                         weights=np.concatenate([x[1] for x in partials]),
+                         minlength=len(kmers))
+    return kmers, counts.astype(np.int64)
+
+
+def read_sequences(in_file, kind="fastq"):
+    """ yields the sequences of a FASTQ or FASTA file as strings """
+    parser = FastqGeneralIterator if kind == "fastq" else SimpleFastaParser
+    with open(in_file) as in_handle:
+        for record in parser(in_handle):
+            yield record[1]
+
+
+def _chunks(seqs, chunksize):
+    while True:
+        chunk = list(islice(seqs, chunksize))
+        if not chunk:
+            return
+        yield chunk
+
+
+def count_kmers(in_file, k, kind="fastq", cores=1, canonical=False,
+                chunksize=DEFAULT_CHUNKSIZE):
+    """
+    counts the k-mers of the reads in in_file, a FASTQ or FASTA file, in
+    chunks of chunksize reads. with more than one core the chunks are
+    counted by a pool of workers, cores chunks at a time, and the counts
+    merged after each round so only those chunks are in memory
+    """
+    _check_k(k)
+    chunks = _chunks(read_sequences(in_file, kind), chunksize)
+    total = merge_counts([])
+    if cores <= 1:
+        for chunk in chunks:
+            total = merge_counts([total, _count_chunk((chunk, k, canonical))])
+        return KmerCounts(k, *total)
+    pool = Pool(cores)
+    try:
+        while True:
+            window = list(islice(chunks, cores))
+            if not window:
+                break
+            partials = pool.map(_count_chunk, [(chunk, k, canonical)
+                                               for chunk in window],
+                                chunksize=1)
+            total = merge_counts([total] + partials)
+    finally:
+        pool.close()
+        pool.join()
+    return KmerCounts(k, *total)
+
+
+def top_kmers(counts, n=10):
+    """
+    the n most common k-mers as (sequence, count), ties in the order of the
+    k-mers
+    """
+    order = np.argsort(-counts.counts, kind="mergesort")[:n]
+    return [(decode(counts.kmers[i], counts.k), int(counts.counts[i]))
+            for i in order]
+
+
+def histogram(counts):
+    """
+    the number of distinct k-mers seen each number of times, as
+    (times seen, k-mers) for each number of times seen by any k-mer like
+    jellyfish histo
+    """
+    times, kmers = np.unique(counts.counts, return_counts=True)
+    return [(int(x), int(y)) for x, y in zip(times, kmers)]
+
+
+def write_counts(counts, out_file, min_count=1):
+    """
+    writes each k-mer seen at least min_count times and its count, tab
+    delimited like jellyfish dump -c
+    """
+    keep = np.flatnonzero(counts.counts >= min_count)
+    with file_transaction(out_file) as tx_out_file:
+        with open(tx_out_file, "w") as out_handle:
+            for i in keep:
+                out_handle.write("%s\t%d\n" % (decode(counts.kmers[i],
+                                                      counts.k),
+                                               counts.counts[i]))
+    return out_file
@@ -0,0 +1,130 @@
+"""
+normalization of count matrices. all of the methods work on a whole
+dataframe of counts (genes x samples) at once. gene lengths are the union
+exon length of each gene and are cached next to the GTF file they were
+calculated from, so they are only calculated once per annotation.
+"""
+import os
+import numpy as np
+import pandas as pd
+from bcbio.utils import file_exists
+from bcbio.distributed.transaction import file_transaction
+from bipy.utils import replace_suffix
+from bipy.toolbox.htseq_count import ExonIndex, SPECIAL_COUNTERS
+
+# genes without a known length are assumed to be about 1kb long
+DEFAULT_GENE_LENGTH = 1000
+METHODS = ["cpm", "rpkm", "tpm", "upper_quartile"]
+
+
+def gene_lengths(gtf_file, cache_file=None):
+    """
+    returns a series of the union exon length of each gene in gtf_file.
+    the lengths are cached in cache_file and only recalculated if the
+    GTF file is newer than the cache
+    """
+    if cache_file is None:
+        cache_file = replace_suffix(gtf_file, "gene_lengths")
+    if (file_exists(cache_file) and
+            os.path.getmtime(cache_file) >= os.path.getmtime(gtf_file)):
+        return pd.read_csv(cache_file, sep="\t", index_col=0,
+                           header=None)[1]
+
+    index = ExonIndex.from_gtf(gtf_file)
+    lengths = pd.Series(index.lengths, index=index.genes)
+    with file_transaction(cache_file) as tmp_cache_file:
+        lengths.to_csv(tmp_cache_file, sep="\t", header=False)
+    return lengths
+
+
+def drop_special_counters(counts):
+    """
+    removes the htseq-count special counters (__no_feature, etc) from
+    a count matrix, including the ones from older versions without the
+    __ prefix
+    """
+    special = set(SPECIAL_COUNTERS + [x[2:] for x in SPECIAL_COUNTERS])
+    return counts[[x not in special for x in counts.index]]
+
+
+def _library_sizes(counts):
+    return counts.values.sum(axis=0).astype(np.float64)
+
+
+def _length_matrix(counts, lengths):
+    """
+    lengths in kb lined up with counts. lengths is either a series of gene
+    lengths or a dataframe of per sample effective lengths
+    """
+    if isinstance(lengths, pd.DataFrame):
+        aligned = lengths.reindex(index=counts.index, columns=counts.columns)
+        values = aligned.values.astype(np.float64)
+    else:
+        values = lengths.reindex(counts.index).values.astype(np.float64)
+        values = values[:, np.newaxis]
+    values = np.where(np.isnan(values), DEFAULT_GENE_LENGTH, values)
+    return values / 1e3
+
+
+def cpm(counts):
+    """ counts per million mapped reads """
+    values = counts.values / (_library_sizes(counts) / 1e6)
+    return pd.DataFrame(values, index=counts.index, columns=counts.columns)
+
+
+def rpkm(counts, lengths):
+    """ reads per kilobase of gene per million mapped reads """
+    values = (counts.values / _length_matrix(counts, lengths) /
+              (_library_sizes(counts) / 1e6))
+    return pd.DataFrame(values, index=counts.index, columns=counts.columns)
+
+
+def tpm(counts, lengths):
+    """ transcripts per million """
+    rate = counts.values / _length_matrix(counts, lengths)
+    values = rate / (rate.sum(axis=0) / 1e6)
+    return pd.DataFrame(values, index=counts.index, columns=counts.columns)
+
+
+def upper_quartile(counts):
+    """
+    scales each sample by the upper quartile of its counts over the genes
+    seen in any sample, rescaled by the mean upper quartile so the values
+    stay on the scale of the counts
+    """
+    values = counts.values.astype(np.float64)
+    expressed = values[values.sum(axis=1) > 0]
+    if not len(expressed):
+        return pd.DataFrame(values, index=counts.index,
+                            columns=counts.columns)
+    quartiles = np.percentile(expressed, 75, axis=0)
+    values = values / quartiles * quartiles.mean()
+    return pd.DataFrame(values, index=counts.index, columns=counts.columns)
+
+
+def normalize(counts, lengths, out_prefix, effective_lengths=None,
+              methods=METHODS):
+    """
+    writes every normalization in methods for a matrix of counts to
+    out_prefix.method.txt and returns a dictionary of method to file.
+    effective_lengths is a dataframe of per sample gene lengths to use
+    instead of lengths for RPKM and TPM, for example from a transcript
+    quantifier
+    """
+    out_files = dict((x, "%s.%s.txt" % (out_prefix, x)) for x in methods)
+    if all(map(file_exists, out_files.values())):
+        return out_files
+
+    counts = drop_special_counters(counts)
+    if effective_lengths is not None:
+        lengths = effective_lengths
+    normalizers = {"cpm": lambda: cpm(counts),
+                   "rpkm": lambda: rpkm(counts, lengths),
+                   "tpm": lambda: tpm(counts, lengths),
+                   "upper_quartile": lambda: upper_quartile(counts)}
+    for method in methods:
+        if file_exists(out_files[method]):
+            continue
+        with file_transaction(out_files[method]) as tmp_out_file:
+            normalizers[method]().to_csv(tmp_out_file, sep="\t")
+    return out_files
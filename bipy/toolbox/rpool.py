@@ -0,0 +1,213 @@
+"""
+pool of long lived R processes for running R code from the wrappers.
+
+each worker embeds its own R through rpy2 and loads its packages once, so
+jobs don't pay for R startup or require() on every call. every job runs in
+its own fresh R environment, so jobs can run at the same time without
+clobbering each other's variables (cds, res, counts, ...). data should be
+passed to jobs as files; only file names and small parameters are
+assigned.
+
+rpy2 is only imported in the workers, by their first job. importing it
+starts R, and the workers are forked from this process, so it must not be
+imported here. a failure to import rpy2 or to load a package is raised as
+an RError from the job that needed it. in a daemonic process, a worker of
+another pool for example, no pool can be started and jobs are run in the
+process itself.
+
+example:
+job = RJob(["DESeq"])
+job.assign("in_file", "counts.txt")
+job('''counts = read.table(in_file, header=TRUE, row.names=1)''')
+job.run()
+"""
+import atexit
+import os
+import traceback
+from multiprocessing import Pool, cpu_count, current_process
+from bipy.log import logger
+
+DEFAULT_PROCESSES = min(4, cpu_count())
+
+# per worker state
+_r = {}
+
+_shared_pool = None
+# the process the shared pool was started in. forked children inherit the
+# pool but not its threads, so they start their own
+_shared_pool_pid = None
+
+
+class RError(RuntimeError):
+    pass
+
+
+class RJob(object):
+    """
+    R code to run in its own environment on an RPool worker. it has the
+    assign and call interface of rpy2's robjects.r, so the same helper
+    functions can build up a job: assignments and code are recorded in
+    order and replayed on the worker. values to assign should be strings,
+    numbers, booleans, None or lists of them
+    """
+
+    def __init__(self, packages=None):
+        self.packages = list(packages or [])
+        self.steps = []
+
+    def assign(self, name, value):
+        self.steps.append(("assign", name, value))
+
+    def __call__(self, code):
+        self.steps.append(("eval", code))
+        return self
+
+    def run(self, pool=None, returns=None):
+        """
+        runs the job and returns the values of the variables named in
+        returns as python lists
+        """
+        if pool is None:
+            pool = shared_pool()
+        return pool.run(self, returns)
+
+
+def _to_r(value):
+    from rpy2 import robjects
+    if value is None:
+        return robjects.NULL
+    values = value if isinstance(value, (list, tuple)) else [value]
+    if all(isinstance(x, bool) for x in values):
+        return robjects.BoolVector(values)
+    if all(isinstance(x, (int, long)) for x in values):
+        return robjects.IntVector(values)
+    if all(isinstance(x, (int, long, float)) for x in values):
+        return robjects.FloatVector(values)
+    return robjects.StrVector([str(x) for x in values])
+
+
+def _load_packages(packages):
+    for package in packages:
+        if package not in _r["packages"]:
+            _r["robjects"].r("suppressMessages(library(%s))" % (package))
+            _r["packages"].add(package)
+
+
+def _init_worker(packages):
+    # nothing that can fail happens here: an exception in a pool
+    # initializer makes multiprocessing restart the worker forever
+    _r["preload"] = list(packages)
+    _r["packages"] = set()
+
+
+def _start_r():
+    if "robjects" not in _r:
+        from rpy2 import robjects
+        _r["robjects"] = robjects
+        _r.setdefault("packages", set())
+        _load_packages(_r.pop("preload", []))
+    return _r["robjects"].r
+
+
+def _run_job(job, returns):
+    try:
+        r = _start_r()
+        _load_packages(job.packages)
+        env = r["new.env"]()
+        for step in job.steps:
+            if step[0] == "assign":
+                env[step[1]] = _to_r(step[2])
+            else:
+                r["eval"](r["parse"](text=step[1]), envir=env)
+        return [list(env[x]) for x in returns or []]
+    except Exception:
+        # rpy2 exceptions do not always survive the trip back to the parent
+        raise RError(traceback.format_exc())
+
+
+class RPool(object):
+    """
+    a few long lived R processes with packages preloaded. run blocks until
+    a job is done, run_async and map let many jobs run at once
+    """
+
+    def __init__(self, processes=DEFAULT_PROCESSES, packages=None):
+        self.processes = processes
+        self.packages = list(packages or [])
+        self._pool = Pool(processes, _init_worker, (self.packages,))
+
+    def run(self, job, returns=None):
+        return self.run_async(job, returns).get()
+
+    def run_async(self, job, returns=None):
+        return self._pool.apply_async(_run_job, (job, returns))
+
+    def map(self, jobs, returns=None):
+        results = [self.run_async(job, returns) for job in jobs]
+        return [x.get() for x in results]
+
+    def close(self):
+        self._pool.close()
+        self._pool.join()
+
+
+class _Finished(object):
+    """ the result of a job run in process, like an AsyncResult """
+
+    def __init__(self, function, *args):
+        try:
+            self._value = function(*args)
+            self._error = None
+        except RError as error:
+            self._error = error
+
+    def get(self):
+        if self._error is not None:
+            raise self._error
+        return self._value
+
+
+class LocalRPool(RPool):
+    """
+    runs jobs one at a time in this process, for processes that cannot
+    start a pool of their own
+    """
+
+    def __init__(self, processes=1, packages=None):
+        self.processes = 1
+        self.packages = list(packages or [])
+        _r.setdefault("preload", []).extend(self.packages)
+
+    def run_async(self, job, returns=None):
+        return _Finished(_run_job, job, returns)
+
+    def close(self):
+        pass
+
+
+def shared_pool(processes=DEFAULT_PROCESSES, packages=None):
+    """
+    returns the pool shared by all of the wrappers in this process,
+    starting it on first use. daemonic processes can't have children, so
+    in those the jobs are run in process
+    """
+    global _shared_pool, _shared_pool_pid
+    if _shared_pool is None or _shared_pool_pid != os.getpid():
+        _shared_pool_pid = os.getpid()
+        if current_process().daemon:
+            logger.info("Running R jobs in process %s." % (
+                current_process().name))
+            _shared_pool = LocalRPool(packages=packages)
+        else:
+            logger.info("Starting %d R worker processes." % (processes))
+            _shared_pool = RPool(processes, packages)
+    return _shared_pool
+
+
+@atexit.register
+def close_shared_pool():
+    global _shared_pool
+    # a pool inherited from the parent is the parent's to close
+    if _shared_pool is not None and _shared_pool_pid == os.getpid():
+        _shared_pool.close()
+    _shared_pool = None
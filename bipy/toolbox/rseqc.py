@@ -1,19 +1,33 @@
 import os
+import abc
 from bipy.utils import (replace_suffix, which, remove_suffix, append_stem,
                         prepare_ref_file)
 import sh
 from bcbio.utils import file_exists, safe_makedir, add_full_path
 import glob
+from collections import OrderedDict
+from itertools import islice
+import numpy as np
 import pandas as pd
+import pysam
+import shutil
+from multiprocessing import Pool
+from multiprocessing.pool import ThreadPool
 from math import sqrt
 from mako.template import Template
 from bipy.toolbox.reporting import LatexReport, safe_latex
+from bipy.toolbox import chrom_sizes
+from bipy.toolbox.rpool import RJob
 from bcbio.distributed.transaction import file_transaction
 from bipy.pipeline.stages import AbstractStage
 from bcbio.broad import BroadRunner, picardrun
 from bcbio.log import logger
 from bcbio.provenance import do
 
+# bases of a chromosome whose reads are held in memory at a time by
+# bam_coverage
+DEFAULT_COVERAGE_WINDOW = 4000000
+
 
 def program_exists(path):
     return which(path)
@@ -35,10 +49,155 @@ def _results_dir(config, prefix=""):
         return _make_dir(config["dir"]["results"])
 
 
-def _fetch_chrom_sizes(config):
+def _fragment_strand(read):
+    """
+    the strand of the fragment a read comes from, the second read of a
+    pair is on the opposite strand of its fragment
+    """
+    if read.is_paired and read.is_read2:
+        return "+" if read.is_reverse else "-"
+    return "-" if read.is_reverse else "+"
+
+
+def _window_runs(samfile, chrom, start, end, strand):
+    """
+    run length encoded depth of the primary alignments on chrom between
+    start and end. reads are counted by their aligned blocks, so introns
+    and deletions are not covered. the runs are found from the sorted
+    block boundaries, so the work depends on the number of reads rather
+    than the size of the window. returns the starts, ends and int32
+    depths of the covered runs and the number of reads starting in the
+    window
+    """
+    starts = []
+    ends = []
+    n_reads = 0
+    for read in samfile.fetch(chrom, start, end):
+        if read.flag & (FLAG_UNMAPPED | FLAG_NOT_PRIMARY | FLAG_QC_FAIL |
+                        FLAG_DUPLICATE):
+            continue
+        if strand and _fragment_strand(read) != strand:
+            continue
+        if read.reference_start >= start:
+            n_reads += 1
+        for block_start, block_end in read.get_blocks():
+            starts.append(block_start)
+            ends.append(block_end)
+    positions = np.clip(np.array(starts + ends, dtype=np.int64), start, end)
+    changes = np.concatenate([np.ones(len(starts), dtype=np.int32),
+                              -np.ones(len(ends), dtype=np.int32)])
+    positions, index = np.unique(positions, return_inverse=True)
+    changes = np.bincount(index, weights=changes,
+                          minlength=len(positions)).astype(np.int32)
+    # blocks starting where others end don't change the depth
+    positions = positions[changes != 0]
+    depth = np.cumsum(changes[changes != 0], dtype=np.int32)
+    covered = np.flatnonzero(depth[:-1] > 0)
+    return (positions[covered], positions[covered + 1], depth[covered],
+            n_reads)
+
+
+def _chrom_coverage(args):
+    """
+    run length encoded coverage of one chromosome, calculated a window
+    at a time and saved to out_file. returns the number of reads counted
+    """
+    in_file, chrom, length, strand, window, out_file = args
+    samfile = pysam.AlignmentFile(in_file, "rb")
+    # a chromosome of length 0 has no windows and no runs
+    runs = [(np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64),
+             np.zeros(0, dtype=np.int32))]
+    n_reads = 0
+    for start in range(0, length, window):
+        end = min(start + window, length)
+        run_starts, run_ends, values, window_reads = _window_runs(
+            samfile, chrom, start, end, strand)
+        n_reads += window_reads
+        runs.append((run_starts, run_ends, values))
+    samfile.close()
+    starts, ends, values = [np.concatenate(x) for x in zip(*runs)]
+    # join the runs split by the window boundaries
+    split = np.flatnonzero((starts[1:] == ends[:-1]) &
+                           (values[1:] == values[:-1])) + 1
+    keep = np.ones(len(starts), dtype=bool)
+    keep[split] = False
+    first = np.flatnonzero(keep)
+    last = np.append(first[1:], len(starts)) - 1
+    np.savez(out_file, starts=starts[first], ends=ends[last[:len(first)]],
+             values=values[first])
+    return n_reads
+
+
+def _indexed_bam(in_file, out_dir):
+    """
+    in_file if it has an index, otherwise a link to it in out_dir with an
+    index of its own, so nothing is written next to the input
+    """
+    if (file_exists(in_file + ".bai") or
+            file_exists(os.path.splitext(in_file)[0] + ".bai")):
+        return in_file
+    link = os.path.join(out_dir, os.path.basename(in_file))
+    if not os.path.lexists(link):
+        safe_makedir(out_dir)
+        os.symlink(os.path.abspath(in_file), link)
+    if (not file_exists(link + ".bai") or
+            os.path.getmtime(link + ".bai") < os.path.getmtime(in_file)):
+        pysam.index(link)
+    return link
 
-    PROGRAM = "fetchChromSizes"
 
+def bam_coverage(in_file, out_file, strand=None, normalize=False, cores=1,
+                 window=DEFAULT_COVERAGE_WINDOW):
+    """
+    writes the coverage of a sorted BAM file as a bedGraph file. a BAM
+    file without an index is indexed through a link next to out_file.
+    chromosomes are done in parallel on cores processes, each a window of
+    bases at a time to bound the memory used. strand is "+" or "-" to only
+    count the reads from fragments on one strand. with normalize the
+    coverage is scaled to reads per million counted reads
+    """
+    if file_exists(out_file):
+        return out_file
+    in_file = _indexed_bam(in_file, os.path.dirname(os.path.abspath(out_file)))
+    samfile = pysam.AlignmentFile(in_file, "rb")
+    # bedGraphToBigWig needs the chromosomes sorted by name
+    chroms = sorted(zip(samfile.references, samfile.lengths))
+    samfile.close()
+    tmp_dir = safe_makedir(out_file + ".tmp")
+    jobs = [(in_file, chrom, length, strand, window,
+             os.path.join(tmp_dir, "%d.npz" % (i)))
+            for i, (chrom, length) in enumerate(chroms)]
+    if cores > 1:
+        pool = Pool(cores)
+        try:
+            n_reads = pool.map(_chrom_coverage, jobs)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        n_reads = map(_chrom_coverage, jobs)
+    scale = 1e6 / max(sum(n_reads), 1) if normalize else 1
+    with file_transaction(out_file) as tx_out_file:
+        with open(tx_out_file, "w") as out_handle:
+            for (chrom, _), job in zip(chroms, jobs):
+                runs = np.load(job[-1])
+                table = pd.DataFrame({"chrom": chrom,
+                                      "start": runs["starts"],
+                                      "end": runs["ends"],
+                                      "value": runs["values"] * scale},
+                                     columns=["chrom", "start", "end",
+                                              "value"])
+                table.to_csv(out_handle, sep="\t", header=False,
+                             index=False, float_format="%.4g")
+    shutil.rmtree(tmp_dir)
+    return out_file
+
+
+def bedgraph2bigwig(bedgraph_file, chrom_size_file, out_file):
+    """
+    convert a bedGraph file to a bigwig file using the UCSC tool
+    """
+    PROGRAM = "bedGraphToBigWig"
     if not program_exists(PROGRAM):
         logger.error("%s is not in the path or is not executable. Make sure "
                      "it is installed or go to "
@@ -46,59 +205,53 @@ def _fetch_chrom_sizes(config):
                      "to download it." % (PROGRAM))
         exit(1)
 
-    if "annotation" not in config:
-        logger.error("'annotation' must be in the yaml file. See example "
-                     " configuration files")
-        exit(1)
-    if "name" not in config["annotation"]:
-        logger.error("'name' must be in the yaml file under  "
-                     " 'annotation'. See example configuration files.")
-        exit(1)
-    genome = config["annotation"]["name"]
-    chrom_size_file = os.path.join(_results_dir(config),
-                                   genome + ".sizes")
-    if file_exists(chrom_size_file):
-        return chrom_size_file
-
-    with file_transaction(chrom_size_file) as tmp_chrom_size_file:
-        sh.fetchChromSizes(genome, _out=tmp_chrom_size_file)
-
-    if not file_exists(chrom_size_file):
-        logger.error("chromosome size file does not exist. Check "
-                     "'annotation': 'name' to make sure it is valid.")
-        exit(1)
-    return chrom_size_file
+    if file_exists(out_file):
+        return out_file
+
+    bedGraphToBigWig = sh.Command(which(PROGRAM))
+    with file_transaction(out_file) as tx_out_file:
+        cmd = str(bedGraphToBigWig.bake(bedgraph_file, chrom_size_file,
+                                        tx_out_file))
+        do.run(cmd, "Converting %s from bedGraph to bigwig."
+               % (bedgraph_file), None)
+    return out_file
 
 
-def bam2bigwig(in_file, config, out_prefix=None):
+def bam2bigwig(in_file, config, out_prefix=None, strand=None,
+               normalize=False):
     """
-    assumes the library preparation was not strand specific for now
+    makes a bigwig file of the coverage of in_file, without a wiggle file
+    in between. the bedGraph file it is made from is removed afterwards.
+    strand is "+" or "-" for a strand specific track and normalize scales
+    the coverage to reads per million
     """
-    PROGRAM = "bam2wig.py"
-    if not program_exists(PROGRAM):
-        logger.info("%s is not in the path or is not executable." % (PROGRAM))
-        exit(1)
-
     prefix = "bigwig"
-    chrom_size_file = config["annotation"].get("chrom_size_file", None)
     out_prefix = _get_out_prefix(in_file, config, out_prefix, prefix)
-    if not chrom_size_file:
-        chrom_size_file = _fetch_chrom_sizes(config)
-    wiggle_file = out_prefix + ".wig"
-
-    if not file_exists(wiggle_file):
-        bam2wig = sh.Command(which(PROGRAM))
-        cmd = str(bam2wig.bake(i=in_file, s=chrom_size_file, o=out_prefix))
-        do.run(cmd, "Converting %s from BAM to bigwig" % (in_file), None)
-
+    if strand:
+        out_prefix += {"+": ".plus", "-": ".minus"}[strand]
+    if normalize:
+        out_prefix += ".rpm"
     bigwig_file = out_prefix + ".bw"
-
-    return wig2bigwig(wiggle_file, chrom_size_file, bigwig_file)
-
-
-def wig2bigwig(wiggle_file, chrom_size_file, out_file):
+    if file_exists(bigwig_file):
+        return bigwig_file
+
+    stage_config = config.get("stage", {}).get("rseqc", {}) or {}
+    chrom_size_file = chrom_sizes.get_chrom_sizes(config, in_file)
+    tmp_dir = safe_makedir(out_prefix + ".tmp")
+    try:
+        bedgraph_file = bam_coverage(
+            in_file, os.path.join(tmp_dir, os.path.basename(out_prefix) +
+                                  ".bedGraph"),
+            strand, normalize, stage_config.get("cores", 1))
+        return bedgraph2bigwig(bedgraph_file, chrom_size_file, bigwig_file)
+    finally:
+        shutil.rmtree(tmp_dir)
+
+
+def wig2bigwig(wiggle_file, chrom_size_file, out_file, config=None):
     """
-    convert wiggle file to bigwig file using the UCSC tool
+    convert wiggle file to bigwig file using the UCSC tool. if
+    chrom_size_file is None the sizes are looked up from config
     """
     PROGRAM = "wigToBigWig"
     if not program_exists(PROGRAM):
@@ -111,6 +264,8 @@ def wig2bigwig(wiggle_file, chrom_size_file, out_file):
     if file_exists(out_file):
         return out_file
 
+    if not chrom_size_file:
+        chrom_size_file = chrom_sizes.get_chrom_sizes(config)
     wigToBigWig = sh.Command(which(PROGRAM))
     with file_transaction(out_file) as tx_out_file:
         cmd = str(wigToBigWig.bake(wiggle_file, chrom_size_file, tx_out_file))
@@ -122,23 +277,16 @@ def bam_stat(in_file, config, out_prefix=None):
     """
     dump read maping statistics from a SAM or BAM file to out_file
     """
-    PROGRAM = "bam_stat.py"
-    if not program_exists(PROGRAM):
-        logger.info("%s is not in the path or is not executable." % (PROGRAM))
-        exit(1)
-
     prefix = "bam_stat"
     out_prefix = _get_out_prefix(in_file, config, out_prefix, prefix)
     out_file = out_prefix + ".txt"
     if file_exists(out_file):
         return out_file
 
-    bam_stat_run = sh.Command(which(PROGRAM))
-    with file_transaction(out_file) as tx_out_file:
-        cmd = str(bam_stat_run.bake(i=in_file, _err=tx_out_file))
-        do.run(cmd, "Calculating BAM statistics from %s." % (in_file), None)
-
-    return out_file
+    stat = BamStat(_mapq_cut(config))
+    logger.info("Calculating BAM statistics from %s." % (in_file))
+    walk_bam(in_file, [stat])
+    return stat.write(out_prefix)
 
 
 def clipping_profile(in_file, config, out_prefix=None):
@@ -166,25 +314,42 @@ def clipping_profile(in_file, config, out_prefix=None):
 
 def genebody_coverage(in_file, config, out_prefix=None):
     """
-    used to check the 5'/3' bias across transcripts
+    used to check the 5'/3' bias across transcripts. the chromosomes of an
+    indexed BAM file are done in parallel
     """
-    PROGRAM = "geneBody_coverage.py"
-    if not program_exists(PROGRAM):
-        logger.info("%s is not in the path or is not executable." % (PROGRAM))
-        exit(1)
-
     prefix = "coverage"
     out_prefix = _get_out_prefix(in_file, config, out_prefix, prefix)
     coverage_plot_file = out_prefix + ".geneBodyCoverage.pdf"
     if file_exists(coverage_plot_file):
         return coverage_plot_file
 
-    gtf = _get_gtf(config)
-    bed = _gtf2bed(gtf)
-    coverage_run = sh.Command(which(PROGRAM))
-    cmd = str(coverage_run.bake(i=in_file, r=bed, o=out_prefix))
-    do.run(cmd, "Calculating coverage of %s." % (in_file), None)
-    return coverage_plot_file
+    bed = _get_bed(config)
+    logger.info("Calculating coverage of %s." % (in_file))
+    if not in_file.endswith(".bam"):
+        coverage = GeneBodyCoverage(bed)
+        walk_bam(in_file, [coverage])
+        return coverage.write(out_prefix)
+
+    in_file = _indexed_bam(in_file, os.path.dirname(out_prefix))
+    samfile = pysam.AlignmentFile(in_file, "rb")
+    chroms = list(samfile.references)
+    samfile.close()
+    stage_config = config.get("stage", {}).get("rseqc", {}) or {}
+    jobs = [(in_file, bed, chrom) for chrom in chroms]
+    cores = stage_config.get("cores", 1)
+    if cores > 1:
+        pool = Pool(cores)
+        try:
+            results = pool.map(_chrom_genebody_coverage, jobs)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        results = map(_chrom_genebody_coverage, jobs)
+    profile = np.sum([x[0] for x in results], axis=0)
+    total_reads = sum(x[1] for x in results)
+    return _write_genebody_coverage(profile, total_reads, out_prefix)
+
 
 def genebody_coverage2(in_file, config, out_prefix=None):
     """
@@ -217,23 +382,17 @@ def junction_annotation(in_file, config, out_prefix=None):
     """
     compile novel/known information about splice junctions
     """
-    PROGRAM = "junction_annotation.py"
-    if not program_exists(PROGRAM):
-        logger.info("%s is not in the path or is not executable." % (PROGRAM))
-        exit(1)
-
     prefix = "junction"
     out_prefix = _get_out_prefix(in_file, config, out_prefix, prefix)
     junction_file = out_prefix + ".splice_junction.pdf"
     if file_exists(junction_file):
         return junction_file
-    junction_run = sh.Command(which(PROGRAM))
-    gtf = _get_gtf(config)
-    bed = _gtf2bed(gtf)
-    cmd = str(junction_run.bake(i=in_file, o=out_prefix, r=bed))
-    do.run(cmd, "Calculating novel/known information about splice junctions of "
-           "%s." % (in_file), None)
-    return junction_file
+    annotation = JunctionAnnotation(_get_bed(config), _mapq_cut(config),
+                                    _min_intron(config))
+    logger.info("Calculating novel/known information about splice "
+                "junctions of %s." % (in_file))
+    walk_bam(in_file, [annotation])
+    return annotation.write(out_prefix)
 
 
 def junction_saturation(in_file, config, out_prefix=None):
@@ -241,92 +400,125 @@ def junction_saturation(in_file, config, out_prefix=None):
     check if splicing is deep enough to perform alternative splicing
     analysis
     """
-    PROGRAM = "junction_saturation.py"
-    if not program_exists(PROGRAM):
-        logger.info("%s is not in the path or is not executable." % (PROGRAM))
-        exit(1)
-
     prefix = "saturation"
     out_prefix = _get_out_prefix(in_file, config, out_prefix, prefix)
     saturation_file = out_prefix + ".junctionSaturation_plot.pdf"
     if file_exists(saturation_file):
         return saturation_file
-
-    saturation_run = sh.Command(which(PROGRAM))
-    gtf = _get_gtf(config)
-    bed = _gtf2bed(gtf)
-    cmd = str(saturation_run.bake(i=in_file, o=out_prefix, r=bed))
-    do.run(cmd, "Calculating junction saturation estimation of %s." % in_file,
-           None)
-    return saturation_file
+    saturation = JunctionSaturation(_get_bed(config), _mapq_cut(config),
+                                    _min_intron(config))
+    logger.info("Calculating junction saturation of %s." % (in_file))
+    walk_bam(in_file, [saturation])
+    return saturation.write(out_prefix)
 
 
 def RPKM_count(in_file, config, out_prefix=None):
     """
     produce RPKM
     """
-    PROGRAM = "RPKM_count.py"
-    if not program_exists(PROGRAM):
-        logger.info("%s is not in the path or is not executable." % (PROGRAM))
-        exit(1)
-
     prefix = "RPKM_count"
     out_prefix = _get_out_prefix(in_file, config, out_prefix, prefix)
     rpkm_count_file = out_prefix + "_read_count.xls"
-    gtf = _get_gtf(config)
-    bed = _gtf2bed(gtf)
     if file_exists(rpkm_count_file):
         return rpkm_count_file
-    RPKM_count_run = sh.Command(which(PROGRAM))
-    cmd = str(RPKM_count_run.bake(i=in_file, r=bed, o=out_prefix))
-    do.run(cmd, "Calculating RPKM of %s using reference %s." % (in_file, bed),
-           None)
-    return rpkm_count_file
+    bed = _get_bed(config)
+    read_count = ReadCount(bed)
+    logger.info("Calculating RPKM of %s using reference %s." % (in_file, bed))
+    walk_bam(in_file, [read_count])
+    return read_count.write(out_prefix)
+
+
+def _load_RPKM_count(in_file, usecols=None):
+    return pd.read_csv(in_file, sep="\t", usecols=usecols,
+                       dtype={"accession": str})
 
 
-def merge_RPKM(in_dir):
+def _load_aligned_RPKM(in_files, accessions, cores=4):
+    """
+    reads RPKM_count files in a thread pool, yielding the tag counts and
+    RPKM of each file in order lined up with accessions. the files must
+    have the same features as the first one
+    """
+    def load_aligned(in_file):
+        table = _load_RPKM_count(in_file, ["accession", "tag_count", "RPKM"])
+        if not np.array_equal(table["accession"].values, accessions):
+            table = table.set_index("accession")
+            if (len(table) != len(accessions) or
+                    not table.index.is_unique or
+                    not table.index.isin(accessions).all()):
+                raise ValueError("%s does not have the same features as "
+                                 "the other RPKM_count files." % (in_file))
+            table = table.reindex(accessions)
+        return table["tag_count"].values, table["RPKM"].values
+
+    pool = ThreadPool(cores)
+    try:
+        for column in pool.imap(load_aligned, in_files):
+            yield column
+    finally:
+        pool.close()
+        pool.join()
+
+
+def merge_RPKM(in_dir, cores=4, chunksize=100000):
     """
     reads in all RPKM_count files in a directory and combines them into
-    one file
+    one file. the files are read in a thread pool into preallocated
+    count and RPKM matrices, so only a few of them are in memory at once,
+    and the merged table is written chunksize rows at a time
     """
-    HEADER = ["chrom", "st", "end", "accession" "score",
-              "gene_strand", "tag_count", "RPKM"]
-    NAME_COL = 3
-    HEADER_START = 0
-    HEADER_END = 5
-    RPKM_COLUMN = 6
-    COUNT_COLUMN = 5
-
     merged_file = os.path.join(in_dir, "RPKM.combined.txt")
     if file_exists(merged_file):
         return merged_file
 
-    RPKM_files = glob.glob(os.path.join(in_dir, "*_read_count.xls"))
+    RPKM_files = sorted(glob.glob(os.path.join(in_dir, "*_read_count.xls")))
+    if not RPKM_files:
+        raise ValueError("There are no RPKM_count files in %s." % (in_dir))
     col_names = map(os.path.basename, map(remove_suffix, RPKM_files))
-    dataframes = [pd.DataFrame.from_csv(f, sep="\t", index_col=NAME_COL)
-                  for f in RPKM_files]
-    # make sure the data frames are sorted in the same order
-    dataframes = [d.sort_index() for d in dataframes]
-    # get the header rows (columns 0-6)
-    common = dataframes[0].ix[:, HEADER_START:HEADER_END]
-    items = zip(col_names, dataframes)
-    for item in items:
-        common[item[0] + "_count"] = item[1].ix[:, COUNT_COLUMN]
-        common[item[0] + "_RPKM"] = item[1].ix[:, RPKM_COLUMN]
-
-    count_columns = [item[0] + "_count" for item in items]
-    rpkm_columns = [item[0] + "_RPKM" for item in items]
-
-    common["count_total"] = common.ix[:, count_columns].sum(axis=1)
-    common["RPKM_mean"] = common.ix[:, rpkm_columns].mean(axis=1)
-    if len(rpkm_columns) > 1:
-        common["RPKM_sd"] = common.ix[:, rpkm_columns].std(axis=1)
-        common["RPKM_sem"] = common["RPKM_sd"] / sqrt(len(rpkm_columns))
+    common = _load_RPKM_count(RPKM_files[0])
+    accessions = common["accession"].values
+    counts = np.zeros((len(common), len(RPKM_files)), dtype=np.int64)
+    rpkm = np.zeros((len(common), len(RPKM_files)), dtype=np.float64)
+    for i, (count, RPKM) in enumerate(_load_aligned_RPKM(RPKM_files,
+                                                         accessions, cores)):
+        counts[:, i] = count
+        rpkm[:, i] = RPKM
+
+    # the same columns as the header of the RPKM_count files
+    common = common.set_index("accession")[["#chrom", "st", "end", "score",
+                                            "gene_strand"]]
+    order = np.argsort(accessions, kind="mergesort")
+    total = counts.sum(axis=1)
+    mean = np.nanmean(rpkm, axis=1)
+    if len(RPKM_files) > 1:
+        sd = np.nanstd(rpkm, axis=1, ddof=1)
     else:
-        common["RPKM_sd"] = float('NaN')
-        common["RPKM_sem"] = float('NaN')
-
-    common.to_csv(merged_file, sep="\t")
+        sd = np.repeat(np.nan, len(common))
+    sem = sd / sqrt(len(RPKM_files))
+    count_columns = [x + "_count" for x in col_names]
+    rpkm_columns = [x + "_RPKM" for x in col_names]
+    # the count and RPKM of each sample next to each other
+    columns = [x for pair in zip(count_columns, rpkm_columns) for x in pair]
+
+    with file_transaction(merged_file) as tx_merged_file:
+        with open(tx_merged_file, "w") as out_handle:
+            for chunk in range(0, len(order), chunksize):
+                rows = order[chunk:chunk + chunksize]
+                # features can share an accession, so the pieces are lined
+                # up by position and indexed afterwards
+                merged = pd.concat(
+                    [common.iloc[rows].reset_index(drop=True),
+                     pd.DataFrame(counts[rows], columns=count_columns),
+                     pd.DataFrame(rpkm[rows], columns=rpkm_columns),
+                     pd.DataFrame({"count_total": total[rows],
+                                   "RPKM_mean": mean[rows],
+                                   "RPKM_sd": sd[rows],
+                                   "RPKM_sem": sem[rows]})], axis=1)
+                merged = merged[list(common.columns) + columns +
+                                ["count_total", "RPKM_mean", "RPKM_sd",
+                                 "RPKM_sem"]]
+                merged.index = common.index[rows]
+                merged.to_csv(out_handle, sep="\t", header=chunk == 0)
     return merged_file
 
 
@@ -361,24 +553,17 @@ def RPKM_saturation(in_file, config, out_prefix=None):
     """
     estimate the precision of RPKM calculation by resampling
     """
-    PROGRAM = "RPKM_saturation.py"
-    if not program_exists(PROGRAM):
-        logger.info("%s is not in the path or is not executable." % (PROGRAM))
-        exit(1)
-
     prefix = "RPKM_saturation"
     out_prefix = _get_out_prefix(in_file, config, out_prefix, prefix)
     rpkm_saturation_file = out_prefix + ".saturation.pdf"
-    gtf = _get_gtf(config)
-    bed = _gtf2bed(gtf)
-
     if file_exists(rpkm_saturation_file):
         return rpkm_saturation_file
 
-    RPKM_saturation_run = sh.Command(which(PROGRAM))
-    cmd = str(RPKM_saturation_run.bake(i=in_file, r=bed, o=out_prefix))
-    do.run(cmd, "Calculating RPKM saturation of %s." % in_file, None)
-    return rpkm_saturation_file
+    saturation = RPKMSaturation(_get_bed(config), _mapq_cut(config))
+    logger.info("Calculating RPKM saturation of %s." % (in_file))
+    walk_bam(in_file, [saturation])
+    return saturation.write(out_prefix)
+
 
 def _get_out_dir(in_file, config, out_prefix, prefix):
     if not out_prefix:
@@ -416,6 +601,1065 @@ def _gtf2bed(gtf):
     return bed
 
 
+def _get_bed(config):
+    """
+    the BED12 gene models of the GTF file in the configuration, converting
+    the GTF file only if there isn't a BED file next to it already
+    """
+    gtf = config["annotation"].get("file", None)
+    if gtf and file_exists(replace_suffix(gtf, "bed")):
+        return replace_suffix(gtf, "bed")
+    return _gtf2bed(_get_gtf(config))
+
+
+def load_gene_models(bed_file):
+    """
+    returns a dataframe of the exons of the transcripts in a BED12 file
+    with chrom, start, end, name, strand, transcript (the line of the
+    transcript in the file) and exon (the number of the exon from the left)
+    columns. coordinates are 0-based and half open like BED
+    """
+    bed = pd.read_csv(bed_file, sep="\t", header=None, comment="#",
+                      usecols=range(12),
+                      names=["chrom", "start", "end", "name", "score",
+                             "strand", "thick_start", "thick_end", "rgb",
+                             "block_count", "block_sizes", "block_starts"],
+                      dtype={"chrom": str, "name": str})
+    counts = bed["block_count"].values.astype(np.int64)
+    sizes = np.fromstring(",".join(bed["block_sizes"].str.rstrip(",")),
+                          sep=",", dtype=np.int64)
+    offsets = np.fromstring(",".join(bed["block_starts"].str.rstrip(",")),
+                            sep=",", dtype=np.int64)
+    transcript = np.repeat(np.arange(len(bed)), counts)
+    starts = bed["start"].values[transcript] + offsets
+    first = np.cumsum(counts) - counts
+    return pd.DataFrame({"chrom": bed["chrom"].values[transcript],
+                         "start": starts, "end": starts + sizes,
+                         "name": bed["name"].values[transcript],
+                         "strand": bed["strand"].values[transcript],
+                         "transcript": transcript,
+                         "exon": np.arange(len(transcript)) -
+                         first[transcript] + 1},
+                        columns=["chrom", "start", "end", "name", "strand",
+                                 "transcript", "exon"])
+
+
+def _introns(exons):
+    """
+    the introns between the exons of each transcript of load_gene_models,
+    numbered from the left
+    """
+    exons = exons.sort_values(["transcript", "start"])
+    same = (exons["transcript"].values[1:] ==
+            exons["transcript"].values[:-1])
+    left = exons.iloc[:-1][same]
+    right = exons.iloc[1:][same]
+    return pd.DataFrame({"chrom": left["chrom"].values,
+                         "start": left["end"].values,
+                         "end": right["start"].values,
+                         "name": left["name"].values,
+                         "strand": left["strand"].values,
+                         "transcript": left["transcript"].values,
+                         "intron": left["exon"].values},
+                        columns=["chrom", "start", "end", "name", "strand",
+                                 "transcript", "intron"])
+
+
+class PointCounter(object):
+    """
+    counts the points that fall into each of a set of possibly overlapping
+    intervals. points are binned into the segments between the interval
+    boundaries as they are added, so memory only depends on the number of
+    intervals. the segments are numbered across all of the chromosomes
+    """
+
+    def __init__(self, chroms, starts, ends):
+        self._chroms = np.asarray(chroms)
+        self._starts = np.asarray(starts)
+        self._ends = np.asarray(ends)
+        self._boundaries = {}
+        self._offsets = {}
+        size = 0
+        for chrom in np.unique(self._chroms):
+            on_chrom = self._chroms == chrom
+            bounds = np.unique(np.concatenate([self._starts[on_chrom],
+                                               self._ends[on_chrom]]))
+            self._boundaries[chrom] = bounds
+            self._offsets[chrom] = size
+            size += len(bounds)
+        self._segments = np.zeros(size, dtype=np.int64)
+
+    def __len__(self):
+        return len(self._segments)
+
+    def segments(self, chrom, points):
+        """
+        the segment each of points falls into, -1 for points before the
+        first boundary of chrom or on a chromosome without intervals
+        """
+        if chrom not in self._boundaries:
+            return np.repeat(-1, len(points))
+        segment = np.searchsorted(self._boundaries[chrom], points,
+                                  side="right") - 1
+        return np.where(segment >= 0, segment + self._offsets[chrom], -1)
+
+    def add(self, chrom, points):
+        if chrom not in self._boundaries:
+            return
+        offset = self._offsets[chrom]
+        size = len(self._boundaries[chrom])
+        segment = self.segments(chrom, points) - offset
+        segment = segment[segment >= 0]
+        self._segments[offset:offset + size] += np.bincount(segment,
+                                                            minlength=size)
+
+    def counts(self, segment_counts=None):
+        """
+        the number of points in each interval, in the order they were
+        given. segment_counts are the points in each segment to use instead
+        of the points added so far
+        """
+        if segment_counts is None:
+            segment_counts = self._segments
+        counts = np.zeros(len(self._chroms), dtype=np.int64)
+        for chrom, bounds in self._boundaries.items():
+            on_chrom = self._chroms == chrom
+            offset = self._offsets[chrom]
+            before = np.concatenate(
+                [[0], np.cumsum(segment_counts[offset:offset + len(bounds)])])
+            counts[on_chrom] = (
+                before[np.searchsorted(bounds, self._ends[on_chrom])] -
+                before[np.searchsorted(bounds, self._starts[on_chrom])])
+        return counts
+
+
+FLAG_PAIRED = 0x1
+FLAG_PROPER_PAIR = 0x2
+FLAG_UNMAPPED = 0x4
+FLAG_REVERSE = 0x10
+FLAG_READ1 = 0x40
+FLAG_READ2 = 0x80
+FLAG_QC_FAIL = 0x200
+FLAG_DUPLICATE = 0x400
+# secondary and supplementary alignments
+FLAG_NOT_PRIMARY = 0x100 | 0x800
+
+DEFAULT_BATCH_SIZE = 100000
+_INTRON_OP = 3
+# M, D, N, = and X move along the reference
+_REFERENCE_OPS = set([0, 2, 3, 7, 8])
+_XS_STRAND = {"+": 1, "-": -1}
+
+
+class ReadBatch(object):
+    """
+    a batch of alignments as arrays, one entry per alignment for the flag,
+    reference ids, mapping quality and NH tag, and one entry per aligned
+    block and per intron (N operation) with the index of its alignment.
+    intron_strand is the strand of the XS tag of the alignment of each
+    intron, 1 for +, -1 for - and 0 if it has none
+    """
+    def __init__(self, references, flag, tid, mate_tid, mapq, nh,
+                 block_read, block_start, block_end,
+                 intron_read, intron_start, intron_end, intron_strand=None):
+        self.references = references
+        self.flag = np.array(flag, dtype=np.int32)
+        self.tid = np.array(tid, dtype=np.int32)
+        self.mate_tid = np.array(mate_tid, dtype=np.int32)
+        self.mapq = np.array(mapq, dtype=np.int32)
+        self.nh = np.array(nh, dtype=np.int32)
+        self.block_read = np.array(block_read, dtype=np.int64)
+        self.block_start = np.array(block_start, dtype=np.int64)
+        self.block_end = np.array(block_end, dtype=np.int64)
+        self.intron_read = np.array(intron_read, dtype=np.int64)
+        self.intron_start = np.array(intron_start, dtype=np.int64)
+        self.intron_end = np.array(intron_end, dtype=np.int64)
+        if intron_strand is None:
+            intron_strand = np.zeros(len(self.intron_read))
+        self.intron_strand = np.array(intron_strand, dtype=np.int8)
+
+    def __len__(self):
+        return len(self.flag)
+
+    def has_flag(self, bits):
+        return (self.flag & bits) != 0
+
+    def primary_mapped(self):
+        """
+        mapped primary alignments which are not duplicates or QC failures
+        """
+        return ~self.has_flag(FLAG_UNMAPPED | FLAG_NOT_PRIMARY |
+                              FLAG_QC_FAIL | FLAG_DUPLICATE)
+
+    def by_reference(self, reads, *arrays):
+        """
+        yields the reference name and the entries of block or intron arrays,
+        grouped by the reference of their read
+        """
+        tids = self.tid[reads]
+        for tid in np.unique(tids):
+            on_reference = tids == tid
+            yield ((self.references[tid],) +
+                   tuple(x[on_reference] for x in arrays))
+
+
+def _read_batches(in_file, batch_size=DEFAULT_BATCH_SIZE, region=None):
+    """
+    yields the alignments of a SAM or BAM file, or of one region of an
+    indexed BAM file, as ReadBatches
+    """
+    mode = "rb" if in_file.endswith(".bam") else "r"
+    samfile = pysam.AlignmentFile(in_file, mode)
+    references = samfile.references
+    if region:
+        reads = samfile.fetch(region=region)
+    else:
+        reads = samfile.fetch(until_eof=True)
+    while True:
+        fields = [[] for _ in range(12)]
+        (flag, tid, mate_tid, mapq, nh, block_read, block_start, block_end,
+         intron_read, intron_start, intron_end, intron_strand) = fields
+        for index, read in enumerate(islice(reads, batch_size)):
+            flag.append(read.flag)
+            tid.append(read.reference_id)
+            mate_tid.append(read.next_reference_id)
+            mapq.append(read.mapping_quality)
+            nh.append(read.get_tag("NH") if read.has_tag("NH") else 1)
+            if read.is_unmapped:
+                continue
+            for start, end in read.get_blocks():
+                block_read.append(index)
+                block_start.append(start)
+                block_end.append(end)
+            if "N" in read.cigarstring:
+                position = read.reference_start
+                xs = read.get_tag("XS") if read.has_tag("XS") else None
+                strand = _XS_STRAND.get(xs, 0)
+                for op, length in read.cigartuples:
+                    if op == _INTRON_OP:
+                        intron_read.append(index)
+                        intron_start.append(position)
+                        intron_end.append(position + length)
+                        intron_strand.append(strand)
+                    if op in _REFERENCE_OPS:
+                        position += length
+        if not flag:
+            break
+        yield ReadBatch(references, *fields)
+    samfile.close()
+
+
+class Accumulator(object):
+    """
+    a metric calculated in the single pass over a BAM file of run_qc.
+    update is called with each ReadBatch and write with the output prefix
+    of the metric once all of the reads have been seen. prefix is the name
+    of the output directory, the same as the RSeQC wrapper for the metric,
+    and suffix that of the file write returns
+    """
+    __metaclass__ = abc.ABCMeta
+    prefix = None
+    suffix = None
+
+    def out_file(self, out_prefix):
+        return out_prefix + self.suffix
+
+    @abc.abstractmethod
+    def update(self, batch):
+        """adds the reads of a ReadBatch to the metric"""
+        return
+
+    @abc.abstractmethod
+    def write(self, out_prefix, pool=None):
+        """writes the metric and returns the output file"""
+        return
+
+
+class BamStat(Accumulator):
+    """
+    read mapping statistics in the format of RSeQC's bam_stat.py
+    """
+    prefix = "bam_stat"
+    suffix = ".txt"
+
+    def __init__(self, mapq_cut=30):
+        self.mapq_cut = mapq_cut
+        self.stats = OrderedDict((x, 0) for x in self.FIELDS)
+
+    FIELDS = ["total", "qc_failed", "duplicate", "non_primary", "unmapped",
+              "non_unique", "unique", "read1", "read2", "forward", "reverse",
+              "non_splice", "splice", "proper_pair",
+              "proper_pair_diff_chrom"]
+
+    def update(self, batch):
+        stats = self.stats
+        stats["total"] += len(batch)
+        # each read is only counted in the first category it falls into
+        left = np.ones(len(batch), dtype=bool)
+        for field, mask in [("qc_failed", batch.has_flag(FLAG_QC_FAIL)),
+                            ("duplicate", batch.has_flag(FLAG_DUPLICATE)),
+                            ("non_primary",
+                             batch.has_flag(FLAG_NOT_PRIMARY)),
+                            ("unmapped", batch.has_flag(FLAG_UNMAPPED)),
+                            ("non_unique", batch.mapq < self.mapq_cut)]:
+            stats[field] += np.sum(left & mask)
+            left &= ~mask
+        spliced = np.zeros(len(batch), dtype=bool)
+        spliced[batch.intron_read] = True
+        paired = batch.has_flag(FLAG_PAIRED)
+        proper = paired & batch.has_flag(FLAG_PROPER_PAIR)
+        stats["unique"] += np.sum(left)
+        stats["read1"] += np.sum(left & paired & batch.has_flag(FLAG_READ1))
+        stats["read2"] += np.sum(left & paired & batch.has_flag(FLAG_READ2))
+        stats["reverse"] += np.sum(left & batch.has_flag(FLAG_REVERSE))
+        stats["forward"] += np.sum(left & ~batch.has_flag(FLAG_REVERSE))
+        stats["splice"] += np.sum(left & spliced)
+        stats["non_splice"] += np.sum(left & ~spliced)
+        stats["proper_pair"] += np.sum(left & proper)
+        stats["proper_pair_diff_chrom"] += np.sum(
+            left & proper & (batch.tid != batch.mate_tid))
+
+    def write(self, out_prefix, pool=None):
+        out_file = out_prefix + ".txt"
+        stats = self.stats
+        lines = [("Total records:", stats["total"]), None,
+                 ("QC failed:", stats["qc_failed"]),
+                 ("Optical/PCR duplicate:", stats["duplicate"]),
+                 ("Non primary hits", stats["non_primary"]),
+                 ("Unmapped reads:", stats["unmapped"]),
+                 ("mapq < mapq_cut (non-unique):", stats["non_unique"]),
+                 None,
+                 ("mapq >= mapq_cut (unique):", stats["unique"]),
+                 ("Read-1:", stats["read1"]),
+                 ("Read-2:", stats["read2"]),
+                 ("Reads map to '+':", stats["forward"]),
+                 ("Reads map to '-':", stats["reverse"]),
+                 ("Non-splice reads:", stats["non_splice"]),
+                 ("Splice reads:", stats["splice"]),
+                 ("Reads mapped in proper pairs:", stats["proper_pair"]),
+                 ("Proper-paired reads map to different chrom:",
+                  stats["proper_pair_diff_chrom"])]
+        with file_transaction(out_file) as tx_out_file:
+            with open(tx_out_file, "w") as out_handle:
+                out_handle.write("\n#" + "=" * 50 + "\n")
+                out_handle.write("#All numbers are READ count\n")
+                out_handle.write("#" + "=" * 50 + "\n\n")
+                for line in lines:
+                    if line is None:
+                        out_handle.write("\n")
+                    else:
+                        out_handle.write("%-40s%d\n" % line)
+        return out_file
+
+
+class ReadCount(Accumulator):
+    """
+    tag counts and RPKM of each exon, intron and mRNA of the transcripts in
+    a BED12 file, written like the _read_count.xls file of RSeQC's
+    RPKM_count.py. each aligned block of a read is counted by its midpoint.
+    reads with more than one alignment (NH > 1) are skipped
+    """
+    prefix = "RPKM_count"
+    suffix = "_read_count.xls"
+
+    def __init__(self, bed_file):
+        self.exons = load_gene_models(bed_file)
+        self.introns = _introns(self.exons)
+        features = pd.concat([self.exons, self.introns], sort=False)
+        self._counter = PointCounter(features["chrom"].values,
+                                     features["start"].values,
+                                     features["end"].values)
+        self.total_reads = 0
+
+    def update(self, batch):
+        counted = batch.primary_mapped() & (batch.nh <= 1)
+        self.total_reads += np.sum(counted)
+        blocks = counted[batch.block_read]
+        starts = batch.block_start[blocks]
+        midpoints = starts + (batch.block_end[blocks] - starts) // 2
+        for chrom, points in batch.by_reference(batch.block_read[blocks],
+                                                midpoints):
+            self._counter.add(chrom, points)
+
+    def table(self):
+        counts = self._counter.counts()
+        exons = self.exons.copy()
+        exons["tag_count"] = counts[:len(exons)]
+        exons["accession"] = (exons["name"] + "_exon_" +
+                              exons["exon"].astype(str))
+        exons["order"] = 0
+        introns = self.introns.copy()
+        introns["tag_count"] = counts[len(exons):]
+        introns["accession"] = (introns["name"] + "_intron_" +
+                                introns["intron"].astype(str))
+        introns["order"] = 1
+        exons["length"] = exons["end"] - exons["start"]
+        mrna = exons.groupby("transcript").agg(
+            {"chrom": "first", "start": "min", "end": "max", "name": "first",
+             "strand": "first", "tag_count": "sum", "length": "sum"})
+        mrna["transcript"] = mrna.index
+        mrna["accession"] = mrna["name"] + "_mRNA"
+        mrna["order"] = 2
+        introns["length"] = introns["end"] - introns["start"]
+        table = pd.concat([exons, introns, mrna], ignore_index=True,
+                          sort=False)
+        table = table.sort_values(["transcript", "order", "start"],
+                                  kind="mergesort")
+        total = max(self.total_reads, 1)
+        table["RPKM"] = (table["tag_count"] * 1e9 /
+                         (table["length"] * float(total)))
+        table["score"] = 0
+        table = table.rename(columns={"chrom": "#chrom", "start": "st",
+                                      "strand": "gene_strand"})
+        return table[["#chrom", "st", "end", "accession", "score",
+                      "gene_strand", "tag_count", "RPKM"]]
+
+    def write(self, out_prefix, pool=None):
+        out_file = out_prefix + "_read_count.xls"
+        with file_transaction(out_file) as tx_out_file:
+            self.table().to_csv(tx_out_file, sep="\t", index=False)
+        return out_file
+
+
+class RPKMSaturation(Accumulator):
+    """
+    RPKM of each transcript in a BED12 file in random samples of 5% to
+    100% of the aligned blocks of the uniquely mapped reads, written like
+    the .eRPKM.xls and .rawCount.xls tables and the plot of RSeQC's
+    RPKM_saturation.py. the single pass over the BAM file only keeps the
+    segment of the gene models each block's midpoint falls into, as an
+    int32 array; the samples are growing slices of one shuffle of it
+    """
+    prefix = "RPKM_saturation"
+    suffix = ".saturation.pdf"
+    PERCENTS = range(5, 100, 5) + [100]
+
+    def __init__(self, bed_file, mapq_cut=30, rpkm_cut=0.01, seed=None):
+        self.exons = load_gene_models(bed_file)
+        self.mapq_cut = mapq_cut
+        self.rpkm_cut = rpkm_cut
+        self.seed = seed
+        self._counter = PointCounter(self.exons["chrom"].values,
+                                     self.exons["start"].values,
+                                     self.exons["end"].values)
+        self._blocks = []
+
+    def update(self, batch):
+        counted = batch.primary_mapped() & (batch.mapq >= self.mapq_cut)
+        blocks = counted[batch.block_read]
+        starts = batch.block_start[blocks]
+        midpoints = starts + (batch.block_end[blocks] - starts) // 2
+        for chrom, points in batch.by_reference(batch.block_read[blocks],
+                                                midpoints):
+            self._blocks.append(
+                self._counter.segments(chrom, points).astype(np.int32))
+
+    def counts(self):
+        """
+        the tag count of each transcript in each sample, one column per
+        percent of PERCENTS, and the number of blocks in each sample
+        """
+        if self._blocks:
+            blocks = np.concatenate(self._blocks)
+        else:
+            blocks = np.zeros(0, dtype=np.int32)
+        self._blocks = [blocks]
+        shuffled = blocks.copy()
+        np.random.RandomState(self.seed).shuffle(shuffled)
+        exons = self.exons
+        transcripts = exons["transcript"].values
+        segment_counts = np.zeros(len(self._counter), dtype=np.int64)
+        counts = np.zeros((transcripts.max() + 1 if len(transcripts) else 0,
+                           len(self.PERCENTS)), dtype=np.int64)
+        sizes = []
+        taken = 0
+        for i, percent in enumerate(self.PERCENTS):
+            end = int(len(shuffled) * (percent / 100.0))
+            sample = shuffled[taken:end]
+            segment_counts += np.bincount(sample[sample >= 0],
+                                          minlength=len(self._counter))
+            taken = end
+            counts[:, i] = np.bincount(
+                transcripts, weights=self._counter.counts(segment_counts),
+                minlength=len(counts))
+            sizes.append(len(shuffled) * (percent / 100.0))
+        return counts, np.array(sizes)
+
+    def tables(self):
+        """
+        the raw count and RPKM tables of the transcripts
+        """
+        counts, sizes = self.counts()
+        exons = self.exons.assign(length=self.exons["end"] -
+                                  self.exons["start"])
+        mrna = exons.groupby("transcript").agg(
+            {"chrom": "first", "start": "min", "end": "max", "name": "first",
+             "strand": "first", "length": "sum"})
+        mrna["score"] = 0
+        mrna = mrna.rename(columns={"chrom": "#chr"})
+        mrna = mrna[["#chr", "start", "end", "name", "score", "strand",
+                     "length"]]
+        columns = ["%d%%" % (x) for x in self.PERCENTS]
+        counts = counts[mrna.index.values]
+        with np.errstate(divide="ignore", invalid="ignore"):
+            rpkm = (counts * 1e9 / mrna["length"].values[:, np.newaxis] /
+                    sizes[np.newaxis, :])
+        rpkm[~np.isfinite(rpkm)] = 0
+        head = mrna.drop("length", axis=1).reset_index(drop=True)
+        raw = pd.concat([head, pd.DataFrame(counts, columns=columns)],
+                        axis=1)
+        erpkm = pd.concat([head, pd.DataFrame(rpkm, columns=columns)],
+                          axis=1)
+        return raw, erpkm
+
+    def write(self, out_prefix, pool=None):
+        raw, erpkm = self.tables()
+        for table, suffix in [(raw, ".rawCount.xls"), (erpkm, ".eRPKM.xls")]:
+            with file_transaction(out_prefix + suffix) as tx_out_file:
+                table.to_csv(tx_out_file, sep="\t", index=False)
+        plot_file = out_prefix + ".saturation.pdf"
+        script = _RPKM_saturation_script(erpkm.iloc[:, 6:].values,
+                                         self.PERCENTS, plot_file,
+                                         self.rpkm_cut)
+        with open(out_prefix + ".saturation.r", "w") as out_handle:
+            out_handle.write(script)
+        RJob()(script).run(pool)
+        return plot_file
+
+
+def _RPKM_saturation_script(rpkm, percents, plot_file, rpkm_cut=0.01):
+    """
+    R script of boxplots of the relative error of the RPKM of each sample
+    against the RPKM of all of the reads, one for each quartile of the
+    expression of the transcripts, as RSeQC's RPKM_saturation.py draws them
+    """
+    mean = rpkm.mean(axis=1)
+    final = rpkm[:, -1]
+    keep = ((rpkm.max(axis=1) > 0) & (np.ptp(rpkm, axis=1) > 0) &
+            (mean >= rpkm_cut) & (final > 0))
+    rpkm = rpkm[keep]
+    mean = mean[keep]
+    error = np.abs(rpkm - rpkm[:, -1:]) / rpkm[:, -1:]
+    error = error[np.argsort(mean, kind="mergesort")]
+    rank = np.arange(1, len(error) + 1)
+    names = ",".join(map(str, percents[:-1]))
+    lines = ["pdf('%s')" % (plot_file), "par(mfrow=c(2,2))"]
+    for quartile, (low, high) in enumerate([(0, 0.25), (0.25, 0.5),
+                                            (0.5, 0.75), (0.75, 1)], 1):
+        in_quartile = ((rank > len(error) * low) &
+                       (rank <= len(error) * high))
+        lines.append("name=c(%s)" % (names))
+        for i, percent in enumerate(percents[:-1]):
+            lines.append("S%d=c(%s)" % (percent, ",".join(
+                map(repr, error[in_quartile, i]))))
+        lines.append("boxplot(%s,names=name,outline=F,ylab='Percent "
+                     "Relative Error',main='Q%d',xlab='Resampling "
+                     "percentage')" % (",".join("100*S%d" % (x) for x in
+                                                percents[:-1]), quartile))
+    lines.append("dev.off()")
+    return "\n".join(lines) + "\n"
+
+
+class PointDepth(object):
+    """
+    the number of intervals covering each of a fixed set of points. the
+    intervals are added in batches; each batch is turned into changes in
+    depth at the sorted points with searchsorted, so only the points are
+    kept in memory
+    """
+
+    def __init__(self, chroms, points):
+        self._chroms = np.asarray(chroms)
+        self._points = np.asarray(points)
+        self._sorted = {}
+        self._changes = {}
+        for chrom in np.unique(self._chroms):
+            self._sorted[chrom] = np.unique(
+                self._points[self._chroms == chrom])
+            self._changes[chrom] = np.zeros(len(self._sorted[chrom]) + 1,
+                                            dtype=np.int64)
+
+    def add(self, chrom, starts, ends):
+        if chrom not in self._sorted:
+            return
+        points = self._sorted[chrom]
+        size = len(points) + 1
+        self._changes[chrom] += (
+            np.bincount(np.searchsorted(points, starts), minlength=size) -
+            np.bincount(np.searchsorted(points, ends), minlength=size))
+
+    def depths(self):
+        """
+        the depth at each point, in the order they were given
+        """
+        depths = np.zeros(len(self._points), dtype=np.int64)
+        for chrom, points in self._sorted.items():
+            on_chrom = self._chroms == chrom
+            depth = np.cumsum(self._changes[chrom][:-1])
+            depths[on_chrom] = depth[np.searchsorted(points,
+                                                     self._points[on_chrom])]
+        return depths
+
+
+def genebody_percentiles(exons, min_length=100):
+    """
+    the 100 percentile points along the exons of each transcript at least
+    min_length bases long, from the 5' to the 3' end, as RSeQC's
+    geneBody_coverage.py picks them. returns the transcripts and an array of
+    their points, one row per transcript
+    """
+    exons = exons.sort_values(["transcript", "start"])
+    lengths = (exons["end"] - exons["start"]).values
+    transcripts, first = np.unique(exons["transcript"].values,
+                                   return_index=True)
+    # each exon's offset into the transcripts laid end to end
+    offsets = np.cumsum(lengths) - lengths
+    transcript_lengths = np.add.reduceat(lengths, first)
+    long_enough = transcript_lengths >= min_length
+    transcripts = transcripts[long_enough]
+    first = first[long_enough]
+    transcript_lengths = transcript_lengths[long_enough]
+
+    index = ((transcript_lengths[:, np.newaxis] - 1) *
+             np.arange(1, 101)[np.newaxis, :] / 100.0)
+    floor = np.floor(index)
+    ceil = np.ceil(index)
+
+    def base(i):
+        # 1-based position of exonic base i of each transcript
+        position = offsets[first][:, np.newaxis] + i.astype(np.int64)
+        exon = np.searchsorted(offsets, position, side="right") - 1
+        return exons["start"].values[exon] + position - offsets[exon] + 1
+
+    low = base(floor)
+    high = base(ceil)
+    interpolated = low * (ceil - index) + high * (index - floor)
+    points = np.where(floor == ceil, low,
+                      np.floor(interpolated + 0.5).astype(np.int64))
+    minus = exons["strand"].values[first] == "-"
+    points[minus] = points[minus][:, ::-1]
+    return transcripts, points - 1
+
+
+class GeneBodyCoverage(Accumulator):
+    """
+    read coverage at 100 percentile points along the exons of every
+    transcript in a BED12 file, summed over the transcripts. the output is
+    the .geneBodyCoverage.txt table and plot of RSeQC's geneBody_coverage.py
+    """
+    prefix = "coverage"
+    suffix = ".geneBodyCoverage.pdf"
+
+    def __init__(self, bed_file, chroms=None):
+        exons = load_gene_models(bed_file)
+        if chroms is not None:
+            exons = exons[exons["chrom"].isin(chroms)]
+        transcripts, points = genebody_percentiles(exons)
+        chrom = exons.drop_duplicates("transcript").set_index(
+            "transcript")["chrom"].reindex(transcripts).values
+        self._depth = PointDepth(np.repeat(chrom, 100), points.ravel())
+        self.total_reads = 0
+
+    def update(self, batch):
+        counted = batch.primary_mapped()
+        self.total_reads += np.sum(counted)
+        blocks = counted[batch.block_read]
+        for chrom, starts, ends in batch.by_reference(
+                batch.block_read[blocks], batch.block_start[blocks],
+                batch.block_end[blocks]):
+            self._depth.add(chrom, starts, ends)
+
+    def profile(self):
+        return self._depth.depths().reshape(-1, 100).sum(axis=0)
+
+    def write(self, out_prefix, pool=None):
+        return _write_genebody_coverage(self.profile(), self.total_reads,
+                                        out_prefix, pool)
+
+
+def _write_genebody_coverage(profile, total_reads, out_prefix, pool=None):
+    """
+    writes the gene body coverage table and plots it with R
+    """
+    table_file = out_prefix + ".geneBodyCoverage.txt"
+    script_file = out_prefix + ".geneBodyCoverage_plot.r"
+    plot_file = out_prefix + ".geneBodyCoverage.pdf"
+    with file_transaction(table_file) as tx_table_file:
+        with open(tx_table_file, "w") as out_handle:
+            out_handle.write("Total reads: %d\n" % (total_reads))
+            out_handle.write("percentile\tcount\n")
+            for percentile, count in enumerate(profile, 1):
+                out_handle.write("%d\t%d\n" % (percentile, count))
+    script = ('pdf("%s")\n'
+              "x=1:100\n"
+              "y=c(%s)\n"
+              "plot(x,y,xlab=\"percentile of gene body (5'->3')\","
+              "ylab='read number',type='s')\n"
+              "dev.off()\n" % (plot_file, ",".join(map(str, profile))))
+    with open(script_file, "w") as out_handle:
+        out_handle.write(script)
+    RJob()(script).run(pool)
+    return plot_file
+
+
+def _chrom_genebody_coverage(args):
+    in_file, bed_file, chrom = args
+    coverage = GeneBodyCoverage(bed_file, [chrom])
+    walk_bam(in_file, [coverage], region=chrom)
+    return coverage.profile(), coverage.total_reads
+
+
+# one row per splice junction: the reference id, the intron (0-based, half
+# open), the strand from the XS tags (0 if unknown or conflicting) and the
+# number of reads splicing across it
+JUNCTION_DTYPE = np.dtype([("tid", np.int32), ("start", np.int64),
+                           ("end", np.int64), ("strand", np.int8),
+                           ("count", np.int64)])
+_STRAND_NAMES = {1: "+", -1: "-", 0: "."}
+# parts of a JunctionCatalogue merged into one array at a time
+_JUNCTION_PARTS = 32
+
+
+def _merge_junctions(junctions):
+    """
+    sums the counts of the rows of a junction array with the same intron
+    """
+    if not len(junctions):
+        return junctions
+    junctions = junctions[np.lexsort((junctions["end"], junctions["start"],
+                                      junctions["tid"]))]
+    new = np.ones(len(junctions), dtype=bool)
+    new[1:] = ((np.diff(junctions["tid"]) != 0) |
+               (np.diff(junctions["start"]) != 0) |
+               (np.diff(junctions["end"]) != 0))
+    groups = np.flatnonzero(new)
+    merged = junctions[groups]
+    merged["count"] = np.add.reduceat(junctions["count"], groups)
+    # reads without an XS tag don't decide the strand
+    strand = junctions["strand"].astype(np.int64)
+    low = np.minimum.reduceat(np.where(strand == 0, 1, strand), groups)
+    high = np.maximum.reduceat(np.where(strand == 0, -1, strand), groups)
+    merged["strand"] = np.where(low == high, low, 0)
+    return merged
+
+
+class JunctionCatalogue(Accumulator):
+    """
+    the splice junctions (N operations) of the uniquely mapped reads, kept
+    as a JUNCTION_DTYPE array with one row per junction. introns shorter
+    than min_intron are skipped, like RSeQC's junction scripts do
+    """
+
+    def __init__(self, mapq_cut=30, min_intron=50):
+        self.mapq_cut = mapq_cut
+        self.min_intron = min_intron
+        self.references = None
+        self._parts = []
+
+    def update(self, batch):
+        self.references = batch.references
+        counted = batch.primary_mapped() & (batch.mapq >= self.mapq_cut)
+        introns = (counted[batch.intron_read] &
+                   (batch.intron_end - batch.intron_start >=
+                    self.min_intron))
+        events = np.zeros(np.sum(introns), dtype=JUNCTION_DTYPE)
+        events["tid"] = batch.tid[batch.intron_read[introns]]
+        events["start"] = batch.intron_start[introns]
+        events["end"] = batch.intron_end[introns]
+        events["strand"] = batch.intron_strand[introns]
+        events["count"] = 1
+        self._parts.append(_merge_junctions(events))
+        if len(self._parts) >= _JUNCTION_PARTS:
+            self._parts = [_merge_junctions(np.concatenate(self._parts))]
+
+    def catalogue(self):
+        """
+        the junctions as a JUNCTION_DTYPE array sorted by position
+        """
+        if not self._parts:
+            return np.zeros(0, dtype=JUNCTION_DTYPE)
+        self._parts = [_merge_junctions(np.concatenate(self._parts))]
+        return self._parts[0]
+
+    def junctions(self):
+        """
+        the junctions as a dataframe with chrom, start, end, strand and
+        count columns
+        """
+        catalogue = self.catalogue()
+        references = np.array(self.references or [], dtype=object)
+        return pd.DataFrame({"chrom": references[catalogue["tid"]],
+                             "start": catalogue["start"],
+                             "end": catalogue["end"],
+                             "strand": [_STRAND_NAMES[x] for x in
+                                        catalogue["strand"]],
+                             "count": catalogue["count"]},
+                            columns=["chrom", "start", "end", "strand",
+                                     "count"])
+
+
+def _in_sites(sites, columns):
+    """
+    True for each row of the arrays in columns that is also a row of the
+    arrays in sites. the arrays are factorized together and each row is
+    turned into one integer key, which np.in1d looks up by sorting
+    """
+    n_sites = len(sites[0])
+    keys = np.zeros(n_sites + len(columns[0]), dtype=np.int64)
+    for site, column in zip(sites, columns):
+        codes, uniques = pd.factorize(np.concatenate([np.asarray(site),
+                                                      np.asarray(column)]))
+        # factorize again so the keys stay below the number of rows
+        keys = pd.factorize(keys * len(uniques) + codes)[0]
+    return np.in1d(keys[n_sites:], keys[:n_sites])
+
+
+def annotate_junctions(junctions, introns):
+    """
+    labels each junction annotated if both its donor and acceptor are
+    splice sites of the introns of the gene models, partial_novel if one
+    of them is and complete_novel if neither is, as RSeQC's
+    junction_annotation.py does
+    """
+    known_start = _in_sites([introns["chrom"], introns["start"]],
+                            [junctions["chrom"], junctions["start"]])
+    known_end = _in_sites([introns["chrom"], introns["end"]],
+                          [junctions["chrom"], junctions["end"]])
+    return np.where(known_start & known_end, "annotated",
+                    np.where(known_start | known_end, "partial_novel",
+                             "complete_novel"))
+
+
+def _pie(name, counts, title):
+    total = float(max(sum(counts), 1))
+    percents = [x * 100.0 / total for x in counts]
+    return ("%s=c(%s)\n"
+            'pie(%s,col=c(2,3,4),init.angle=30,angle=c(60,120,150),'
+            'density=c(70,70,70),main="%s",labels=c("partial_novel %d%%",'
+            '"complete_novel %d%%","known %d%%"))\n'
+            % ((name, ",".join(map(str, percents)), name, title) +
+               tuple(round(x) for x in percents)))
+
+
+class JunctionAnnotation(JunctionCatalogue):
+    """
+    known and novel splice junctions, written like the output of RSeQC's
+    junction_annotation.py: the .junction.xls table, a .junction.bed
+    track and pie charts of the splicing events and junctions
+    """
+    prefix = "junction"
+    suffix = ".splice_junction.pdf"
+    CLASSES = ["partial_novel", "complete_novel", "annotated"]
+
+    def __init__(self, bed_file, mapq_cut=30, min_intron=50):
+        super(JunctionAnnotation, self).__init__(mapq_cut, min_intron)
+        self.introns = _introns(load_gene_models(bed_file))
+
+    def table(self):
+        junctions = self.junctions()
+        junctions["annotation"] = annotate_junctions(junctions,
+                                                     self.introns)
+        return junctions
+
+    def write(self, out_prefix, pool=None):
+        table = self.table()
+        xls_file = out_prefix + ".junction.xls"
+        with file_transaction(xls_file) as tx_xls_file:
+            table.rename(columns={"start": "intron_st(0-based)",
+                                  "end": "intron_end(1-based)",
+                                  "count": "read_count"}).to_csv(
+                tx_xls_file, sep="\t", index=False,
+                columns=["chrom", "intron_st(0-based)",
+                         "intron_end(1-based)", "read_count",
+                         "annotation"])
+        _write_junction_bed(table, out_prefix + ".junction.bed")
+
+        events = [table["count"][table["annotation"] == x].sum()
+                  for x in self.CLASSES]
+        junctions = [np.sum(table["annotation"] == x) for x in self.CLASSES]
+        logger.info("%d splicing events and %d splice junctions, of which "
+                    "%d annotated, %d partial novel and %d novel."
+                    % ((sum(events), len(table), junctions[2], junctions[0],
+                        junctions[1])))
+        plot_file = out_prefix + ".splice_junction.pdf"
+        script = ('pdf("%s")\n' % (out_prefix + ".splice_events.pdf") +
+                  _pie("events", events, "splicing events") +
+                  "dev.off()\n" +
+                  'pdf("%s")\n' % (plot_file) +
+                  _pie("junction", junctions, "splicing junctions") +
+                  "dev.off()\n")
+        with open(out_prefix + ".junction_plot.r", "w") as out_handle:
+            out_handle.write(script)
+        RJob()(script).run(pool)
+        return plot_file
+
+
+def _write_junction_bed(table, out_file, size=10):
+    """
+    the junctions as BED12 with a block of size bases on each side of the
+    intron, colored by annotation
+    """
+    colors = {"annotated": "205,0,0", "partial_novel": "0,205,0",
+              "complete_novel": "0,0,205"}
+    with file_transaction(out_file) as tx_out_file:
+        with open(tx_out_file, "w") as out_handle:
+            for row in table.itertuples(index=False):
+                start = row.start - size
+                end = row.end + size
+                out_handle.write("\t".join(map(str, [
+                    row.chrom, start, end, row.annotation, row.count,
+                    row.strand, start, end, colors[row.annotation], 2,
+                    "%d,%d" % (size, size), "0,%d" % (end - size - start)]))
+                    + "\n")
+    return out_file
+
+
+def saturation_curves(catalogue, known, percents, recur=1, seed=None):
+    """
+    the number of all, known and novel junctions seen in growing random
+    samples of the splicing reads of a junction catalogue, as RSeQC's
+    junction_saturation.py counts them. known is a boolean array marking
+    the annotated junctions of the catalogue. the reads are shuffled once
+    as an array of junction numbers and each sample extends the last one,
+    so the BAM file is not read again. known junctions need at least recur
+    reads to be counted
+    """
+    reads = np.repeat(np.arange(len(catalogue), dtype=np.int32),
+                      catalogue["count"])
+    np.random.RandomState(seed).shuffle(reads)
+    seen = np.zeros(len(catalogue), dtype=np.int64)
+    curves = {"all": [], "known": [], "novel": []}
+    taken = 0
+    for percent in percents:
+        end = int(len(reads) * (percent / 100.0))
+        seen += np.bincount(reads[taken:end], minlength=len(catalogue))
+        taken = end
+        curves["all"].append(np.sum(seen > 0))
+        curves["known"].append(np.sum(known & (seen >= recur)))
+        curves["novel"].append(np.sum(~known & (seen > 0)))
+    return curves
+
+
+class JunctionSaturation(JunctionCatalogue):
+    """
+    saturation curves of the junctions detected in 5% to 100% of the
+    splicing reads, plotted like RSeQC's junction_saturation.py. only the
+    chromosomes of the gene models are used
+    """
+    prefix = "saturation"
+    suffix = ".junctionSaturation_plot.pdf"
+    PERCENTS = range(5, 100, 5) + [100]
+
+    def __init__(self, bed_file, mapq_cut=30, min_intron=50, recur=1,
+                 seed=None):
+        super(JunctionSaturation, self).__init__(mapq_cut, min_intron)
+        exons = load_gene_models(bed_file)
+        self.introns = _introns(exons)
+        self.chroms = set(exons["chrom"])
+        self.recur = recur
+        self.seed = seed
+
+    def curves(self):
+        catalogue = self.catalogue()
+        junctions = self.junctions()
+        on_genes = junctions["chrom"].isin(self.chroms).values
+        known = _in_sites([self.introns["chrom"], self.introns["start"],
+                           self.introns["end"]],
+                          [junctions["chrom"], junctions["start"],
+                           junctions["end"]])
+        return saturation_curves(catalogue[on_genes], known[on_genes],
+                                 self.PERCENTS, self.recur, self.seed)
+
+    def write(self, out_prefix, pool=None):
+        curves = self.curves()
+        plot_file = out_prefix + ".junctionSaturation_plot.pdf"
+        last = dict((x, y[-1] // 1000) for x, y in curves.items())
+        first = dict((x, y[0] // 1000) for x, y in curves.items())
+        script = ("pdf('%s')\n" % (plot_file) +
+                  "x=c(%s)\n" % (",".join(map(str, self.PERCENTS))) +
+                  "y=c(%s)\n" % (",".join(map(str, curves["known"]))) +
+                  "z=c(%s)\n" % (",".join(map(str, curves["all"]))) +
+                  "w=c(%s)\n" % (",".join(map(str, curves["novel"]))) +
+                  "m=max(%d,%d,%d)\n" % (last["known"], last["all"],
+                                         last["novel"]) +
+                  "n=min(%d,%d,%d)\n" % (first["known"], first["all"],
+                                         first["novel"]) +
+                  "plot(x,z/1000,xlab='percent of total reads',"
+                  "ylab='Number of splicing junctions (x1000)',type='o',"
+                  "col='blue',ylim=c(n,m))\n"
+                  "points(x,y/1000,type='o',col='red')\n"
+                  "points(x,w/1000,type='o',col='green')\n"
+                  'legend(5,%d, legend=c("All junctions","known junctions",'
+                  ' "novel junctions"),col=c("blue","red","green"),lwd=1,'
+                  "pch=1)\n" % (last["all"]) +
+                  "dev.off()\n")
+        with open(out_prefix + ".junctionSaturation_plot.r",
+                  "w") as out_handle:
+            out_handle.write(script)
+        RJob()(script).run(pool)
+        return plot_file
+
+
+def walk_bam(in_file, accumulators, batch_size=DEFAULT_BATCH_SIZE,
+             region=None):
+    """
+    reads in_file once, updating each of the accumulators with every batch
+    of reads
+    """
+    for batch in _read_batches(in_file, batch_size, region):
+        for accumulator in accumulators:
+            accumulator.update(batch)
+    return accumulators
+
+
+def _mapq_cut(config):
+    stage_config = config.get("stage", {}).get("rseqc", {}) or {}
+    return stage_config.get("mapq_cut", 30)
+
+
+def _min_intron(config):
+    stage_config = config.get("stage", {}).get("rseqc", {}) or {}
+    return stage_config.get("min_intron", 50)
+
+
+def _default_accumulators(config):
+    bed = _get_bed(config)
+    mapq_cut = _mapq_cut(config)
+    min_intron = _min_intron(config)
+    return [BamStat(mapq_cut), ReadCount(bed), GeneBodyCoverage(bed),
+            JunctionAnnotation(bed, mapq_cut, min_intron),
+            JunctionSaturation(bed, mapq_cut, min_intron),
+            RPKMSaturation(bed, mapq_cut)]
+
+
+def run_qc(in_file, config, accumulators=None, pool=None):
+    """
+    calculates the RSeQC metrics of in_file in a single pass over the
+    reads and writes each metric where the RSeQC wrapper for the metric
+    would, so RseqcParser picks them up. the plots are made on pool, by
+    default the shared R pool. metrics with output already are skipped.
+    returns a dictionary of metric prefix to output file
+    """
+    if accumulators is None:
+        accumulators = _default_accumulators(config)
+    out_prefixes = dict((x.prefix, _get_out_prefix(in_file, config, None,
+                                                    x.prefix))
+                        for x in accumulators)
+    out_files = dict((x.prefix, x.out_file(out_prefixes[x.prefix]))
+                     for x in accumulators)
+    # only the metrics without output yet are calculated
+    missing = [x for x in accumulators
+               if not file_exists(out_files[x.prefix])]
+    if not missing:
+        return out_files
+    logger.info("Calculating %s of %s in one pass."
+                % (", ".join(x.prefix for x in missing), in_file))
+    walk_bam(in_file, missing)
+    for x in missing:
+        out_files[x.prefix] = x.write(out_prefixes[x.prefix], pool)
+    return out_files
+
+
 class RseqcParser(object):
     """
     parse a directory full of rseqc results
@@ -429,7 +1673,8 @@ class RseqcParser(object):
               (os.path.join("clipping", "clipping.pdf"), "", 1.0),
               (os.path.join("coverage", "coverage.geneBodyCoverage.pdf"),
                "", 1.0),
-              (os.path.join("saturation", "junction_saturation.pdf"),
+              (os.path.join("saturation",
+                            "saturation.junctionSaturation_plot.pdf"),
                "", 1.0),
               (os.path.join("junction", "junction.splice_junction.pdf"),
                "", 1.0))
@@ -455,7 +1700,7 @@ class RseqcReport(LatexReport):
                 "coverage.geneBodyCoverage.pdf": "",
                 "clipping.pdf": "",
                 "coverage.pdf": "",
-                "junction_saturation.pdf": "",
+                "saturation.junctionSaturation_plot.pdf": "",
                 "splice_events.pdf": ""}
 
     def __init__(self):
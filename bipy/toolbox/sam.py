@@ -221,9 +221,10 @@ class Disambiguate(AbstractStage):
         assigned_name = append_stem(in_file, "unique")
         ambiguous_name = append_stem(in_file, "ambiguous")
 
-        in_handle = pysam.Samfile(in_file, "rb")
-        assigned = pysam.Samfile(assigned_name, "wb", template=in_handle)
-        ambiguous = pysam.Samfile(ambiguous_name, "wb", template=in_handle)
+        in_handle = pysam.AlignmentFile(in_file, "rb")
+        assigned = pysam.AlignmentFile(assigned_name, "wb", template=in_handle)
+        ambiguous = pysam.AlignmentFile(ambiguous_name, "wb",
+                                        template=in_handle)
 
         return (in_handle, assigned, ambiguous)
 
@@ -250,10 +251,10 @@ class Disambiguate(AbstractStage):
                 self._dump_rest(handles_0, read0)
                 return True
 
-        if read0.qname < read1.qname:
+        if read0.query_name < read1.query_name:
             assigned0.write(read0)
             read0 = None
-        elif read1.qname < read0.qname:
+        elif read1.query_name < read0.query_name:
             assigned1.write(read1)
             read1 = None
         else:
@@ -271,9 +272,9 @@ class Disambiguate(AbstractStage):
         self._process_reads(handles_0, handles_1, read0, read1)
 
     def _score_read_pair(self, read0, read1):
-        if (read0.mapq - read1.mapq) > self.cutoff:
+        if (read0.mapping_quality - read1.mapping_quality) > self.cutoff:
             return 1
-        elif (read1.mapq - read0.mapq) > self.cutoff:
+        elif (read1.mapping_quality - read0.mapping_quality) > self.cutoff:
             return -1
         else:
             return 0
@@ -130,10 +130,8 @@ def main(config_file, view):
             view.map(disambiguate, curr_files)
 
         if stage == "htseq-count":
-            logger.info("Running htseq-count on %s." % (bamfiles))
-            name_sorted = view.map(sam.bam_name_sort, bamfiles)
-            curr_files = view.map(sam.bam2sam, name_sorted)
-            htseq_args = zip(*product(curr_files, [config], [stage]))
+            logger.info("Running htseq-count on %s." % (final_bamfiles))
+            htseq_args = zip(*product(final_bamfiles, [config], [stage]))
             htseq_outputs = view.map(htseq_count.run_with_config,
                                      *htseq_args)
             htseq_count.combine_counts(htseq_outputs)
@@ -153,15 +151,11 @@ def main(config_file, view):
             logger.info("Running rseqc on %s." % (curr_files))
             #rseq_args = zip(*product(curr_files, [config]))
             rseq_args = zip(*product(final_bamfiles, [config]))
-            view.map(rseqc.bam_stat, *rseq_args)
-            down_args = zip(*product(final_bamfiles, [40000000]))
-            down_bam = view.map(sam.downsample_bam, *down_args)
-            view.map(rseqc.genebody_coverage, down_bam,
-                     [config] * len(down_bam))
-            view.map(rseqc.junction_annotation, *rseq_args)
-            view.map(rseqc.junction_saturation, *rseq_args)
-            RPKM_args = zip(*product(final_bamfiles, [config]))
-            RPKM_count_out = view.map(rseqc.RPKM_count, *RPKM_args)
+            # bam_stat, RPKM_count, the gene body coverage, the splice
+            # junctions and the RPKM saturation of the full BAM files are
+            # calculated in one pass
+            qc_out = view.map(rseqc.run_qc, *rseq_args)
+            RPKM_count_out = [x["RPKM_count"] for x in qc_out]
             RPKM_count_fixed = view.map(rseqc.fix_RPKM_count_file,
                                         RPKM_count_out)
             """
@@ -172,7 +166,6 @@ def main(config_file, view):
             view.map(annotate.annotate_table_with_biomart,
                      *annotate_args)
                      """
-            view.map(rseqc.RPKM_saturation, *rseq_args)
             curr_files = tophat_outputs
 
 if __name__ == "__main__":
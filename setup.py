@@ -21,6 +21,6 @@ setup(name="bipy",
           "cutadapt >= 1.2.1",
           "pandas >= 0.1.0",
           "HTSeq >= 0.5.3p9",
-          "pysam == 0.7",
+          "pysam >= 0.15.0",
           "sh >= 1.0.8",
           "ipython-cluster-helper"])
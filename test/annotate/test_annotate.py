@@ -0,0 +1,136 @@
+from bipy.toolbox import annotate
+from bipy.toolbox.rpool import RError
+from bcbio.utils import safe_makedir, file_exists
+import pandas as pd
+import os
+import shutil
+import unittest
+from multiprocessing import Pool
+
+STAGENAME = "annotate"
+
+
+def _add_gene(args):
+    store_dir, i = args
+    table = pd.DataFrame({"mgi_symbol": ["gene%d" % (i)]},
+                         index=["id%d" % (i)])
+    annotate.add_to_store(table, "mouse", "ensembl_gene_id", store_dir)
+
+
+class FailingPool(object):
+    """ a pool whose R jobs fail, like one without biomaRt """
+
+    def __init__(self):
+        self.queried = []
+
+    def run(self, job, returns=None):
+        assigned = dict(step[1:] for step in job.steps
+                        if step[0] == "assign")
+        with open(assigned["ids_file"]) as in_handle:
+            self.queried.append(set(in_handle.read().split()))
+        raise RError("there is no package called 'biomaRt'")
+
+
+class EmptyBiomartPool(object):
+    """ a pool standing in for a BioMart that knows none of the ids """
+
+    def __init__(self):
+        self.jobs = 0
+
+    def run(self, job, returns=None):
+        self.jobs += 1
+        assigned = dict(step[1:] for step in job.steps
+                        if step[0] == "assign")
+        with open(assigned["fetched_file"], "w") as out_handle:
+            out_handle.write("%s\tmgi_symbol\tdescription\n"
+                             % (assigned["filter_type"]))
+
+
+class TestAnnotate(unittest.TestCase):
+
+    def setUp(self):
+        self.gtf_file = "test/data/E_coli_k12.ASM584v1.15.gtf"
+        self.out_dir = os.path.join("results", STAGENAME)
+        self.store_dir = os.path.join(self.out_dir, "store")
+        safe_makedir(self.out_dir)
+        self.in_file = os.path.join(self.out_dir, "genes.txt")
+        pd.DataFrame({"id": ["EBESCG00000000900", "unknown"],
+                      "count": [10, 20]},
+                     columns=["id", "count"]).to_csv(self.in_file, sep="\t",
+                                                     index=False)
+
+    def test_annotate_from_gtf(self):
+        annotate.build_store_from_gtf(self.gtf_file, "mouse", self.store_dir)
+        out_file = annotate.annotate_table(self.in_file, "id",
+                                           "ensembl_gene_id", "mouse",
+                                           store_dir=self.store_dir,
+                                           fetch=False)
+        self.assertTrue(file_exists(out_file))
+        annotated = pd.read_csv(out_file, sep="\t", index_col=0)
+        self.assertEquals(annotated["mgi_symbol"]["EBESCG00000000900"],
+                          "thrL")
+        self.assertTrue(pd.isnull(annotated["mgi_symbol"]["unknown"]))
+
+    def test_import_biomart_dump(self):
+        dump_file = os.path.join(self.out_dir, "dump.txt")
+        with open(dump_file, "w") as out_handle:
+            out_handle.write("ensembl_gene_id\tmgi_symbol\tdescription\n")
+            out_handle.write("unknown\tUnk\tnot so unknown\n")
+        annotate.import_biomart_dump(dump_file, "mouse", "ensembl_gene_id",
+                                     self.store_dir)
+        store = annotate.load_store("mouse", "ensembl_gene_id",
+                                    self.store_dir)
+        self.assertEquals(store["description"]["unknown"], "not so unknown")
+
+    def test_add_to_store_concurrently(self):
+        pool = Pool(4)
+        try:
+            pool.map(_add_gene, [(self.store_dir, i) for i in range(20)])
+        finally:
+            pool.close()
+            pool.join()
+        store = annotate.load_store("mouse", "ensembl_gene_id",
+                                    self.store_dir)
+        self.assertEquals(sorted(store.index),
+                          sorted("id%d" % (i) for i in range(20)))
+
+    def test_gtf_without_gene_name(self):
+        gtf_file = os.path.join(self.out_dir, "no_gene_name.gtf")
+        with open(gtf_file, "w") as out_handle:
+            out_handle.write('Chromosome\tprotein_coding\texon\t190\t255\t.'
+                             '\t+\t.\tgene_id "EBESCG00000000900"; '
+                             'transcript_id "EBESCT00000001087";\n')
+        annotate.build_store_from_gtf(gtf_file, "mouse", self.store_dir)
+        pool = FailingPool()
+        out_file = annotate.annotate_table(self.in_file, "id",
+                                           "ensembl_gene_id", "mouse",
+                                           store_dir=self.store_dir,
+                                           pool=pool)
+        # the id without a symbol is looked up, and the failed lookup
+        # still leaves every row in the output
+        self.assertEquals(pool.queried,
+                          [set(["EBESCG00000000900", "unknown"])])
+        annotated = pd.read_csv(out_file, sep="\t", index_col=0)
+        self.assertEquals(list(annotated.index),
+                          ["EBESCG00000000900", "unknown"])
+        self.assertTrue(annotated["mgi_symbol"].isnull().all())
+
+    def test_unknown_ids_fetched_once(self):
+        pool = EmptyBiomartPool()
+        for out_file in ["first.txt", "second.txt"]:
+            annotate.annotate_table(self.in_file, "id", "ensembl_gene_id",
+                                    "mouse",
+                                    out_file=os.path.join(self.out_dir,
+                                                          out_file),
+                                    store_dir=self.store_dir, pool=pool)
+        self.assertEquals(pool.jobs, 1)
+        self.assertEquals(annotate.load_unknown("mouse", "ensembl_gene_id",
+                                                self.store_dir),
+                          set(["EBESCG00000000900", "unknown"]))
+
+    def tearDown(self):
+        shutil.rmtree(self.out_dir)
+
+if __name__ == "__main__":
+    suite = unittest.TestLoader().loadTestsFromTestCase(TestAnnotate)
+    unittest.TextTestRunner(verbosity=2).run(suite)
@@ -1,4 +1,5 @@
 from bipy.toolbox import bedtools
+from bipy.toolbox.intervals import Intervals
 from bipy.utils import replace_suffix
 from bcbio.utils import safe_makedir
 import os
@@ -10,6 +11,12 @@ class TestBedtools(unittest.TestCase):
     def setUp(self):
         self.bam_file = "test/data/s_1_1_10k.bam"
         self.gtf = "test/data/E_coli_k12.ASM584v1.15.gtf"
+        self.bed_files = ["test/data/a.bed", "test/data/b.bed",
+                          "test/data/c.bed"]
+
+    def _read(self, in_file):
+        with open(in_file) as in_handle:
+            return [line.rstrip("\n").split("\t") for line in in_handle]
 
     def test_count_overlap(self):
         out_dir = "results/count_overlaps"
@@ -19,16 +26,87 @@ class TestBedtools(unittest.TestCase):
         out_file = bedtools.count_overlaps(self.bam_file, self.gtf,
                                            out_file)
         self.assertTrue(os.path.exists(out_file))
+        for fields in self._read(out_file):
+            count, covered, length = map(int, fields[9:12])
+            self.assertEquals(length, int(fields[4]) - int(fields[3]) + 1)
+            self.assertTrue(covered <= length)
+            self.assertEquals(count == 0, covered == 0)
+
+    def test_count_overlaps_indexed(self):
+        out_dir = "results/count_overlaps"
+        safe_makedir(out_dir)
+        bam_file = "test/data/mouse_chr17.sorted.bam"
+        bed_file = "test/data/mouse_chr17.bed"
+        out_file = bedtools.count_overlaps(
+            bam_file, bed_file, os.path.join(out_dir, "indexed.counts"),
+            cores=2)
+        counts = [map(int, x[-4:-1]) for x in self._read(out_file)]
+        features = Intervals.from_file(bed_file)
+        streamed = bedtools._stream_coverage(bam_file, features)
+        self.assertEquals([x[0] for x in counts], list(streamed[0]))
+        self.assertEquals([x[1] for x in counts], list(streamed[1]))
 
     def test_multi_intersect(self):
         out_dir = "results/multi_intersect"
         safe_makedir(out_dir)
         out_file = os.path.join(out_dir, "multi_intersect_test.bed")
-        bed_files = ["test/data/a.bed", "test/data/b.bed", "test/data/c.bed"]
         options = ["-header", "-cluster"]
-        out_file = bedtools.multi_intersect(bed_files, options, out_file)
+        out_file = bedtools.multi_intersect(self.bed_files, options,
+                                            out_file)
 
         self.assertTrue(os.path.exists(out_file))
+        self.assertEquals(self._read(out_file),
+                          [["chrom", "start", "end", "num", "list"] +
+                           self.bed_files,
+                           ["chr1", "9", "10", "2", "1,2", "1", "1", "0"],
+                           ["chr1", "13", "14", "3", "1,2,3", "1", "1", "1"],
+                           ["chr1", "16", "17", "2", "1,2", "1", "1", "0"]])
+
+    def test_multi_intersect_pieces(self):
+        out_dir = "results/multi_intersect"
+        safe_makedir(out_dir)
+        out_file = os.path.join(out_dir, "multi_intersect_pieces.bed")
+        out_file = bedtools.multi_intersect(self.bed_files[:2],
+                                            out_file=out_file)
+        self.assertEquals([x[:5] for x in self._read(out_file)],
+                          [["chr1", "1", "9", "1", "1"],
+                           ["chr1", "9", "10", "2", "1,2"],
+                           ["chr1", "11", "12", "1", "1"],
+                           ["chr1", "12", "15", "2", "1,2"],
+                           ["chr1", "15", "16", "1", "1"],
+                           ["chr1", "16", "17", "2", "1,2"],
+                           ["chr1", "17", "18", "1", "1"]])
+
+    def test_intersect(self):
+        out_dir = "results/intersect"
+        safe_makedir(out_dir)
+        out_file = bedtools.intersect(self.bed_files[:2], out_file=
+                                      os.path.join(out_dir, "intersect.bed"))
+        self.assertEquals(self._read(out_file),
+                          [["chr1", "9", "10", "A1"],
+                           ["chr1", "12", "15", "A2"],
+                           ["chr1", "16", "17", "A2"]])
+        out_file = bedtools.intersect(self.bed_files[1:], ["-u"],
+                                      os.path.join(out_dir, "u.bed"))
+        self.assertEquals(self._read(out_file), [["chr1", "12", "15", "B2"]])
+        out_file = bedtools.intersect(self.bed_files[1:], ["-v"],
+                                      os.path.join(out_dir, "v.bed"))
+        self.assertEquals(self._read(out_file), [["chr1", "9", "10", "B1"],
+                                                 ["chr1", "16", "17", "B3"]])
+
+    def test_overlap_pairs(self):
+        # one interval spanning the chromosome among short ones
+        starts = [0] + range(0, 1000, 10)
+        ends = [1000] + range(5, 1005, 10)
+        other = Intervals(["chr1"] * len(starts), starts, ends)
+        features = Intervals(["chr1", "chr1", "chr2"], [498, 3, 0],
+                             [512, 4, 10])
+        pairs = features.overlap_pairs(other)
+        self.assertEquals(zip(*[list(x) for x in pairs]),
+                          [(0, 0), (0, 51), (0, 52), (1, 1), (1, 0)])
+
+    def test_intersect_needs_two_files(self):
+        self.assertRaises(ValueError, bedtools.intersect, self.bed_files)
 
 
 if __name__ == "__main__":
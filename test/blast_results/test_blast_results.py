@@ -0,0 +1,69 @@
+from bipy.toolbox import blast_results
+from bcbio.utils import safe_makedir, file_exists
+import os
+import shutil
+import unittest
+
+STAGENAME = "blast_results"
+
+# qseqid sseqid pident length mismatch gapopen qstart qend sstart send
+# evalue bitscore qlen slen
+HITS = ["q1\ts1\t99.0\t100\t1\t0\t1\t100\t1\t100\t1e-50\t180\t100\t120",
+        "q1\ts2\t90.0\t100\t10\t0\t1\t100\t1\t100\t1e-40\t150\t100\t100",
+        "q2\ts3\t95.0\t20\t1\t0\t1\t20\t20\t1\t0.01\t40\t100\t100",
+        "q3\ts1\t80.0\t90\t18\t0\t5\t95\t95\t5\t1e-20\t90\t100\t100",
+        "q3\ts4\t85.0\t90\t13\t0\t5\t95\t5\t95\t1e-25\t120\t100\t100"]
+
+
+class TestBlastResults(unittest.TestCase):
+
+    def setUp(self):
+        self.out_dir = os.path.join("results", "tests", STAGENAME)
+        safe_makedir(self.out_dir)
+        self.in_file = os.path.join(self.out_dir, "hits.tsv")
+        with open(self.in_file, "w") as out_handle:
+            out_handle.write("\n".join(HITS) + "\n")
+
+    def tearDown(self):
+        shutil.rmtree(self.out_dir)
+
+    def _qseqids(self, in_file):
+        return [list(x["qseqid"]) for x in
+                blast_results.read_results(in_file)][0]
+
+    def test_filter_results(self):
+        out_file = os.path.join(self.out_dir, "hits.filt.tsv")
+        blast_results.filter_results(self.in_file, out_file,
+                                     min_coverage=0.5, min_identity=85,
+                                     chunksize=2)
+        self.assertTrue(file_exists(out_file))
+        self.assertEquals(self._qseqids(out_file), ["q1", "q1", "q3"])
+
+    def test_best_hits(self):
+        out_file = os.path.join(self.out_dir, "hits.best.tsv")
+        blast_results.best_hits(self.in_file, out_file, chunksize=2)
+        best = [x for x in blast_results.read_results(out_file)][0]
+        self.assertEquals(list(best["qseqid"]), ["q1", "q2", "q3"])
+        self.assertEquals(list(best["sseqid"]), ["s1", "s3", "s4"])
+
+    def test_best_hits_first_seen(self):
+        # the best hit of q1 comes after the hit of q2
+        hits = [HITS[1], HITS[2], HITS[0]]
+        with open(self.in_file, "w") as out_handle:
+            out_handle.write("\n".join(hits) + "\n")
+        for chunksize in [1, 2, 3]:
+            out_file = os.path.join(self.out_dir,
+                                    "hits.best.%d.tsv" % (chunksize))
+            blast_results.best_hits(self.in_file, out_file,
+                                    chunksize=chunksize)
+            best = [x for x in blast_results.read_results(out_file)][0]
+            self.assertEquals(list(best["qseqid"]), ["q1", "q2"])
+            self.assertEquals(list(best["sseqid"]), ["s1", "s3"])
+
+    def test_hit_ids(self):
+        self.assertEquals(blast_results.hit_ids(self.in_file),
+                          set(["q1", "q2", "q3"]))
+
+if __name__ == "__main__":
+    suite = unittest.TestLoader().loadTestsFromTestCase(TestBlastResults)
+    unittest.TextTestRunner(verbosity=2).run(suite)
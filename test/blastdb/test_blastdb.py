@@ -0,0 +1,60 @@
+from bipy.toolbox import blastdb
+from bcbio.utils import safe_makedir
+import os
+import shutil
+import unittest
+
+STAGENAME = "blastdb"
+
+
+class TestBlastdb(unittest.TestCase):
+
+    def setUp(self):
+        self.out_dir = os.path.join("results", "tests", STAGENAME)
+        safe_makedir(self.out_dir)
+        self.db_file = os.path.join(self.out_dir, "ref.fa")
+        with open(self.db_file, "w") as out_handle:
+            out_handle.write(">seq1\nACGTACGT\n")
+        self.base = os.path.join(self.out_dir, "ref")
+        # stand in for the files makeblastdb writes
+        for ext in blastdb.VOLUME_EXTS["nucl"]:
+            with open("%s.%s" % (self.base, ext), "w") as out_handle:
+                out_handle.write(ext)
+
+    def tearDown(self):
+        blastdb._registry.clear()
+        shutil.rmtree(self.out_dir)
+
+    def test_manifest(self):
+        self.assertFalse(blastdb.is_complete(self.db_file, self.base,
+                                             "nucl"))
+        blastdb.write_manifest(self.db_file, self.base, "nucl")
+        self.assertTrue(blastdb.is_complete(self.db_file, self.base, "nucl"))
+        self.assertFalse(blastdb.is_complete(self.db_file, self.base,
+                                             "prot"))
+        os.remove(self.base + ".nsq")
+        self.assertFalse(blastdb.is_complete(self.db_file, self.base,
+                                             "nucl"))
+
+    def test_changed_reference(self):
+        blastdb.write_manifest(self.db_file, self.base, "nucl")
+        with open(self.db_file, "a") as out_handle:
+            out_handle.write(">seq2\nTTTT\n")
+        self.assertFalse(blastdb.is_complete(self.db_file, self.base,
+                                             "nucl"))
+
+    def test_missing_volume(self):
+        with open(self.base + ".nal", "w") as out_handle:
+            out_handle.write("TITLE ref\nDBLIST ref.00 ref.01\n")
+        self.assertEquals(len(blastdb.volume_files(self.base, "nucl")), 7)
+        self.assertRaises(ValueError, blastdb.write_manifest, self.db_file,
+                          self.base, "nucl")
+
+    def test_file_lock(self):
+        lock_file = self.base + ".lock"
+        with blastdb.file_lock(lock_file):
+            self.assertTrue(os.path.exists(lock_file))
+
+if __name__ == "__main__":
+    suite = unittest.TestLoader().loadTestsFromTestCase(TestBlastdb)
+    unittest.TextTestRunner(verbosity=2).run(suite)
@@ -1,11 +1,47 @@
 from bipy.toolbox import blastn
-from bipy import cluster
 from bipy.log import logger, setup_logging
+from bcbio.utils import safe_makedir
+import os
+import shutil
+import unittest
 import yaml
 import sys
 
+STAGENAME = "blastn"
+
+
+class TestBlastn(unittest.TestCase):
+
+    def setUp(self):
+        self.config_file = os.path.join("test", STAGENAME,
+                                        "test_" + STAGENAME + ".yaml")
+        with open(self.config_file) as in_handle:
+            self.config = yaml.load(in_handle)
+        self.query = self.config["query"]
+        self.out_dir = os.path.join("results", "tests", STAGENAME)
+        safe_makedir(self.out_dir)
+
+    def tearDown(self):
+        shutil.rmtree(self.out_dir)
+
+    def test_chunk_bounds(self):
+        self.assertEquals(blastn._chunk_bounds([10, 10, 10, 10], 2), [0, 2])
+        self.assertEquals(blastn._chunk_bounds([1, 1, 1, 100], 3), [0, 3])
+        self.assertEquals(blastn._chunk_bounds([5], 4), [0])
+
+    def test_split_fasta(self):
+        chunk_files = blastn.split_fasta(self.query, self.out_dir, 4)
+        self.assertEquals(len(chunk_files), 2)
+        sizes = [blastn._fasta_sizes(x) for x in chunk_files]
+        self.assertEquals(sum(sizes, []), blastn._fasta_sizes(self.query))
+        merged = os.path.join(self.out_dir, "merged.fa")
+        blastn.merge_chunks(chunk_files, merged)
+        with open(merged) as merged_handle, open(self.query) as query_handle:
+            self.assertEquals(merged_handle.read(), query_handle.read())
+
 
 def main(config_file):
+    from bipy import cluster
     with open(config_file) as in_handle:
         config = yaml.load(in_handle)
     setup_logging(config)
@@ -0,0 +1,61 @@
+from bipy.toolbox import chrom_sizes
+from bcbio.utils import safe_makedir, file_exists
+import os
+import shutil
+import unittest
+
+STAGENAME = "chrom_sizes"
+
+
+class TestChromSizes(unittest.TestCase):
+
+    def setUp(self):
+        self.bam_file = "test/data/mouse_chr17.sorted.bam"
+        self.fasta_file = "test/data/contaminants.fa"
+        self.ref_dir = os.path.join("results", STAGENAME)
+        safe_makedir(self.ref_dir)
+        self.config = {"dir": {"ref": self.ref_dir},
+                       "annotation": {"name": "mm9"}}
+
+    def test_from_bam(self):
+        sizes = dict(chrom_sizes.from_bam(self.bam_file))
+        self.assertEquals(sizes["chr17"], 95272651)
+
+    def test_from_fasta(self):
+        sizes = chrom_sizes.from_fasta(self.fasta_file)
+        out_file = os.path.join(self.ref_dir, "contaminants.sizes")
+        chrom_sizes.write_chrom_sizes(sizes, out_file)
+        self.assertEquals(chrom_sizes.from_fai(out_file), sizes)
+
+    def test_get_chrom_sizes_cached(self):
+        out_file = chrom_sizes.get_chrom_sizes(self.config, self.bam_file)
+        self.assertEquals(out_file, os.path.join(self.ref_dir, "mm9.sizes"))
+        self.assertTrue(file_exists(out_file))
+        # the cached sizes are used without a BAM file
+        self.assertEquals(chrom_sizes.get_chrom_sizes(self.config), out_file)
+
+    def test_get_chrom_sizes_other_genome(self):
+        # a cache written for another genome under the same name
+        cache_file = os.path.join(self.ref_dir, "mm9.sizes")
+        chrom_sizes.write_chrom_sizes([("chr1", 1000)], cache_file)
+        out_file = chrom_sizes.get_chrom_sizes(self.config, self.bam_file)
+        # the sizes from the header go to the reference directory, not
+        # next to the BAM file
+        self.assertEquals(os.path.dirname(out_file), self.ref_dir)
+        self.assertFalse(os.path.exists(self.bam_file + ".sizes"))
+        self.assertEquals(chrom_sizes.from_fai(out_file),
+                          chrom_sizes.from_bam(self.bam_file))
+        self.assertEquals(chrom_sizes.from_fai(cache_file), [("chr1", 1000)])
+        # and are only written once
+        os.utime(out_file, (1000, 1000))
+        self.assertEquals(chrom_sizes.get_chrom_sizes(self.config,
+                                                      self.bam_file),
+                          out_file)
+        self.assertEquals(os.path.getmtime(out_file), 1000)
+
+    def tearDown(self):
+        shutil.rmtree(self.ref_dir)
+
+if __name__ == "__main__":
+    suite = unittest.TestLoader().loadTestsFromTestCase(TestChromSizes)
+    unittest.TextTestRunner(verbosity=2).run(suite)
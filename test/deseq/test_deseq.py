@@ -3,6 +3,8 @@ from bipy.utils import replace_suffix
 from bcbio.utils import safe_makedir, file_exists
 import os
 import unittest
+import pandas as pd
+import numpy as np
 
 
 class TestDeseq(unittest.TestCase):
@@ -18,6 +20,83 @@ class TestDeseq(unittest.TestCase):
         result = deseq.run(self.count_file, self.conds, out_prefix=out_prefix)
         self.assertTrue(file_exists(result))
 
+    def test_run_contrasts(self):
+        out_dir = "results/tests/deseq/contrasts"
+        samples = ["untreated1", "untreated2", "untreated3", "untreated4",
+                   "treated1", "treated2", "treated3"]
+        design = dict(zip(samples, self.conds))
+        out_files, combined = deseq.run_contrasts(self.count_file, design,
+                                                  out_dir)
+        self.assertTrue(all(map(file_exists, out_files.values())))
+        self.assertTrue(file_exists(combined))
+
+    def test_estimate_size_factors(self):
+        # the size factors from the DESeq vignette
+        expected = {"untreated1": 1.138, "untreated2": 1.793,
+                    "untreated3": 0.650, "untreated4": 0.752,
+                    "treated1": 1.636, "treated2": 0.761, "treated3": 0.833}
+        counts = pd.read_csv(self.count_file, sep="\t", index_col=0)
+        factors = deseq.estimate_size_factors(counts)
+        for sample, factor in expected.items():
+            self.assertAlmostEqual(factors[sample], factor, places=3)
+
+    def test_log_transform(self):
+        counts = pd.DataFrame({"a": [0, 3, 7], "b": [1, 7, 15]},
+                              index=["g1", "g2", "g3"], columns=["a", "b"])
+        logged = deseq.log_transform(counts, factors=[1.0, 2.0])
+        expected = [[0.0, 0.5849625], [2.0, 2.1699250], [3.0, 3.0874628]]
+        for row, values in zip(logged.values, expected):
+            for x, y in zip(row, values):
+                self.assertAlmostEqual(x, y, places=6)
+
+    def test_mva_data(self):
+        counts = pd.DataFrame({"a1": [2, 0], "a2": [4, 0], "b1": [12, 5],
+                               "c1": [100, 100]},
+                              index=["g1", "g2"],
+                              columns=["a1", "a2", "b1", "c1"])
+        conds = ["a", "a", "b", "c"]
+        mva = deseq.mva_data(counts, conds, "a", "b", factors=[1, 1, 1, 1])
+        self.assertEquals(list(mva["id"]), ["g1", "g2"])
+        self.assertEquals(list(mva["baseMeanA"]), [3.0, 0.0])
+        self.assertEquals(list(mva["baseMeanB"]), [12.0, 5.0])
+        # the samples of c are not part of the contrast
+        self.assertEquals(list(mva["baseMean"]), [6.0, 5.0 / 3])
+        self.assertEquals(mva["foldChange"][0], 4.0)
+        self.assertEquals(mva["log2FoldChange"][0], 2.0)
+        self.assertTrue(np.isinf(mva["foldChange"][1]))
+
+    def test_variance_stabilize(self):
+        counts = pd.read_csv(self.count_file, sep="\t", index_col=0)
+        factors = deseq.estimate_size_factors(counts)
+        fit = deseq.fit_dispersions(deseq.dispersion_moments(counts, factors))
+        self.assertTrue(all(x > 0 for x in fit))
+        vst = deseq.variance_stabilize(counts, factors, fit)
+        self.assertEquals(vst.shape, counts.shape)
+        self.assertTrue(vst.notnull().values.all())
+
+    def test_top_by(self):
+        out_dir = "results/tests/deseq/top_by"
+        safe_makedir(out_dir)
+        in_file = os.path.join(out_dir, "top_by.deseq.txt")
+        table = pd.DataFrame({"id": ["a", "b", "c", "d"],
+                              "log2FoldChange": [0.5, -3.0, 1.0, 2.0],
+                              "padj": [0.2, 0.01, None, 0.05],
+                              "count": [10, 300, 5, 80]},
+                             columns=["id", "log2FoldChange", "padj",
+                                      "count"])
+        table.to_csv(in_file, sep="\t", index=False)
+        cols = ["id", "log2FoldChange", "padj"]
+        top = deseq.top_by(in_file, cols, "padj", k=3, chunksize=2)
+        self.assertEquals(list(top["id"]), ["b", "d", "a"])
+        self.assertEquals(top["padj"].dtype, np.float64)
+        self.assertEquals(top["log2FoldChange"].dtype, np.float64)
+        # the columns keep their dtypes across the chunks
+        top = deseq.top_by(in_file, ["id", "count", "padj"], "padj", k=3,
+                           chunksize=2)
+        self.assertEquals(top["count"].dtype, np.int64)
+        top = deseq.top_by(in_file, cols, "log2FoldChange", k=2)
+        self.assertEquals(list(top["id"]), ["b", "d"])
+
 if __name__ == "__main__":
     suite = unittest.TestLoader().loadTestsFromTestCase(TestDeseq)
     unittest.TextTestRunner(verbosity=2).run(suite)
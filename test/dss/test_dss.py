@@ -17,6 +17,27 @@ class TestDss(unittest.TestCase):
         result = dss.run(self.count_file, self.conds, ("untreat", "treat"), out_prefix=out_prefix)
         self.assertTrue(file_exists(result))
 
+    def test_run_contrasts_chunked(self):
+        out_dir = "results/tests/dss/contrasts"
+        out_files = dss.run_contrasts(self.count_file, self.conds, out_dir,
+                                      chunk_size=5000)
+        self.assertTrue(all(map(file_exists, out_files.values())))
+
+    def test_fit_key(self):
+        key = dss._fit_key(self.count_file, self.conds)
+        self.assertEqual(dss._fit_key(self.count_file, list(self.conds)),
+                         key)
+        self.assertNotEqual(dss._fit_key(self.count_file,
+                                         self.conds[::-1]), key)
+
+    def test_adjust_pvalues(self):
+        # p.adjust(c(0.01, 0.04, 0.03, 0.2), method="BH") in R
+        adjusted = dss.adjust_pvalues([0.01, 0.04, 0.03, 0.2, None])
+        expected = [0.04, 0.05333333, 0.05333333, 0.2]
+        for x, y in zip(adjusted, expected):
+            self.assertAlmostEqual(x, y)
+        self.assertTrue(adjusted[-1] != adjusted[-1])
+
 if __name__ == "__main__":
     suite = unittest.TestLoader().loadTestsFromTestCase(TestDss)
     unittest.TextTestRunner(verbosity=2).run(suite)
@@ -0,0 +1,90 @@
+from bipy.toolbox import fasta
+from bcbio.utils import safe_makedir
+from Bio import SeqIO
+import os
+import shutil
+import unittest
+
+STAGENAME = "fasta"
+
+
+def starts_with_m(record):
+    return str(record.seq).startswith("M")
+
+
+class TestFasta(unittest.TestCase):
+
+    def setUp(self):
+        self.out_dir = os.path.join("results", STAGENAME)
+        safe_makedir(self.out_dir)
+        # the index is written next to the file
+        self.in_file = os.path.join(self.out_dir, "ecoli.pep.fa")
+        shutil.copy("test/data/E_coli_k12.ASM584v1.15.pep.all.fa",
+                    self.in_file)
+        self.records = list(SeqIO.parse(self.in_file, "fasta"))
+
+    def test_build_index(self):
+        index = fasta.read_index(fasta.build_index(self.in_file))
+        self.assertEquals(index.keys(), [x.id for x in self.records])
+        self.assertEquals([x.length for x in index.values()],
+                          [len(x) for x in self.records])
+
+    def test_fetch(self):
+        with fasta.IndexedFasta(self.in_file) as indexed:
+            for record in self.records[::50]:
+                seq = str(record.seq)
+                self.assertEquals(indexed[record.id], seq)
+                self.assertEquals(indexed.fetch(record.id, 55, 130),
+                                  seq[55:130])
+                self.assertEquals(indexed.region(record.id + ":2-61"),
+                                  seq[1:61])
+                self.assertEquals(indexed.record(record.id).description,
+                                  record.description)
+
+    def test_description_with_gt(self):
+        in_file = os.path.join(self.out_dir, "gt.fa")
+        with open(in_file, "w") as out_handle:
+            out_handle.write(">s1 gene a>b\nACGT\n>s2\nGG\n")
+        with fasta.IndexedFasta(in_file) as indexed:
+            self.assertEquals(indexed.description("s1"), "s1 gene a>b")
+            self.assertEquals(indexed.description("s2"), "s2")
+
+    def test_duplicate_names(self):
+        in_file = os.path.join(self.out_dir, "duplicate.fa")
+        with open(in_file, "w") as out_handle:
+            out_handle.write(">s1\nACGT\n>s1 again\nGG\n")
+        self.assertRaises(ValueError, fasta.build_index, in_file)
+        fai_file = in_file + ".fai"
+        with open(fai_file, "w") as out_handle:
+            out_handle.write("s1\t4\t4\t4\t5\ns1\t2\t19\t2\t3\n")
+        self.assertRaises(ValueError, fasta.read_index, fai_file)
+
+    def test_byte_chunks(self):
+        with fasta.IndexedFasta(self.in_file) as indexed:
+            chunks = indexed.byte_chunks(4)
+        self.assertEquals(len(chunks), 4)
+        self.assertEquals(sum(chunks, []), [x.id for x in self.records])
+
+    def test_passed_seqio(self):
+        expected = fasta.passed_seqio(self.in_file, starts_with_m, "fasta")
+        self.assertEquals(expected[1], len(self.records))
+        self.assertEquals(fasta.passed_seqio(self.in_file, starts_with_m,
+                                             "fasta", cores=2), expected)
+        self.assertEquals(fasta.count_seqio(self.in_file, starts_with_m,
+                                            "fasta"), expected[0])
+
+    def test_filter_seqio(self):
+        expected = [x.id for x in self.records if starts_with_m(x)]
+        for cores in [1, 2]:
+            out_file = os.path.join(self.out_dir, "filtered_%d.fa" % (cores))
+            fasta.filter_seqio(self.in_file, starts_with_m, out_file,
+                               cores=cores, batchsize=500)
+            self.assertEquals([x.id for x in SeqIO.parse(out_file, "fasta")],
+                              expected)
+
+    def tearDown(self):
+        shutil.rmtree(self.out_dir)
+
+if __name__ == "__main__":
+    suite = unittest.TestLoader().loadTestsFromTestCase(TestFasta)
+    unittest.TextTestRunner(verbosity=2).run(suite)
@@ -4,6 +4,7 @@ from bipy.toolbox import htseq_count
 from bcbio.utils import safe_makedir
 import os
 import shutil
+import pandas as pd
 
 STAGENAME = "htseq-count"
 
@@ -18,13 +19,11 @@ class TestHtseqcount(unittest.TestCase):
         self.input_file = self.config["input"]
         self.gtf = self.config["annotation"]["file"]
         self.stage_config = self.config["stage"][STAGENAME]
-        self.options = self.stage_config["options"]
 
     def test_run(self):
         out_file = "results/htseq-count/test_run.count"
         run_result = htseq_count.run(self.input_file,
                                      self.gtf,
-                                     self.options,
                                      out_file)
         self.assertTrue(run_result == out_file)
         self.assertTrue(os.path.exists(run_result))
@@ -37,6 +36,25 @@ class TestHtseqcount(unittest.TestCase):
         self.assertTrue(os.path.exists(run_result))
         self.assertTrue(os.path.getsize(run_result) > 0)
 
+    def test_count_reads(self):
+        index = htseq_count.ExonIndex.from_gtf(self.gtf)
+        counts = htseq_count.count_reads(self.input_file, index)
+        correct = htseq_count._load_htseq_count_file(
+            "test/data/s_1_1_10k_last.counts")[1]
+        # the stored counts are from an htseq-count without the __ prefix
+        correct.index = [x if x.startswith("EBESCG") else "__" + x
+                         for x in correct.index]
+        self.assertTrue((counts == correct.reindex(counts.index)).all())
+
+    def test_count_reads_parallel(self):
+        in_file = "test/data/s_1_1_10k.sorted.bam"
+        index = htseq_count.ExonIndex.from_gtf(self.gtf)
+        single = htseq_count.count_reads(in_file, index)
+        parallel = htseq_count.count_reads(in_file, index, cores=2)
+        self.assertTrue((single == parallel).all())
+        self.assertEqual(single[htseq_count.NO_FEATURE], 225)
+        self.assertEqual(single[htseq_count.AMBIGUOUS], 46)
+
     def test_combine(self):
         to_combine = self.config["to_combine"]
         out_file = "results/%s/combined_counts.counts" % (STAGENAME)
@@ -45,6 +63,50 @@ class TestHtseqcount(unittest.TestCase):
         self.assertTrue(os.path.exists(out_file))
         self.assertTrue(os.path.getsize(out_file) > 0)
 
+    def test_combine_different_genes(self):
+        to_combine = self.config["to_combine"]
+        out_dir = "results/%s" % (STAGENAME)
+        safe_makedir(out_dir)
+        truncated = os.path.join(out_dir, "truncated.counts")
+        with open(to_combine[1]) as in_handle:
+            lines = in_handle.readlines()
+        with open(truncated, "w") as out_handle:
+            out_handle.writelines(lines[1:])
+        out_file = os.path.join(out_dir, "combined_truncated.counts")
+        self.assertRaises(ValueError, htseq_count.combine_counts,
+                          [to_combine[0], truncated], out_file=out_file)
+        self.assertRaises(ValueError, htseq_count.combine_counts,
+                          [truncated, to_combine[0]], out_file=out_file)
+        self.assertFalse(os.path.exists(out_file))
+
+    def test_combine_binary(self):
+        to_combine = self.config["to_combine"]
+        out_file = "results/%s/combined_binary.counts" % (STAGENAME)
+        safe_makedir(os.path.dirname(out_file))
+        htseq_count.combine_counts(to_combine, ["last", "first"],
+                                   out_file=out_file, binary=True)
+        binary = htseq_count.load_count_matrix(out_file)
+        text = pd.read_csv(out_file, sep="\t", index_col=0, header=0)
+        self.assertEqual(list(binary.columns), ["last", "first"])
+        self.assertTrue((binary.values == text.values).all())
+        self.assertTrue((binary.index == text.index).all())
+
+    def test_count_store(self):
+        to_combine = self.config["to_combine"]
+        store_dir = "results/%s/test.store" % (STAGENAME)
+        genes = htseq_count._load_htseq_count_file(to_combine[0]).index
+        store = htseq_count.CountStore.create(store_dir, genes)
+        store.add_count_files(to_combine, ["last", "first"], chunk_size=1)
+        store.add_count_files(to_combine[:1], ["compressed"], compress=True)
+        store = htseq_count.CountStore(store_dir)
+        self.assertEqual(store.samples, ["last", "first", "compressed"])
+        subset = store.read(samples=["compressed", "first"],
+                            genes=["no_feature", "ambiguous"])
+        self.assertEqual(list(subset["compressed"]), [213, 27])
+        self.assertEqual(list(subset["first"]), [225, 46])
+        self.assertRaises(ValueError, store.add_count_files,
+                          to_combine[:1], ["last"])
+
     def tearDown(self):
         results_dir = "results/%s" % (STAGENAME)
         if os.path.exists(results_dir):
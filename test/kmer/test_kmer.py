@@ -0,0 +1,74 @@
+from bipy.toolbox import kmer
+from bcbio.utils import safe_makedir
+from collections import Counter
+import os
+import shutil
+import unittest
+import numpy as np
+
+STAGENAME = "kmer"
+
+
+class TestKmer(unittest.TestCase):
+
+    def setUp(self):
+        self.in_file = "test/data/test_fastq_1.fastq"
+        self.out_dir = os.path.join("results", STAGENAME)
+        safe_makedir(self.out_dir)
+        self.k = 7
+        self.expected = Counter()
+        for seq in kmer.read_sequences(self.in_file):
+            for i in range(len(seq) - self.k + 1):
+                if set(seq[i:i + self.k]) <= set("ACGT"):
+                    self.expected[seq[i:i + self.k]] += 1
+
+    def _as_dict(self, counts):
+        return dict((kmer.decode(x, counts.k), y) for x, y in
+                    zip(counts.kmers, counts.counts))
+
+    def test_encode(self):
+        kmers = kmer.encode(["ACGTN", "TTT"], 3)
+        self.assertEquals([kmer.decode(x, 3) for x in kmers],
+                          ["ACG", "CGT", "TTT"])
+        canonical = kmer.encode(["TTT"], 3, canonical=True)
+        self.assertEquals(kmer.decode(canonical[0], 3), "AAA")
+
+    def test_count_kmers(self):
+        counts = kmer.count_kmers(self.in_file, self.k, chunksize=700)
+        self.assertEquals(self._as_dict(counts), dict(self.expected))
+        self.assertEquals(kmer.top_kmers(counts, 1),
+                          self.expected.most_common(1))
+
+    def test_count_kmers_parallel(self):
+        counts = kmer.count_kmers(self.in_file, self.k, cores=2,
+                                  chunksize=300)
+        self.assertEquals(self._as_dict(counts), dict(self.expected))
+
+    def test_histogram(self):
+        counts = kmer.count_kmers(self.in_file, self.k)
+        expected = sorted(Counter(self.expected.values()).items())
+        self.assertEquals(kmer.histogram(counts), expected)
+
+    def test_histogram_large_counts(self):
+        counts = kmer.KmerCounts(2, np.arange(3), np.array([10 ** 12, 3, 3]))
+        self.assertEquals(kmer.histogram(counts), [(3, 2), (10 ** 12, 1)])
+
+    def test_write_counts(self):
+        counts = kmer.count_kmers(self.in_file, self.k)
+        out_file = kmer.write_counts(counts, os.path.join(self.out_dir,
+                                                          "kmers.txt"), 10)
+        with open(out_file) as in_handle:
+            written = dict((x.split()[0], int(x.split()[1]))
+                           for x in in_handle)
+        self.assertEquals(written, dict((x, y) for x, y in
+                                        self.expected.items() if y >= 10))
+
+    def test_bad_k(self):
+        self.assertRaises(ValueError, kmer.count_kmers, self.in_file, 33)
+
+    def tearDown(self):
+        shutil.rmtree(self.out_dir)
+
+if __name__ == "__main__":
+    suite = unittest.TestLoader().loadTestsFromTestCase(TestKmer)
+    unittest.TextTestRunner(verbosity=2).run(suite)
@@ -0,0 +1,65 @@
+from bipy.toolbox import normalize, htseq_count
+from bcbio.utils import safe_makedir, file_exists
+import numpy as np
+import pandas as pd
+import os
+import shutil
+import unittest
+
+STAGENAME = "normalize"
+
+
+class TestNormalize(unittest.TestCase):
+
+    def setUp(self):
+        self.gtf = "test/data/E_coli_k12.ASM584v1.15.gtf"
+        self.count_file = "test/data/combined_counts.counts"
+        self.out_dir = os.path.join("results", STAGENAME)
+        safe_makedir(self.out_dir)
+        self.cache_file = os.path.join(self.out_dir, "e_coli.gene_lengths")
+        self.counts = normalize.drop_special_counters(
+            htseq_count.load_count_matrix(self.count_file))
+
+    def test_gene_lengths(self):
+        lengths = normalize.gene_lengths(self.gtf, self.cache_file)
+        self.assertTrue(file_exists(self.cache_file))
+        # thrL has a single 190-255 exon
+        self.assertEqual(lengths["EBESCG00000000900"], 66)
+        cached = normalize.gene_lengths(self.gtf, self.cache_file)
+        self.assertTrue((cached == lengths).all())
+
+    def test_normalizations(self):
+        lengths = normalize.gene_lengths(self.gtf, self.cache_file)
+        tpm = normalize.tpm(self.counts, lengths)
+        self.assertTrue(np.allclose(tpm.sum(), 1e6))
+        cpm = normalize.cpm(self.counts)
+        self.assertTrue(np.allclose(cpm.sum(), 1e6))
+        rpkm = normalize.rpkm(self.counts, lengths)
+        gene = self.counts.index[self.counts.iloc[:, 0] > 0][0]
+        correct = (self.counts.loc[gene].iloc[0] / (lengths[gene] / 1e3) /
+                   (self.counts.iloc[:, 0].sum() / 1e6))
+        self.assertAlmostEqual(rpkm.loc[gene].iloc[0], correct)
+
+    def test_effective_lengths(self):
+        lengths = normalize.gene_lengths(self.gtf, self.cache_file)
+        effective = pd.DataFrame(dict((x, lengths) for x in
+                                      self.counts.columns))
+        plain = normalize.rpkm(self.counts, lengths)
+        per_sample = normalize.rpkm(self.counts, effective)
+        self.assertTrue(np.allclose(plain.values, per_sample.values))
+
+    def test_normalize(self):
+        lengths = normalize.gene_lengths(self.gtf, self.cache_file)
+        out_files = normalize.normalize(self.counts, lengths,
+                                        os.path.join(self.out_dir, "test"))
+        self.assertEqual(sorted(out_files.keys()), sorted(normalize.METHODS))
+        self.assertTrue(all(map(file_exists, out_files.values())))
+
+    def tearDown(self):
+        if os.path.exists(self.out_dir):
+            shutil.rmtree(self.out_dir)
+
+
+if __name__ == "__main__":
+    suite = unittest.TestLoader().loadTestsFromTestCase(TestNormalize)
+    unittest.TextTestRunner(verbosity=2).run(suite)
@@ -0,0 +1,81 @@
+from bipy.toolbox import rpool
+from bcbio.utils import safe_makedir, file_exists
+import os
+import shutil
+import unittest
+from multiprocessing import Pool
+
+STAGENAME = "rpool"
+
+
+def _shared_pool_type():
+    return type(rpool.shared_pool()).__name__
+
+
+class TestRpool(unittest.TestCase):
+
+    def setUp(self):
+        self.out_dir = os.path.join("results", STAGENAME)
+        safe_makedir(self.out_dir)
+        self.pool = rpool.RPool(processes=2)
+
+    def test_run(self):
+        out_file = os.path.join(self.out_dir, "counts.txt")
+        job = rpool.RJob()
+        job.assign("in_file", "test/data/pasilla_gene_counts.tsv")
+        job.assign("out_file", out_file)
+        job('''
+        counts = read.table(in_file, header=TRUE, row.names=1)
+        write.table(colSums(counts), file=out_file, sep="\t")
+        n = ncol(counts)
+        ''')
+        (n,) = job.run(self.pool, returns=["n"])
+        self.assertEqual(n, [7])
+        self.assertTrue(file_exists(out_file))
+
+    def test_isolated(self):
+        jobs = []
+        for x in range(4):
+            job = rpool.RJob()
+            job.assign("x", x)
+            job("res = x * 2")
+            jobs.append(job)
+        results = self.pool.map(jobs, returns=["res"])
+        self.assertEqual([x[0][0] for x in results], [0, 2, 4, 6])
+        # nothing leaks from one job into the next
+        self.assertRaises(rpool.RError, rpool.RJob()("res").run, self.pool,
+                          ["res"])
+
+    def test_missing_package(self):
+        # used to restart the workers forever instead of failing
+        job = rpool.RJob(["notAnRPackage"])("x = 1")
+        self.assertRaises(rpool.RError, job.run, self.pool)
+        self.assertRaises(rpool.RError, job.run, rpool.LocalRPool())
+
+    def test_shared_pool_in_daemon(self):
+        pool = Pool(1)
+        try:
+            self.assertEqual(pool.apply(_shared_pool_type),
+                             "LocalRPool")
+        finally:
+            pool.close()
+            pool.join()
+
+    def test_shared_pool_not_inherited(self):
+        # a pool of this process is of no use to forked workers
+        parent = rpool.shared_pool()
+        try:
+            self.test_shared_pool_in_daemon()
+        finally:
+            rpool.close_shared_pool()
+        self.assertEqual(type(parent).__name__, "RPool")
+
+    def tearDown(self):
+        self.pool.close()
+        if os.path.exists(self.out_dir):
+            shutil.rmtree(self.out_dir)
+
+
+if __name__ == "__main__":
+    suite = unittest.TestLoader().loadTestsFromTestCase(TestRpool)
+    unittest.TextTestRunner(verbosity=2).run(suite)
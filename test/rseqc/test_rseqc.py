@@ -3,6 +3,12 @@ import unittest
 from bipy.toolbox import rseqc
 from bcbio.utils import safe_makedir, file_exists
 import os
+import shutil
+import glob
+from math import sqrt
+import numpy as np
+import pandas as pd
+import pysam
 from bipy.toolbox import reporting
 
 STAGENAME = "rseqc"
@@ -39,6 +45,49 @@ class TestRseqc(unittest.TestCase):
     def test_bam2bigwig(self):
         out_file = rseqc.bam2bigwig(self.input_file, self.config)
         self.assertTrue(file_exists(out_file))
+        # the bedGraph the bigwig is made from is not kept
+        self.assertEquals(glob.glob(os.path.join(os.path.dirname(out_file),
+                                                 "*.bedGraph")), [])
+        os.unlink(out_file)
+
+    def test_bam_coverage(self):
+        out_dir = os.path.join(self.config["dir"]["results"], STAGENAME)
+        safe_makedir(out_dir)
+        out_file = os.path.join(out_dir, "coverage.minus.bedGraph")
+        rseqc.bam_coverage(self.input_file, out_file, strand="-",
+                           normalize=True, cores=2)
+        self.assertTrue(file_exists(out_file))
+        os.unlink(out_file)
+
+    def test_bam_coverage_unindexed(self):
+        test_dir = os.path.join(self.config["dir"]["results"], STAGENAME,
+                                "unindexed")
+        in_dir = safe_makedir(os.path.join(test_dir, "data"))
+        out_dir = safe_makedir(os.path.join(test_dir, "coverage"))
+        in_file = os.path.join(in_dir, os.path.basename(self.input_file))
+        shutil.copy(self.input_file, in_file)
+        out_file = os.path.join(out_dir, "unindexed.bedGraph")
+        rseqc.bam_coverage(in_file, out_file)
+        # the index is made in the output directory, not next to the input
+        self.assertFalse(os.path.exists(in_file + ".bai"))
+        indexed_file = os.path.join(out_dir, "indexed.bedGraph")
+        rseqc.bam_coverage(self.input_file, indexed_file)
+        with open(out_file) as in_handle:
+            with open(indexed_file) as indexed_handle:
+                self.assertEquals(in_handle.read(), indexed_handle.read())
+        shutil.rmtree(test_dir)
+
+    def test_chrom_coverage_empty(self):
+        out_dir = os.path.join(self.config["dir"]["results"], STAGENAME)
+        safe_makedir(out_dir)
+        out_file = os.path.join(out_dir, "empty.npz")
+        chrom = pysam.AlignmentFile(self.input_file, "rb").references[0]
+        n_reads = rseqc._chrom_coverage((self.input_file, chrom, 0, None,
+                                         1000, out_file))
+        self.assertEquals(n_reads, 0)
+        runs = np.load(out_file)
+        self.assertEquals(len(runs["starts"]), 0)
+        self.assertEquals(len(runs["ends"]), 0)
         os.unlink(out_file)
 
     def test_bamstat(self):
@@ -46,6 +95,29 @@ class TestRseqc(unittest.TestCase):
         self.assertTrue(file_exists(out_file))
         os.unlink(out_file)
 
+    def test_run_qc(self):
+        out_files = rseqc.run_qc(self.input_file, self.config)
+        self.assertEquals(sorted(out_files),
+                          ["RPKM_count", "RPKM_saturation", "bam_stat",
+                           "coverage", "junction", "saturation"])
+        for out_file in out_files.values():
+            self.assertTrue(file_exists(out_file))
+            os.unlink(out_file)
+
+    def test_run_qc_skips_finished(self):
+        out_files = rseqc.run_qc(self.input_file, self.config,
+                                 [rseqc.BamStat()])
+        stat = rseqc.BamStat()
+        self.assertEquals(rseqc.run_qc(self.input_file, self.config, [stat]),
+                          out_files)
+        # the BAM file is not read again
+        self.assertEquals(stat.stats["total"], 0)
+        os.unlink(out_files["bam_stat"])
+
+    def test_accumulator_is_abstract(self):
+        self.assertRaises(TypeError, rseqc.Accumulator)
+        self.assertRaises(TypeError, rseqc.JunctionCatalogue)
+
     def test_clipping_profile(self):
         out_file = rseqc.clipping_profile(self.input_file, self.config)
         self.assertTrue(file_exists(out_file))
@@ -61,6 +133,22 @@ class TestRseqc(unittest.TestCase):
         #out_file_bw = reseqc.genebody_coverage(bigwig, self.config)
         #self.assertTrue(file_exists(out_file_bw))
 
+    def test_genebody_percentiles(self):
+        out_dir = os.path.join(self.config["dir"]["results"], STAGENAME)
+        safe_makedir(out_dir)
+        bed_file = os.path.join(out_dir, "genebody.bed")
+        with open(bed_file, "w") as out_handle:
+            out_handle.write("chr1\t0\t200\tplus\t0\t+\t0\t200\t0\t1\t"
+                             "200,\t0,\n")
+            out_handle.write("chr1\t0\t50\tshort\t0\t-\t0\t50\t0\t1\t"
+                             "50,\t0,\n")
+        exons = rseqc.load_gene_models(bed_file)
+        transcripts, points = rseqc.genebody_percentiles(exons)
+        self.assertEquals(list(transcripts), [0])
+        self.assertEquals(points[0][0], 2)
+        self.assertEquals(points[0][-1], 199)
+        os.unlink(bed_file)
+
     def test_genebody_coverage2(self):
         # test on a bam file
         out_file_bam = rseqc.genebody_coverage2(self.input_file, self.config)
@@ -80,6 +168,31 @@ class TestRseqc(unittest.TestCase):
         self.assertTrue(file_exists(out_file_saturation))
         os.unlink(out_file_saturation)
 
+    def test_annotate_junctions(self):
+        introns = pd.DataFrame({"chrom": ["chr1", "chr1"],
+                                "start": [100, 500], "end": [200, 600]})
+        junctions = pd.DataFrame({"chrom": ["chr1", "chr1", "chr1", "chr2"],
+                                  "start": [100, 100, 300, 100],
+                                  "end": [200, 600, 400, 200]})
+        self.assertEquals(list(rseqc.annotate_junctions(junctions,
+                                                        introns)),
+                          ["annotated", "annotated", "complete_novel",
+                           "complete_novel"])
+        junctions["end"] = [250, 600, 400, 200]
+        self.assertEquals(rseqc.annotate_junctions(junctions, introns)[0],
+                          "partial_novel")
+
+    def test_saturation_curves(self):
+        catalogue = np.zeros(3, dtype=rseqc.JUNCTION_DTYPE)
+        catalogue["count"] = [10, 1, 5]
+        known = np.array([True, True, False])
+        curves = rseqc.saturation_curves(catalogue, known, [50, 100],
+                                         recur=2, seed=1)
+        self.assertEquals(curves["all"][-1], 3)
+        self.assertEquals(curves["known"][-1], 1)
+        self.assertEquals(curves["novel"][-1], 1)
+        self.assertTrue(curves["all"][0] <= curves["all"][-1])
+
     def test_RPKM_count(self):
         out_file_RPKM = rseqc.RPKM_count(self.input_file,
                                          self.config)
@@ -93,6 +206,47 @@ class TestRseqc(unittest.TestCase):
         os.unlink(out_file_RPKM)
         os.unlink(out_file_fixed)
 
+    def test_merge_RPKM(self):
+        out_dir = os.path.join(self.config["dir"]["results"], STAGENAME,
+                               "merge_RPKM")
+        safe_makedir(out_dir)
+        header = "#chrom\tst\tend\taccession\tscore\tgene_strand\t"
+        rows = ["chr1\t0\t100\tb_exon_1\t0\t+\t%d\t%f\n",
+                "chr1\t200\t300\ta_exon_1\t0\t+\t%d\t%f\n"]
+        for sample, values in [("s1", [(2, 1.0), (4, 3.0)]),
+                               ("s2", [(6, 3.0), (8, 5.0)])]:
+            in_file = os.path.join(out_dir, sample + "_read_count.xls")
+            with open(in_file, "w") as out_handle:
+                out_handle.write(header + "tag_count\tRPKM\n")
+                for row, value in zip(rows, values):
+                    out_handle.write(row % value)
+        out_file = rseqc.merge_RPKM(out_dir)
+        merged = pd.read_csv(out_file, sep="\t", index_col=0)
+        self.assertEquals(list(merged.index), ["a_exon_1", "b_exon_1"])
+        self.assertEquals(list(merged["s1_read_count_count"]), [4, 2])
+        self.assertEquals(list(merged["count_total"]), [12, 8])
+        self.assertEquals(list(merged["RPKM_mean"]), [4.0, 2.0])
+        self.assertAlmostEquals(merged["RPKM_sd"][0], sqrt(2))
+        os.unlink(out_file)
+
+        with open(in_file, "a") as out_handle:
+            out_handle.write(rows[0] % (1, 1.0))
+        self.assertRaises(ValueError, rseqc.merge_RPKM, out_dir)
+
+    def test_RPKM_saturation_tables(self):
+        bed = rseqc._get_bed(self.config)
+        saturation = rseqc.RPKMSaturation(bed, seed=1)
+        rseqc.walk_bam(self.input_file, [saturation])
+        raw, erpkm = saturation.tables()
+        counts = raw[["%d%%" % (x) for x in saturation.PERCENTS]].values
+        # the samples grow, so the counts never go down
+        self.assertTrue((np.diff(counts, axis=1) >= 0).all())
+        count = rseqc.ReadCount(bed)
+        rseqc.walk_bam(self.input_file, [count])
+        table = count.table()
+        mrna = table[table["accession"].str.endswith("_mRNA")]
+        self.assertEquals(counts[:, -1].sum(), mrna["tag_count"].sum())
+
     def test_RPKM_saturation(self):
         out_file_RPKM_saturation = rseqc.RPKM_saturation(self.input_file,
                                                          self.config)
@@ -100,6 +254,12 @@ class TestRseqc(unittest.TestCase):
         self.assertTrue(file_exists(out_file_RPKM_saturation))
         os.unlink(out_file_RPKM_saturation)
 
+    def tearDown(self):
+        # the chromosome sizes cached by bam2bigwig
+        ref_dir = self.config["dir"]["ref"]
+        if os.path.exists(ref_dir):
+            shutil.rmtree(ref_dir)
+
 if __name__ == "__main__":
     suite = unittest.TestLoader().loadTestsFromTestCase(TestRseqc)
     unittest.TextTestRunner(verbosity=2).run(suite)